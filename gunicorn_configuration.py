@@ -1,2 +1,6 @@
+import os
+
 timeout = 1500
-keepalive = 1500
\ No newline at end of file
+keepalive = 1500
+# Use uvicorn.workers.UvicornWorker, with asgi:application instead of wsgi:application, for the async front end
+worker_class = os.environ.get("SASWEBCALC_WORKER_CLASS", "sync")
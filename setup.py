@@ -8,5 +8,5 @@ setup(
     author_email='jeffery.krzywon@nist.gov',
     description='A web-based small-angle scattering (SAS) tool for calculating theoretical I vs. Q and 2D scattering patterns based off an instrumental configuration and SAS model.',
     packages=find_packages(),
-    install_requires=['numpy', 'flask', 'sasmodels', 'gunicorn'],
+    install_requires=['numpy', 'flask', 'sasmodels', 'gunicorn', 'uvicorn', 'a2wsgi'],
 )
\ No newline at end of file
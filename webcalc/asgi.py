@@ -0,0 +1,3 @@
+from webcalc import create_app
+from python.asgi import AsgiApplication
+application = AsgiApplication(create_app())
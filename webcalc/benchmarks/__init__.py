@@ -0,0 +1,5 @@
+"""Timing benchmarks for the instruments, slicers, sasmodels evaluation, and the /calculate/ route
+
+Run from the webcalc directory with ``python -m benchmarks --output results.json`` and compare two runs with
+``python -m benchmarks --compare before.json after.json``.
+"""
@@ -0,0 +1,54 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+
+# The /calculate/ benchmarks time the calculation, so repeated requests must not be answered from the result or
+#  instrument caches. They are read when the modules are imported, so they are set before any are.
+os.environ.setdefault("SASWEBCALC_RESULT_CACHE_SIZE", "0")
+os.environ.setdefault("SASWEBCALC_INSTRUMENT_CACHE_SIZE", "0")
+
+from python.registry import InstrumentRegistry
+
+from .cases import get_all_benchmarks
+from .runner import compare_results, load_results, run_benchmarks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description="Times the instruments, slicers, models, and /calculate/ route")
+    parser.add_argument("--output", help="The JSON file the results are written to, stdout if not given")
+    parser.add_argument("--repeat", type=int, default=5, help="The number of timed calls of each benchmark")
+    parser.add_argument("--warmup", type=int, default=1, help="The number of calls before timing")
+    parser.add_argument("--filter", default="", help="Only run benchmarks whose name contains this text")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="Compare two result files instead of running the benchmarks")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        for row in compare_results(load_results(args.compare[0]), load_results(args.compare[1])):
+            ratio = f"{row['ratio']:6.2f}x" if row["ratio"] is not None else "     -"
+            print(f"{row['name']:60s} {row['before'] * 1000:10.3f} ms {row['after'] * 1000:10.3f} ms {ratio}")
+        return
+
+    # Imported here so comparing results does not need the app
+    from webcalc import create_app
+    with contextlib.redirect_stdout(io.StringIO()):
+        app = create_app()
+        registry = InstrumentRegistry()
+        registry.load()
+    benchmarks = [benchmark for benchmark in get_all_benchmarks(app, registry) if args.filter in benchmark.name]
+    # Progress goes to stderr so stdout can be the JSON results
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run_benchmarks(benchmarks, repeat=args.repeat, warmup=args.warmup)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+import copy
+import json
+from typing import Dict, List
+
+import numpy as np
+
+from python.executor import run_sas_calc
+from python.link_to_sasmodels import calculate_model, get_params
+from python.registry import InstrumentRegistry
+from python.slicers import Q_GRID_CACHE, Circular, DetectorGeometry, Elliptical, Rectangular, Sector, get_q_grid
+
+from .runner import Benchmark
+
+# The instruments timed, and whether they use the averaging types
+INSTRUMENTS = {"NG7SANS": True, "NGB10SANS": True, "NGB30SANS": True, "NoInstrument": False}
+# The averaging types, as the instruments expect them, and their slicer classes
+AVERAGING_TYPES = {"Circular": Circular, "sector": Sector, "rectangular": Rectangular, "elliptical": Elliptical}
+# A representative set of form factors, including oriented and multiplicity models
+MODELS = ["sphere", "cylinder", "core_shell_sphere", "ellipsoid", "flexible_cylinder", "lamellar", "power_law",
+          "core_multi_shell"]
+# Form factor and structure factor products
+PRODUCT_MODELS = ["sphere@hardsphere", "cylinder@hayter_msa", "ellipsoid@stickyhardsphere", "sphere@squarewell"]
+# The model used for the instrument and round trip benchmarks
+DEFAULT_MODEL = "sphere"
+# The number of Q values in 1D model benchmarks and on each side of the 2D model benchmarks
+N_Q_1D = 100
+N_Q_2D = 128
+# The parameters slicer benchmarks use, matching a 128 x 128 detector 10 m from the sample
+SLICER_PARAMS = {"x_pixels": 128, "y_pixels": 128, "x_center": 64.5, "y_center": 64.5, "pixel_size": 0.508,
+                 "lambda_val": 6.0, "SDD": 1000.0, "detector_distance": 1000.0, "phi": 0.5, "aspect_ratio": 2.0,
+                 "detector_sections": "both"}
+# The number of pixels on each side of the detectors timed by the detector size benchmarks
+DETECTOR_SIZES = [128, 256, 512, 1024]
+
+
+def get_instrument_params(name: str, registry: InstrumentRegistry) -> Dict:
+    """Gets the parameters the front end sends for an instrument, with the first option chosen where there is no
+    default
+
+    :param str name: The class name of the instrument
+    :param InstrumentRegistry registry: The registry the instrument is in
+    :return: The instrument parameters
+    :rtype: Dict
+    """
+    params = json.loads(registry.get_js_params_json(name))
+    for category in params.values():
+        for param in category.values():
+            if isinstance(param, dict) and "default" not in param and param.get("options"):
+                param["default"] = param["options"][0]
+    return params
+
+
+def get_calculate_request(instrument: str, averaging_type: str, registry: InstrumentRegistry,
+                          model: str = DEFAULT_MODEL, structure_factor: str = "None") -> bytes:
+    """Gets a /calculate/ request body like the one the front end sends
+
+    :param str instrument: The class name of the instrument
+    :param str averaging_type: The averaging type
+    :param InstrumentRegistry registry: The registry the instrument is in
+    :param str model: The form factor
+    :param str structure_factor: The structure factor, or None
+    :return: The request body
+    :rtype: bytes
+    """
+    request = {"instrument": instrument, "instrument_params": get_instrument_params(instrument, registry),
+               "model": model, "model_params": get_params(model, json_encode=False),
+               "structure_factor": structure_factor, "averaging_type": averaging_type, "averaging_params": {}}
+    return json.dumps(json.dumps(request)).encode()
+
+
+def _get_averaging_types(instrument: str) -> List[str]:
+    return list(AVERAGING_TYPES) if INSTRUMENTS[instrument] else ["Circular"]
+
+
+def get_instrument_benchmarks(registry: InstrumentRegistry) -> List[Benchmark]:
+    """Times creating each instrument and running sas_calc, for each averaging type
+
+    :param InstrumentRegistry registry: The registry the instruments are in
+    :return: The benchmarks
+    :rtype: List
+    """
+    benchmarks = []
+    for instrument in INSTRUMENTS:
+        for averaging_type in _get_averaging_types(instrument):
+            params = {"instrument_params": get_instrument_params(instrument, registry), "slicer": averaging_type,
+                      "slicer_params": {}}
+            benchmarks.append(Benchmark(f"instrument/{instrument}/{averaging_type}", "instrument", run_sas_calc,
+                                        lambda params=params, instrument=instrument:
+                                        (instrument, copy.deepcopy(params), registry)))
+    return benchmarks
+
+
+def get_slicer_benchmarks() -> List[Benchmark]:
+    """Times the binning of each slicer on a 128 x 128 detector, with a sector width of 0.5 radians
+
+    :return: The benchmarks
+    :rtype: List
+    """
+    return [Benchmark(f"slicer/{averaging_type}", "slicer", lambda slicer_class=slicer_class:
+                      slicer_class(dict(SLICER_PARAMS)).calculate())
+            for averaging_type, slicer_class in AVERAGING_TYPES.items()]
+
+
+def get_detector_params(size: int) -> Dict:
+    """Gets the slicer parameters of a square detector with the pixels of the benchmark detector
+
+    :param int size: The number of pixels on each side
+    :return: The slicer parameters, with the beam in the center
+    :rtype: Dict
+    """
+    return dict(SLICER_PARAMS, x_pixels=size, y_pixels=size, x_center=size / 2 + 0.5, y_center=size / 2 + 0.5)
+
+
+def get_detector_benchmarks() -> List[Benchmark]:
+    """Times the detector geometry, circular binning, and the 2D model for each of the DETECTOR_SIZES, so the time
+    and memory of the 2D path can be checked to grow linearly with the number of pixels
+
+    :return: The benchmarks
+    :rtype: List
+    """
+    benchmarks = []
+    for size in DETECTOR_SIZES:
+        params = get_detector_params(size)
+        geometry_args = (size, size, params["pixel_size"], params["pixel_size"], params["x_center"],
+                         params["y_center"], params["detector_distance"], params["lambda_val"], 10000)
+
+        def setup_geometry(geometry_args=geometry_args):
+            # The Q grid would otherwise be reused from the last call
+            Q_GRID_CACHE.clear()
+            return geometry_args
+
+        geometry = DetectorGeometry(*geometry_args)
+        q_2d = get_q_grid(geometry.qx_values, geometry.qy_values).get_flattened()
+        benchmarks += [
+            Benchmark(f"detector/{size}/geometry", "detector", DetectorGeometry, setup_geometry),
+            Benchmark(f"detector/{size}/slicer", "detector", lambda params=params: Circular(dict(params)).calculate()),
+            Benchmark(f"detector/{size}/model_2d", "detector", calculate_model,
+                      lambda q_2d=q_2d: (DEFAULT_MODEL, q_2d, {})),
+        ]
+    return benchmarks
+
+
+def get_model_benchmarks() -> List[Benchmark]:
+    """Times calculate_model in 1D and 2D for each model, with the default parameters
+
+    :return: The benchmarks
+    :rtype: List
+    """
+    q_1d = [np.logspace(-3, -0.5, N_Q_1D)]
+    qx, qy = np.meshgrid(np.linspace(-0.3, 0.3, N_Q_2D), np.linspace(-0.3, 0.3, N_Q_2D))
+    q_2d = [qx.flatten(), qy.flatten()]
+    benchmarks = []
+    for model in MODELS + PRODUCT_MODELS:
+        for dimension, q in [("1d", q_1d), ("2d", q_2d)]:
+            benchmarks.append(Benchmark(f"model/{model}/{dimension}", "model", calculate_model,
+                                        lambda model=model, q=q: (model, q, {})))
+    return benchmarks
+
+
+def get_round_trip_benchmarks(app, registry: InstrumentRegistry) -> List[Benchmark]:
+    """Times full /calculate/ requests through the Flask test client, for each instrument and averaging type, and
+    with a structure factor
+
+    :param app: The Flask app from create_app
+    :param InstrumentRegistry registry: The registry the instruments are in
+    :return: The benchmarks
+    :rtype: List
+    """
+    client = app.test_client()
+
+    def post(body):
+        response = client.post("/calculate/", data=body)
+        if response.status_code != 200:
+            raise RuntimeError(f"/calculate/ returned {response.status_code}")
+
+    benchmarks = []
+    for instrument in INSTRUMENTS:
+        for averaging_type in _get_averaging_types(instrument):
+            body = get_calculate_request(instrument, averaging_type, registry)
+            benchmarks.append(Benchmark(f"calculate/{instrument}/{averaging_type}", "calculate", post,
+                                        lambda body=body: (body,)))
+    body = get_calculate_request("NG7SANS", "Circular", registry, structure_factor="hardsphere")
+    benchmarks.append(Benchmark("calculate/NG7SANS/Circular/sphere@hardsphere", "calculate", post,
+                                lambda: (body,)))
+    return benchmarks
+
+
+def get_all_benchmarks(app, registry: InstrumentRegistry) -> List[Benchmark]:
+    """Gets every benchmark
+
+    :param app: The Flask app from create_app
+    :param InstrumentRegistry registry: The registry the instruments are in
+    :return: The benchmarks
+    :rtype: List
+    """
+    return (get_instrument_benchmarks(registry) + get_slicer_benchmarks() + get_detector_benchmarks()
+            + get_model_benchmarks() + get_round_trip_benchmarks(app, registry))
@@ -0,0 +1,294 @@
+"""Replays recorded request bodies against the app, in process or against a running server, and reports the
+throughput, latency percentiles, and error rate of each route
+
+Record traffic with ``SASWEBCALC_CAPTURE_DIR`` set, or write synthetic requests with ``--synthetic``, then run
+from the webcalc directory::
+
+    python -m benchmarks.replay requests.jsonl --concurrency 8 --rate 20 --requests 500
+    python -m benchmarks.replay requests.jsonl --url http://localhost:8000 --duration 60
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from python.capture import get_record_body, get_replay_record, load_replay_file
+from python.link_to_sasmodels import get_params
+from python.registry import InstrumentRegistry
+
+from .cases import AVERAGING_TYPES, INSTRUMENTS, MODELS, get_calculate_request
+from .runner import get_metadata
+
+# The latency percentiles reported for each route
+PERCENTILES = (50, 90, 95, 99)
+
+
+class TestClientTarget:
+    """Sends requests to an app in this process with the Flask test client"""
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def send(self, record: Dict) -> int:
+        """Sends the request of a replay record
+
+        :param dict record: The replay record
+        :return: The response status
+        :rtype: int
+        """
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        headers = {"Accept": record["response_type"]} if record.get("response_type") else {}
+        response = client.open(record["path"], method=record.get("method", "POST"), query_string=record.get("args"),
+                               data=get_record_body(record), content_type=record.get("content_type"),
+                               headers=headers)
+        # Read the whole body, as a server would have to send it
+        response.get_data()
+        return response.status_code
+
+
+class HttpTarget:
+    """Sends requests to a running server, e.g. gunicorn, over HTTP"""
+
+    def __init__(self, url: str, timeout: float = 120):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def send(self, record: Dict) -> int:
+        """Sends the request of a replay record
+
+        :param dict record: The replay record
+        :return: The response status
+        :rtype: int
+        """
+        url = self.url + record["path"]
+        if record.get("args"):
+            url += "?" + urllib.parse.urlencode(record["args"])
+        request = urllib.request.Request(url, data=get_record_body(record), method=record.get("method", "POST"))
+        if record.get("content_type"):
+            request.add_header("Content-Type", record["content_type"])
+        # Clients that asked for the binary format are sent it again
+        if record.get("response_type"):
+            request.add_header("Accept", record["response_type"])
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+
+def run_load(records: List[Dict], target, concurrency: int = 1, rate: Optional[float] = None,
+             requests: Optional[int] = None, duration: Optional[float] = None) -> Tuple[List[Tuple], float]:
+    """Sends the recorded requests in order, repeating them until enough requests were sent
+
+    With a rate, requests are started on a fixed schedule whether or not earlier requests have finished, and the
+    latency is measured from the time a request was due, so a server that falls behind is not hidden by the load
+    generator slowing down with it. Without a rate, each of the concurrent senders sends its next request as soon as
+    the last one finishes.
+
+    :param list records: The replay records
+    :param target: A TestClientTarget or HttpTarget
+    :param int concurrency: The number of requests sent at the same time
+    :param float rate: The number of requests started per second, or None to send as fast as possible
+    :param int requests: The number of requests to send, once through the records if neither this nor duration is set
+    :param float duration: The number of seconds to send requests for
+    :return: A list of (path, status, latency in seconds, error message) and the total number of seconds taken
+    :rtype: Tuple
+    """
+    if not records:
+        return [], 0.0
+    if requests is None and duration is None:
+        requests = len(records)
+    counter = itertools.count()
+    counter_lock = threading.Lock()
+    results = []
+    start = time.perf_counter()
+
+    def next_index() -> Optional[int]:
+        with counter_lock:
+            index = next(counter)
+        if requests is not None and index >= requests:
+            return None
+        if duration is not None and time.perf_counter() - start >= duration:
+            return None
+        return index
+
+    def sender():
+        while True:
+            index = next_index()
+            if index is None:
+                return
+            due = start + index / rate if rate else time.perf_counter()
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            if duration is not None and due - start >= duration:
+                return
+            record = records[index % len(records)]
+            sent = time.perf_counter() if not rate else due
+            try:
+                status, error = target.send(record), None
+            except Exception as e:
+                status, error = None, f"{type(e).__name__}: {e}"
+            results.append((record["path"], status, time.perf_counter() - sent, error))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(sender) for _ in range(concurrency)]:
+            future.result()
+    return results, time.perf_counter() - start
+
+
+def get_percentile(sorted_values: List[float], percentile: float) -> float:
+    """Gets a percentile of sorted values by the nearest rank method
+
+    :param list sorted_values: The values in ascending order
+    :param float percentile: The percentile, from 0 to 100
+    :return: The value
+    :rtype: float
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(int(-(-percentile * len(sorted_values) // 100)), 1)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(results: List[Tuple], elapsed: float) -> Dict[str, Dict]:
+    """Gets the throughput, latency, and error rate of each route, and of all routes together
+
+    A request is an error if it raised, e.g. the connection was refused, or was answered with a status of 400 or more.
+
+    :param list results: The results from run_load
+    :param float elapsed: The number of seconds the load ran for
+    :return: A dictionary mapping each path, and "all", to its statistics with latencies in seconds
+    :rtype: Dict
+    """
+    groups = {}
+    for result in results:
+        groups.setdefault(result[0], []).append(result)
+    groups["all"] = list(results)
+    summary = {}
+    for path, group in groups.items():
+        latencies = sorted(latency for _, _, latency, _ in group)
+        errors = sum(1 for _, status, _, error in group if error is not None or status >= 400)
+        statuses = {}
+        for _, status, _, error in group:
+            key = str(status) if error is None else "exception"
+            statuses[key] = statuses.get(key, 0) + 1
+        summary[path] = {
+            "requests": len(group),
+            "errors": errors,
+            "error_rate": errors / len(group) if group else 0.0,
+            "throughput": len(group) / elapsed if elapsed > 0 else 0.0,
+            "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+            "max": latencies[-1] if latencies else 0.0,
+            "statuses": statuses,
+        }
+        for percentile in PERCENTILES:
+            summary[path][f"p{percentile}"] = get_percentile(latencies, percentile)
+    return summary
+
+
+def get_synthetic_records(registry: InstrumentRegistry) -> List[Dict]:
+    """Gets /update/params/ requests for each model in the benchmark cases, and /calculate/ requests for each
+    instrument, averaging type, and model, for when no captured traffic is available
+
+    Multiplicity models are only sent to /update/params/, as their parameters are expanded by the front end before
+    they are calculated.
+
+    :param InstrumentRegistry registry: The registry the instruments are in
+    :return: The replay records
+    :rtype: List
+    """
+    records = []
+    calculated_models = []
+    for model in MODELS:
+        params = get_params(model, json_encode=False)
+        body = json.dumps(json.dumps({"model": model, "model_params": params})).encode()
+        records.append(get_replay_record("POST", "/update/params/", {}, "application/json", body))
+        if not any("[" in name for name in params):
+            calculated_models.append(model)
+    for instrument, has_averaging in INSTRUMENTS.items():
+        for averaging_type in (AVERAGING_TYPES if has_averaging else ["Circular"]):
+            for model in calculated_models:
+                body = get_calculate_request(instrument, averaging_type, registry, model)
+                records.append(get_replay_record("POST", "/calculate/", {}, "application/json", body))
+    return records
+
+
+def print_summary(summary: Dict[str, Dict], file=sys.stdout):
+    """Prints the summary of each route as a table, with latencies in milliseconds
+
+    :rtype: None
+    """
+    columns = ["requests", "throughput", "error_rate"] + [f"p{percentile}" for percentile in PERCENTILES] + ["max"]
+    print(f"{'route':40s}" + "".join(f"{column:>12s}" for column in columns), file=file)
+    for path, stats in summary.items():
+        values = [f"{stats['requests']:12d}", f"{stats['throughput']:10.2f}/s", f"{stats['error_rate'] * 100:11.2f}%"]
+        values += [f"{stats[column] * 1000:9.1f} ms" for column in columns[3:]]
+        print(f"{path:40s}" + "".join(values), file=file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.replay",
+                                     description="Replays recorded requests and reports latency and errors per route")
+    parser.add_argument("files", nargs="*", help="Replay files written by the capture, or by --synthetic")
+    parser.add_argument("--url", help="The server to send requests to, e.g. http://localhost:8000. In process if not "
+                                      "given.")
+    parser.add_argument("--concurrency", type=int, default=1, help="The number of requests sent at the same time")
+    parser.add_argument("--rate", type=float, help="The number of requests started per second, as fast as possible if "
+                                                   "not given")
+    parser.add_argument("--requests", type=int, help="The number of requests sent, repeating the recorded requests")
+    parser.add_argument("--duration", type=float, help="The number of seconds to send requests for")
+    parser.add_argument("--timeout", type=float, default=120, help="The number of seconds to wait for a response")
+    parser.add_argument("--output", help="The JSON file the summary is written to")
+    parser.add_argument("--synthetic", metavar="FILE", help="Write synthetic /calculate/ requests to a replay file "
+                                                            "instead of sending requests")
+    args = parser.parse_args(argv)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        registry = InstrumentRegistry()
+        registry.load()
+    if args.synthetic:
+        with contextlib.redirect_stdout(io.StringIO()):
+            records = get_synthetic_records(registry)
+        with open(args.synthetic, "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        return
+    records = [record for path in args.files for record in load_replay_file(path)]
+    if not records:
+        parser.error("No requests to replay")
+
+    if args.url:
+        target = HttpTarget(args.url, args.timeout)
+    else:
+        # Imported here so replaying against a server does not need the app
+        from webcalc import create_app
+        with contextlib.redirect_stdout(io.StringIO()):
+            target = TestClientTarget(create_app())
+    # The app prints while calculating, which would swamp the summary
+    with contextlib.redirect_stdout(io.StringIO()):
+        results, elapsed = run_load(records, target, args.concurrency, args.rate, args.requests, args.duration)
+    summary = summarize(results, elapsed)
+    print_summary(summary)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"metadata": get_metadata(), "target": args.url or "in process", "concurrency": args.concurrency,
+                       "rate": args.rate, "elapsed": elapsed, "routes": summary}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import contextlib
+import datetime
+import io
+import json
+import platform
+import statistics
+import subprocess
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# The version of the JSON results format, increased when the format changes
+RESULTS_FORMAT_VERSION = 1
+
+
+class Benchmark:
+    """A single timed operation
+
+    :param str self.name: The unique name of the benchmark, e.g. instrument/NG7SANS/Circular
+    :param str self.group: The group the benchmark belongs to, e.g. instrument
+    :param self.function: The operation that is timed
+    :param self.setup: An optional function returning the arguments of each call, which is not timed
+    """
+
+    def __init__(self, name: str, group: str, function: Callable, setup: Optional[Callable[[], Tuple]] = None):
+        self.name = name
+        self.group = group
+        self.function = function
+        self.setup = setup
+
+    def call(self) -> float:
+        """Calls the function once
+
+        :return: The time the call took, in seconds
+        :rtype: float
+        """
+        args = self.setup() if self.setup is not None else ()
+        start = time.perf_counter()
+        self.function(*args)
+        return time.perf_counter() - start
+
+
+def time_benchmark(benchmark: Benchmark, repeat: int = 5, warmup: int = 1) -> Dict:
+    """Times a benchmark after warming it up, so one-off work like compiling models is not included
+
+    :param Benchmark benchmark: The benchmark to time
+    :param int repeat: The number of timed calls
+    :param int warmup: The number of calls made before timing
+    :return: The timing statistics in seconds, or the error if the benchmark fails
+    :rtype: Dict
+    """
+    result = {"name": benchmark.name, "group": benchmark.group}
+    try:
+        for _ in range(warmup):
+            benchmark.call()
+        times = [benchmark.call() for _ in range(repeat)]
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        return result
+    result.update({"repeat": repeat, "min": min(times), "median": statistics.median(times),
+                   "mean": statistics.mean(times), "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+                   "max": max(times)})
+    return result
+
+
+def get_metadata() -> Dict:
+    """Gets the details of the environment the benchmarks were run in
+
+    :return: A dictionary of the versions, platform, time, and git commit
+    :rtype: Dict
+    """
+    import numpy
+    import sasmodels
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"format_version": RESULTS_FORMAT_VERSION,
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "commit": commit, "python": platform.python_version(), "platform": platform.platform(),
+            "processor": platform.processor(), "numpy": numpy.__version__, "sasmodels": sasmodels.__version__}
+
+
+def run_benchmarks(benchmarks: List[Benchmark], repeat: int = 5, warmup: int = 1, verbose: bool = True) -> Dict:
+    """Times every benchmark
+
+    The instruments print while they calculate, so output is suppressed during each benchmark.
+
+    :param benchmarks: The benchmarks to run
+    :param int repeat: The number of timed calls of each benchmark
+    :param int warmup: The number of calls made before timing
+    :param bool verbose: Print each result as it finishes
+    :return: The metadata and results, ready to be saved as JSON
+    :rtype: Dict
+    """
+    results = []
+    for benchmark in benchmarks:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = time_benchmark(benchmark, repeat, warmup)
+        results.append(result)
+        if verbose:
+            summary = result.get("error") or f"{result['median'] * 1000:10.3f} ms median"
+            print(f"{benchmark.name:60s} {summary}")
+    return {"metadata": get_metadata(), "results": results}
+
+
+def compare_results(before: Dict, after: Dict) -> List[Dict]:
+    """Compares the median times of two runs
+
+    :param dict before: The results of the first run
+    :param dict after: The results of the second run
+    :return: A list of {name, before, after, ratio} for the benchmarks in both runs, where ratio is after / before
+    :rtype: List
+    """
+    medians = {result["name"]: result["median"] for result in before["results"] if "median" in result}
+    comparison = []
+    for result in after["results"]:
+        if "median" in result and result["name"] in medians:
+            old = medians[result["name"]]
+            comparison.append({"name": result["name"], "before": old, "after": result["median"],
+                               "ratio": result["median"] / old if old else None})
+    return comparison
+
+
+def load_results(path: str) -> Dict:
+    """Loads results saved by run_benchmarks
+
+    :param str path: The path of the JSON file
+    :return: The results
+    :rtype: Dict
+    """
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,201 @@
+import asyncio
+import os
+import threading
+from typing import Callable, Iterable
+
+from a2wsgi import WSGIMiddleware
+
+# The number of threads running Flask handlers. Handlers only hold a thread while they calculate, or wait for the
+#  process pool, as request bodies are read and responses are sent by the event loop.
+ASGI_THREADS = int(os.environ.get("SASWEBCALC_ASGI_THREADS", 32))
+# The largest request body accepted, in bytes
+MAX_BODY_SIZE = int(os.environ.get("SASWEBCALC_MAX_BODY_SIZE", 64 * 1024 * 1024))
+
+# The environ key of the threading.Event set when the client disconnects, which handlers may pass to
+#  ExecutionPool.run to cancel queued calculations
+DISCONNECTED_KEY = "saswebcalc.disconnected"
+
+
+class AsgiApplication:
+    """Serves a WSGI application, e.g. the Flask app from create_app, to an ASGI server such as uvicorn
+
+    The WSGI application is run in the threads of an a2wsgi.WSGIMiddleware. The whole request body is read on the
+    event loop before a thread is taken, and the client is watched while the handler runs. Handlers find an event set
+    when the client disconnects in environ[DISCONNECTED_KEY], and streamed responses are closed when it is set, which
+    cancels any batch work that has not started.
+
+    :param WSGIMiddleware self.app: The ASGI application calling the WSGI application
+    :param int self.max_body_size: The largest request body accepted, in bytes
+    """
+
+    def __init__(self, wsgi_app: Callable, threads: int = ASGI_THREADS, max_body_size: int = MAX_BODY_SIZE):
+        """Creates the ASGI application
+
+        :param wsgi_app: The WSGI application
+        :param int threads: The number of threads the WSGI application is called in
+        :param int max_body_size: The largest request body accepted, in bytes
+        """
+        self.app = WSGIMiddleware(DisconnectedEnviron(wsgi_app), workers=threads)
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        body = await read_body(receive, self.max_body_size)
+        if body is None:
+            # There is no one to answer
+            return
+        if body is False:
+            await send({"type": "http.response.start", "status": 413, "headers": []})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        disconnected = threading.Event()
+        watcher = asyncio.create_task(watch_disconnect(receive, disconnected))
+        replayed = []
+
+        async def replay():
+            """Gives the body that was read to the WSGI middleware, then waits for the client to disconnect"""
+            if not replayed:
+                replayed.append(body)
+                return {"type": "http.request", "body": body, "more_body": False}
+            await watcher
+            return {"type": "http.disconnect"}
+
+        # The body has been read, so its length is known even when it was sent in chunks
+        headers = [(name, value) for name, value in scope.get("headers", []) if name.lower() != b"content-length"]
+        headers.append((b"content-length", str(len(body)).encode("latin-1")))
+        try:
+            await self.app(dict(scope, headers=headers, **{DISCONNECTED_KEY: disconnected}), replay, send)
+        finally:
+            watcher.cancel()
+
+
+class DisconnectedEnviron:
+    """Passes the event set when the client disconnects, put in the ASGI scope by AsgiApplication, to the WSGI
+    application, and stops streaming the response once it is set
+
+    :param self.wsgi_app: The WSGI application
+    """
+
+    def __init__(self, wsgi_app: Callable):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        disconnected = environ["asgi.scope"][DISCONNECTED_KEY]
+        environ[DISCONNECTED_KEY] = disconnected
+        return stream_until(self.wsgi_app(environ, start_response), disconnected)
+
+
+def stream_until(iterable: Iterable[bytes], disconnected: threading.Event):
+    """Yields the chunks of a response until the client disconnects, then closes the response
+
+    :param iterable: The response of the WSGI application
+    :param threading.Event disconnected: The event set when the client disconnects
+    """
+    try:
+        for chunk in iterable:
+            if disconnected.is_set():
+                return
+            yield chunk
+    finally:
+        if hasattr(iterable, "close"):
+            iterable.close()
+
+
+async def read_body(receive, max_body_size: int):
+    """Reads the whole request body
+
+    :param receive: The ASGI receive callable
+    :param int max_body_size: The largest request body accepted, in bytes
+    :return: The body, None if the client disconnected, or False if the body is too large
+    """
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > max_body_size:
+            return False
+        chunks.append(chunk)
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def watch_disconnect(receive, disconnected: threading.Event):
+    """Sets disconnected when the client goes away"""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            disconnected.set()
+            return
+
+
+if __name__ == '__main__':
+    from flask import Flask, request, stream_with_context
+
+    app = Flask(__name__)
+
+    @app.route('/echo/', methods=['POST'])
+    def echo():
+        return request.data[::-1] + request.args.get('suffix', '').encode()
+
+    @app.route('/stream/')
+    def stream():
+        return app.response_class(stream_with_context(str(i) for i in range(3)))
+
+    waited = []
+
+    @app.route('/wait/', methods=['POST'])
+    def wait():
+        waited.append(request.environ[DISCONNECTED_KEY].wait(5))
+        return ""
+
+    async def call(application, method, path, body=b"", query=b"", disconnect=False, disconnect_after=False):
+        messages = [{"type": "http.request", "body": body[:2], "more_body": True},
+                    {"type": "http.disconnect"} if disconnect else
+                    {"type": "http.request", "body": body[2:], "more_body": False}]
+        if disconnect_after:
+            messages.append({"type": "http.disconnect"})
+        sent = []
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await asyncio.sleep(3600)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": method, "path": path, "query_string": query, "headers": [],
+                 "http_version": "1.1"}
+        await application(scope, receive, send)
+        if not sent:
+            return None
+        return sent[0]["status"], b"".join(message.get("body", b"") for message in sent[1:])
+
+    application = AsgiApplication(app, threads=2, max_body_size=100)
+    # Ensure requests are passed through unchanged, in pieces, and streamed back
+    assert asyncio.run(call(application, "POST", "/echo/", b"abcdef", b"suffix=g")) == (200, b"fedcbag")
+    assert asyncio.run(call(application, "GET", "/stream/")) == (200, b"012")
+    assert asyncio.run(call(application, "GET", "/missing/"))[0] == 404
+    assert asyncio.run(call(application, "POST", "/echo/", b"x" * 101))[0] == 413
+    # Ensure nothing is sent to a client that disconnected while sending its request
+    assert asyncio.run(call(application, "POST", "/echo/", b"abcdef", disconnect=True)) is None
+    # Ensure handlers are told when the client disconnects while they run
+    asyncio.run(call(application, "POST", "/wait/", b"abcdef", disconnect_after=True))
+    assert waited == [True]
+    # Ensure streamed responses stop, and are closed, once the client disconnects
+    closed = []
+
+    class Response(list):
+        def close(self):
+            closed.append(True)
+
+    disconnected = threading.Event()
+    assert list(stream_until(Response([b"a", b"b"]), disconnected)) == [b"a", b"b"] and closed == [True]
+    disconnected.set()
+    assert list(stream_until(Response([b"a", b"b"]), disconnected)) == [] and closed == [True, True]
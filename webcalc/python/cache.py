@@ -0,0 +1,164 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+# Every cache created in this process, by name, so their statistics can be reported together
+CACHES = {}
+
+
+class LRUCache:
+    """A thread-safe, size-bounded, least recently used cache that keeps hit and miss counters
+
+    :param str self.name: The name the cache is registered under
+    :param int self.maxsize: The maximum number of entries stored before the least recently used is evicted
+    :param int self.hits: The number of lookups that found a stored value
+    :param int self.misses: The number of lookups that did not find a stored value
+    :param int self.evictions: The number of entries removed to stay within maxsize
+    :param self.on_evict: An optional function called with each value that is removed from the cache
+    """
+
+    def __init__(self, name: str, maxsize: int = 32, on_evict: Optional[Callable[[Any], None]] = None):
+        """Creates an empty cache and registers it by name
+
+        :param str name: The name of the cache
+        :param int maxsize: The maximum number of entries to store
+        :param on_evict: An optional function called with each value that is removed, e.g. to release resources
+        """
+        self.name = name
+        self.maxsize = max(int(maxsize), 0)
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        CACHES[name] = self
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def keys(self) -> List[Hashable]:
+        """Gets a list of the stored keys, from least to most recently used
+
+        :return: The stored keys
+        :rtype: List
+        """
+        with self._lock:
+            return list(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Gets a value from the cache and marks it as the most recently used
+
+        :param key: The cache key
+        :param default: The value returned if the key is not stored
+        :return: The stored value or the default
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any):
+        """Stores a value, evicting the least recently used entries if the cache is full
+
+        :param key: The cache key
+        :param value: The value to store
+        :rtype: None
+        """
+        with self._lock:
+            previous = self._entries.get(key, value)
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            # A value replaced by another, e.g. created by two threads at once, is released like an evicted value
+            if previous is not value:
+                self._release(previous)
+            self._trim()
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """Gets a value from the cache, calling factory to create and store it if it is not stored yet
+
+        :param key: The cache key
+        :param factory: A function without arguments that creates the value
+        :return: The stored or newly created value
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        # Create the value outside the lock so slow factories do not block other lookups
+        value = factory()
+        self.put(key, value)
+        return value
+
+    def evict(self, key: Hashable) -> bool:
+        """Removes a single entry from the cache
+
+        :param key: The cache key
+        :return: True if an entry was removed
+        :rtype: bool
+        """
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._release(self._entries.pop(key))
+            return True
+
+    def clear(self):
+        """Removes all entries and resets the counters
+
+        :rtype: None
+        """
+        with self._lock:
+            while self._entries:
+                self._release(self._entries.popitem(last=False)[1])
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def resize(self, maxsize: int):
+        """Changes the size bound, evicting the least recently used entries if necessary
+
+        :param int maxsize: The new maximum number of entries
+        :rtype: None
+        """
+        with self._lock:
+            self.maxsize = max(int(maxsize), 0)
+            self._trim()
+
+    def stats(self) -> Dict[str, int]:
+        """Gets the size and counters of the cache
+
+        :return: A dictionary of the cache statistics
+        :rtype: Dict
+        """
+        with self._lock:
+            return {"size": len(self._entries), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
+
+    def _trim(self):
+        """Evicts the least recently used entries until the cache fits in maxsize"""
+        while len(self._entries) > self.maxsize:
+            self._release(self._entries.popitem(last=False)[1])
+            self.evictions += 1
+
+    def _release(self, value: Any):
+        """Passes a removed value to on_evict, if it is set"""
+        if self.on_evict is not None:
+            self.on_evict(value)
+
+
+def get_cache_stats() -> Dict[str, Dict[str, int]]:
+    """Gets the statistics of every cache in this process
+
+    :return: A dictionary mapping the cache name to its statistics
+    :rtype: Dict
+    """
+    return {name: cache.stats() for name, cache in CACHES.items()}
@@ -0,0 +1,160 @@
+import base64
+import json
+import os
+import random
+import threading
+from typing import Dict, List, Optional
+
+# The directory request bodies are recorded to, one file per process, or an empty string to record nothing
+CAPTURE_DIRECTORY = os.environ.get("SASWEBCALC_CAPTURE_DIR", "")
+# The fraction of requests to the captured routes that are recorded
+CAPTURE_RATE = float(os.environ.get("SASWEBCALC_CAPTURE_RATE", 1.0))
+# The routes whose requests are recorded, separated by commas
+CAPTURE_ROUTES = os.environ.get("SASWEBCALC_CAPTURE_ROUTES", "/calculate/,/update/params/").split(",")
+# Larger request bodies are not recorded, in bytes
+CAPTURE_MAX_BODY_SIZE = int(os.environ.get("SASWEBCALC_CAPTURE_MAX_BODY_SIZE", 1024 * 1024))
+# The query parameters that change a calculation or its response format, and so are kept. Others, e.g. profiling
+#  tokens, are dropped.
+KEPT_QUERY_PARAMETERS = ["dimensions", "precision_2d", "format", "precision"]
+# The version of the replay format, increased when the format changes
+REPLAY_FORMAT_VERSION = 2
+
+
+def get_replay_record(method: str, path: str, args: Dict[str, str], content_type: Optional[str], body: bytes,
+                      status: Optional[int] = None, response_type: Optional[str] = None) -> Dict:
+    """Gets the replay record of a request. Only what is needed to send the request again is kept, so the client
+    address, headers, cookies, and query parameters that do not change the calculation are never recorded. The
+    content type of the response is kept instead of the Accept header, so replayed requests ask for the same format,
+    e.g. the binary format, whether the client asked for it with a header or a query parameter.
+
+    :param str method: The HTTP method
+    :param str path: The path of the request
+    :param dict args: The query parameters
+    :param str content_type: The content type of the body
+    :param bytes body: The request body
+    :param int status: The status the request was answered with
+    :param str response_type: The content type of the response, sent as the Accept header when replayed
+    :return: A dictionary that can be written as one line of a replay file
+    :rtype: Dict
+    """
+    record = {"version": REPLAY_FORMAT_VERSION, "method": method, "path": path,
+              "args": {name: args[name] for name in KEPT_QUERY_PARAMETERS if name in args},
+              "content_type": content_type}
+    try:
+        record["body"] = body.decode("utf-8")
+    except UnicodeDecodeError:
+        record["body"] = base64.b64encode(body).decode("ascii")
+        record["body_encoding"] = "base64"
+    if status is not None:
+        record["status"] = status
+    if response_type is not None:
+        record["response_type"] = response_type
+    return record
+
+
+def get_record_body(record: Dict) -> bytes:
+    """Gets the request body of a replay record
+
+    :param dict record: The replay record
+    :return: The request body
+    :rtype: bytes
+    """
+    if record.get("body_encoding") == "base64":
+        return base64.b64decode(record["body"])
+    return record.get("body", "").encode("utf-8")
+
+
+def load_replay_file(path: str) -> List[Dict]:
+    """Reads the replay records in a file written by RequestCapture, skipping lines that cannot be read, e.g. the
+    last line of a process that was killed while writing
+
+    :param str path: The replay file
+    :return: The replay records
+    :rtype: List
+    """
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and "path" in record:
+                records.append(record)
+    return records
+
+
+class RequestCapture:
+    """Records sampled request bodies of selected routes, so real traffic can be replayed by benchmarks.replay
+
+    Each process appends to capture_<pid>.jsonl in the capture directory, one replay record per line.
+
+    :param str self.directory: The directory written to, or an empty string to record nothing
+    :param float self.rate: The fraction of requests recorded
+    :param list self.routes: The paths of the routes recorded
+    """
+
+    def __init__(self, directory: str = CAPTURE_DIRECTORY, rate: float = CAPTURE_RATE, routes: List[str] = None,
+                 max_body_size: int = CAPTURE_MAX_BODY_SIZE):
+        self.directory = directory
+        self.rate = rate
+        self.routes = CAPTURE_ROUTES if routes is None else routes
+        self.max_body_size = max_body_size
+        self._lock = threading.Lock()
+        self._file = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory) and self.rate > 0
+
+    def should_capture(self, path: str, size: int) -> bool:
+        """Decides whether to record a request
+
+        :param str path: The path of the request
+        :param int size: The size of the body in bytes
+        :return: True if the request should be recorded
+        :rtype: bool
+        """
+        return self.enabled and path in self.routes and size <= self.max_body_size and random.random() < self.rate
+
+    def record(self, method: str, path: str, args: Dict[str, str], content_type: Optional[str], body: bytes,
+               status: Optional[int] = None, response_type: Optional[str] = None):
+        """Appends the replay record of a request to the capture file of this process
+
+        :rtype: None
+        """
+        line = json.dumps(get_replay_record(method, path, args, content_type, body, status, response_type)) + "\n"
+        with self._lock:
+            if self._file is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._file = open(os.path.join(self.directory, f"capture_{os.getpid()}.jsonl"), "a")
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        """Closes the capture file
+
+        :rtype: None
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+if __name__ == '__main__':
+    import tempfile
+    directory = tempfile.mkdtemp()
+    capture = RequestCapture(directory, rate=1.0)
+    assert capture.should_capture("/calculate/", 10) and not capture.should_capture("/get/onLoad/", 10)
+    assert not RequestCapture("", rate=1.0).should_capture("/calculate/", 10)
+    body = json.dumps(json.dumps({"model": "sphere"})).encode()
+    capture.record("POST", "/calculate/", {"dimensions": "1d", "profile": "secret", "format": "binary"},
+                   "application/json", body, 200, "application/x-saswebcalc-binary")
+    capture.record("POST", "/calculate/", {}, None, b"\xff\xfe", 400)
+    capture.close()
+    # Ensure records read back the same bodies, without the query parameters that are not kept
+    records = load_replay_file(os.path.join(directory, f"capture_{os.getpid()}.jsonl"))
+    assert [get_record_body(record) for record in records] == [body, b"\xff\xfe"]
+    assert records[0]["args"] == {"dimensions": "1d", "format": "binary"} and records[1]["status"] == 400
+    assert records[0]["response_type"] == "application/x-saswebcalc-binary" and "response_type" not in records[1]
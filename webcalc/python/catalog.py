@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import sasmodels
+
+from .helpers import encode_json
+from .link_to_sasmodels import get_model_list, get_structure_list, get_multiplicity_models
+
+# Increase this whenever the structure of the snapshot changes so old snapshots are ignored
+CATALOG_FORMAT_VERSION = 1
+# The directory where catalog snapshots are stored between processes
+CATALOG_SNAPSHOT_DIR = os.environ.get("SASWEBCALC_CATALOG_DIR", tempfile.gettempdir())
+
+
+def get_snapshot_path(snapshot_dir: Optional[str] = None) -> str:
+    """Gets the path of the catalog snapshot for the installed sasmodels version
+
+    :param str snapshot_dir: The directory to store snapshots in, defaults to CATALOG_SNAPSHOT_DIR
+    :return: The absolute path of the snapshot file
+    :rtype: str
+    """
+    snapshot_dir = snapshot_dir if snapshot_dir else CATALOG_SNAPSHOT_DIR
+    file_name = f"saswebcalc_catalog_v{CATALOG_FORMAT_VERSION}_sasmodels_{sasmodels.__version__}.json"
+    return os.path.join(snapshot_dir, file_name)
+
+
+def build_model_catalog() -> Dict[str, list]:
+    """Gets the lists of structure factors, multiplicity models, and models from sasmodels
+
+    :return: A dictionary with the structures, multiplicity_models, and models lists
+    :rtype: Dict
+    """
+    return {"structures": get_structure_list(), "multiplicity_models": get_multiplicity_models(),
+            "models": get_model_list()}
+
+
+def load_model_catalog(snapshot_dir: Optional[str] = None) -> Dict[str, list]:
+    """Loads the model catalog from the snapshot for the installed sasmodels version, building and saving it if the
+    snapshot does not exist or cannot be read
+
+    :param str snapshot_dir: The directory to store snapshots in, defaults to CATALOG_SNAPSHOT_DIR
+    :return: A dictionary with the structures, multiplicity_models, and models lists
+    :rtype: Dict
+    """
+    path = get_snapshot_path(snapshot_dir)
+    try:
+        with open(path, 'r') as snapshot:
+            model_catalog = json.load(snapshot)
+        if set(model_catalog) == {"structures", "multiplicity_models", "models"}:
+            return model_catalog
+    except (OSError, ValueError):
+        pass
+    model_catalog = build_model_catalog()
+    try:
+        # Write to a temporary file first so other processes never read a partial snapshot
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(handle, 'w') as snapshot:
+            json.dump(model_catalog, snapshot)
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"Unable to save the catalog snapshot to {path}: {e}")
+    return model_catalog
+
+
+class Catalog:
+    """The payload for /get/onLoad/, built once per process and stored as pre-encoded JSON
+
+    :param self.get_instruments: A function returning a dictionary mapping instrument class names to shown names
+    :param str self.snapshot_dir: The directory used for model catalog snapshots
+    :param tuple self.snapshot: The JSON encoded payload, a hash of it used as the ETag header, and the time it was
+        built, or None until the payload is built
+    """
+
+    def __init__(self, get_instruments: Callable[[], Dict[str, str]], snapshot_dir: Optional[str] = None):
+        """Creates the catalog. The payload is built the first time it is used.
+
+        :param get_instruments: A function returning a dictionary mapping instrument class names to shown names
+        :param str snapshot_dir: The directory to store snapshots in, defaults to CATALOG_SNAPSHOT_DIR
+        """
+        self.get_instruments = get_instruments
+        self.snapshot_dir = snapshot_dir
+        self.snapshot = None
+        self._lock = threading.Lock()
+
+    def build(self) -> Tuple[bytes, str, float]:
+        """Builds the payload, loading the model lists from the snapshot when possible
+
+        :return: The JSON encoded payload, its ETag, and the time it was built
+        :rtype: Tuple
+        """
+        payload = load_model_catalog(self.snapshot_dir)
+        payload["instruments"] = self.get_instruments()
+        body = encode_json(payload).encode()
+        return body, hashlib.sha1(body).hexdigest(), time.time()
+
+    def get_snapshot(self) -> Tuple[bytes, str, float]:
+        """Gets the payload, building it if this is the first time it is needed. The body, ETag, and build time are
+        returned together so a reset while they are used cannot mix two payloads.
+
+        :return: The JSON encoded payload, its ETag, and the time it was built
+        :rtype: Tuple
+        """
+        with self._lock:
+            if self.snapshot is None:
+                self.snapshot = self.build()
+            return self.snapshot
+
+    def get_body(self) -> bytes:
+        """Gets the JSON encoded payload, building it if this is the first time it is needed
+
+        :return: The JSON encoded payload
+        :rtype: bytes
+        """
+        return self.get_snapshot()[0]
+
+    def reset(self):
+        """Clears the payload so it is rebuilt the next time it is used
+
+        :rtype: None
+        """
+        with self._lock:
+            self.snapshot = None
+
+
+if __name__ == '__main__':
+    import contextlib
+    import io
+    instruments = {"NG7SANS": "NG7 SANS"}
+    with tempfile.TemporaryDirectory() as directory:
+        catalog = Catalog(lambda: dict(instruments), directory)
+        with contextlib.redirect_stdout(io.StringIO()):
+            body, etag, last_modified = catalog.get_snapshot()
+        # Ensure the snapshot is saved, reused, and has an ETag that only depends on the payload
+        assert os.path.exists(get_snapshot_path(directory))
+        assert catalog.get_snapshot() is catalog.get_snapshot() and catalog.get_body() is body
+        assert json.loads(body)["instruments"] == instruments and etag == hashlib.sha1(body).hexdigest()
+        catalog.reset()
+        assert catalog.snapshot is None
+        rebuilt = catalog.get_snapshot()
+        assert rebuilt[0] == body and rebuilt[1] == etag and rebuilt[2] >= last_modified
+        # Ensure reset rebuilds the payload with the current instruments
+        instruments["NGB30SANS"] = "NGB 30m SANS"
+        assert catalog.get_snapshot() is rebuilt
+        catalog.reset()
+        body, etag, last_modified = catalog.get_snapshot()
+        assert json.loads(body)["instruments"] == instruments and etag != rebuilt[1]
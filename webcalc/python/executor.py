@@ -0,0 +1,305 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, List, Optional
+
+from .link_to_sasmodels import PREWARM_MODELS, prewarm_models
+from .registry import InstrumentRegistry
+
+# The number of worker processes. 0 runs every job in the calling thread, as before the pool existed.
+WORKERS = int(os.environ.get("SASWEBCALC_WORKERS", 0))
+# The number of jobs that may wait for a free worker before new requests are turned away
+MAX_QUEUE = int(os.environ.get("SASWEBCALC_MAX_QUEUE", 2 * max(WORKERS, 1)))
+# The number of seconds a request waits for a job before giving up
+JOB_TIMEOUT = float(os.environ.get("SASWEBCALC_JOB_TIMEOUT", 60))
+# How worker processes are started. spawn avoids forking a process that is already running threads.
+START_METHOD = os.environ.get("SASWEBCALC_START_METHOD", "spawn")
+# The number of seconds between checks of whether a waiting job was cancelled, e.g. as its client disconnected
+CANCEL_INTERVAL = 0.1
+
+# The instrument registry used inside worker processes, loaded once per process
+_worker_registry = None
+
+
+class PoolBusyError(Exception):
+    """Raised when a job is submitted while the pool already has as many jobs as it is allowed to queue"""
+
+
+class JobTimeoutError(Exception):
+    """Raised when a job does not finish within its timeout"""
+
+
+class JobCancelledError(Exception):
+    """Raised when a job is cancelled while it waits, e.g. as the client of the request disconnected"""
+
+
+def _initialize_worker():
+    """Loads the instruments, and the models in SASWEBCALC_PREWARM_MODELS, when a worker process starts, so the first
+    job does not pay for them"""
+    get_worker_registry()
+    prewarm_models(PREWARM_MODELS)
+
+
+def get_worker_registry() -> InstrumentRegistry:
+    """Gets the instrument registry of this process, loading it the first time
+
+    :return: The instrument registry
+    :rtype: InstrumentRegistry
+    """
+    global _worker_registry
+    if _worker_registry is None:
+        registry = InstrumentRegistry()
+        registry.load()
+        _worker_registry = registry
+    return _worker_registry
+
+
+def run_sas_calc(instrument: str, params: dict, registry: Optional[InstrumentRegistry] = None,
+                 bank_map: Optional[Callable] = None) -> dict:
+    """Creates an instrument and runs its sas_calc
+
+    :param str instrument: The class name of the instrument
+    :param dict params: A dictionary of parameters inputted by the user in the JavaScript
+    :param InstrumentRegistry registry: The registry to find the instrument in, the process registry if None
+    :param bank_map: A function like the built-in map the slicers of the detector banks are created by, e.g. the
+        map of an ExecutionPool, or None to create them in this process
+    :return: The python return dictionary, or an empty dictionary if the instrument does not exist
+    :rtype: dict
+    """
+    registry = registry if registry is not None else get_worker_registry()
+    if instrument in registry:
+        loaded_instrument = registry[instrument]
+    else:
+        print("Instrument Not on List")
+        return {}
+    # Temporary fix- TODO make the name of everything the same
+    instrument_name = instrument[0:instrument.find("S")].lower()
+    i_class = loaded_instrument(instrument_name, params)
+    i_class.bank_map = bank_map
+    return i_class.sas_calc()
+
+
+class ExecutionPool:
+    """Runs CPU-bound jobs in a pool of worker processes so web workers are not blocked by them
+
+    Jobs are functions defined at the top level of a module, so they can be sent to the workers. With no workers,
+    jobs are run in the calling thread and none of the limits apply.
+
+    :param int self.workers: The number of worker processes
+    :param int self.max_queue: The number of jobs that may wait for a worker
+    :param float self.timeout: The default number of seconds to wait for a job
+    :param int self.pending: The number of submitted jobs that have not finished
+    """
+
+    def __init__(self, workers: int = WORKERS, max_queue: int = MAX_QUEUE, timeout: float = JOB_TIMEOUT,
+                 start_method: str = START_METHOD):
+        """Creates the pool. The worker processes are started by the first job.
+
+        :param int workers: The number of worker processes, or 0 to run jobs in the calling thread
+        :param int max_queue: The number of jobs that may wait for a worker
+        :param float timeout: The default number of seconds to wait for a job
+        :param str start_method: The multiprocessing start method of the workers
+        """
+        self.workers = max(int(workers), 0)
+        self.max_queue = max(int(max_queue), 0)
+        self.timeout = timeout
+        self.start_method = start_method
+        self.pending = 0
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        """Gets the process pool, starting it if necessary. Must be called with the lock held."""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context(self.start_method),
+                                                 initializer=_initialize_worker)
+        return self._executor
+
+    def _release_slot(self, future):
+        with self._lock:
+            self.pending -= 1
+            self._slot_freed.notify()
+
+    def submit(self, function: Callable, *args, block: bool = False, cancelled: Optional[threading.Event] = None):
+        """Submits a job to the worker processes
+
+        :param function: A top level function to run in a worker
+        :param args: The arguments of the function
+        :param bool block: Wait for a free slot instead of raising PoolBusyError when the queue is full
+        :param threading.Event cancelled: Stops waiting for a free slot, raising JobCancelledError, when set
+        :return: The future of the job
+        :rtype: concurrent.futures.Future
+        """
+        with self._lock:
+            while self.pending >= self.workers + self.max_queue:
+                if not block:
+                    raise PoolBusyError(f"{self.pending} calculations are already running or queued")
+                if cancelled is not None and cancelled.is_set():
+                    raise JobCancelledError("The calculation was cancelled before it started")
+                self._slot_freed.wait(CANCEL_INTERVAL if cancelled is not None else None)
+            future = self._get_executor().submit(function, *args)
+            self.pending += 1
+        future.add_done_callback(self._release_slot)
+        return future
+
+    def run(self, function: Callable, *args, timeout: Optional[float] = None, block: bool = False,
+            cancelled: Optional[threading.Event] = None) -> Any:
+        """Runs a job and waits for the result
+
+        A job that is still queued when the timeout expires, or when cancelled is set, is cancelled. A job that has
+        already started keeps its worker until it finishes, and keeps counting towards the queue limit until then.
+
+        :param function: A top level function to run in a worker
+        :param args: The arguments of the function
+        :param float timeout: The number of seconds to wait, the pool timeout if None
+        :param bool block: Wait for a free slot instead of raising PoolBusyError when the queue is full
+        :param threading.Event cancelled: Stops waiting for the job, raising JobCancelledError, when set, e.g. by
+            the ASGI application when the client disconnects
+        :return: The return value of the function
+        """
+        return self._run_jobs(function, [args], timeout, block, cancelled)[0]
+
+    def map(self, function: Callable, *iterables, timeout: Optional[float] = None, block: bool = False,
+            cancelled: Optional[threading.Event] = None) -> List[Any]:
+        """Runs a job for each set of arguments, like the built-in map, so they are calculated in parallel by the
+        workers, and waits for every result
+
+        The jobs are cancelled and limited like the job of run, with one timeout for them all. If a job fails, the
+        jobs that have not started are cancelled.
+
+        :param function: A top level function to run in a worker
+        :param iterables: The arguments of each job, one iterable per argument of the function
+        :param float timeout: The number of seconds to wait for every job, the pool timeout if None
+        :param bool block: Wait for free slots instead of raising PoolBusyError when the queue is full
+        :param threading.Event cancelled: Stops waiting for the jobs, raising JobCancelledError, when set
+        :return: The return value of each job, in the order of the arguments
+        :rtype: List
+        """
+        return self._run_jobs(function, list(zip(*iterables)), timeout, block, cancelled)
+
+    def _run_jobs(self, function: Callable, jobs: List[tuple], timeout: Optional[float], block: bool,
+                  cancelled: Optional[threading.Event]) -> List[Any]:
+        """Submits every job and waits for their results, cancelling the jobs that are still queued if waiting fails"""
+        if not self.enabled:
+            return [function(*args) for args in jobs]
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        futures = []
+        try:
+            for args in jobs:
+                futures.append(self.submit(function, *args, block=block, cancelled=cancelled))
+            return [self._get_result(future, deadline, cancelled) for future in futures]
+        except FutureTimeoutError:
+            self._cancel(futures)
+            raise JobTimeoutError(f"The calculation did not finish within {timeout} seconds")
+        except BrokenProcessPool:
+            # A worker died, e.g. it ran out of memory. Start new workers for the following jobs.
+            self.restart()
+            raise
+        except BaseException:
+            # Includes GeneratorExit and KeyboardInterrupt when a streaming client disconnects
+            self._cancel(futures)
+            raise
+
+    @staticmethod
+    def _get_result(future, deadline: float, cancelled: Optional[threading.Event]) -> Any:
+        """Waits for the result of a job until the deadline, or until cancelled is set"""
+        if cancelled is None:
+            return future.result(timeout=max(deadline - time.monotonic(), 0))
+        while True:
+            try:
+                return future.result(timeout=max(min(CANCEL_INTERVAL, deadline - time.monotonic()), 0))
+            except FutureTimeoutError:
+                if time.monotonic() >= deadline:
+                    raise
+                if cancelled.is_set():
+                    raise JobCancelledError("The calculation was cancelled")
+
+    @staticmethod
+    def _cancel(futures: List):
+        for future in futures:
+            future.cancel()
+
+    def restart(self):
+        """Replaces the worker processes, e.g. after the instruments were reloaded. Running jobs still finish.
+
+        :rtype: None
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        """Stops the worker processes after the running jobs finish
+
+        :rtype: None
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+if __name__ == '__main__':
+    from .link_to_sasmodels import calculate_model
+    import numpy as np
+    q = np.logspace(-3, -1, 50)
+    inline = ExecutionPool(workers=0)
+    pool = ExecutionPool(workers=1, max_queue=0, timeout=120)
+    # Ensure jobs give the same result in a worker process and inline
+    assert np.array_equal(pool.run(calculate_model, 'sphere', [q], {}), inline.run(calculate_model, 'sphere', [q], {}))
+    assert pool.run(run_sas_calc, 'NotAnInstrument', {}) == {}
+    # Ensure a full pool turns new jobs away
+    import time
+    future = pool.submit(time.sleep, 1)
+    try:
+        pool.submit(calculate_model, 'sphere', [q], {})
+        raise AssertionError("The pool accepted more jobs than it can queue")
+    except PoolBusyError:
+        pass
+    future.result()
+    # Ensure a queued job is cancelled when its client disconnects, and the pool does not wait for it. The process
+    #  pool hands one more job than it has workers to them, which can no longer be cancelled.
+    queued = ExecutionPool(workers=1, max_queue=2, timeout=120)
+    disconnected = threading.Event()
+    running = [queued.submit(time.sleep, 1), queued.submit(time.sleep, 0.1)]
+    threading.Timer(0.2, disconnected.set).start()
+    start = time.monotonic()
+    try:
+        queued.run(calculate_model, 'sphere', [q], {}, cancelled=disconnected)
+        raise AssertionError("The job was not cancelled")
+    except JobCancelledError:
+        pass
+    assert time.monotonic() - start < 0.8 and queued.pending == 2
+    # Ensure waiting for a free slot is also cancelled
+    running.append(queued.submit(time.sleep, 0.1))
+    assert queued.pending == queued.workers + queued.max_queue
+    try:
+        queued.run(calculate_model, 'sphere', [q], {}, block=True, cancelled=disconnected)
+        raise AssertionError("The job was not cancelled")
+    except JobCancelledError:
+        pass
+    [future.result() for future in running]
+    assert queued.run(calculate_model, 'sphere', [q], {}, cancelled=threading.Event()).shape == q.shape
+    # Ensure several jobs are run in order, and jobs that do not fit in the queue wait when blocking
+    assert queued.map(pow, [2, 3, 4, 5], [2, 2, 2, 2], block=True) == inline.map(pow, [2, 3, 4, 5], [2, 2, 2, 2])
+    assert queued.map(pow, [2, 3, 4, 5], [2, 2, 2, 2], block=True) == [4, 9, 16, 25]
+    queued.shutdown()
+    # Ensure a job that takes too long raises, without waiting for it
+    try:
+        pool.run(time.sleep, 2, timeout=0.1)
+        raise AssertionError("The job did not time out")
+    except JobTimeoutError:
+        pass
+    pool.shutdown()
+    assert pool.pending == 0
@@ -1,22 +1,116 @@
 
+import hashlib
 import json
+import struct
 from json import JSONDecodeError
+from typing import Optional
+
+import numpy as np
+
+# The mimetype used for binary responses
+BINARY_MIMETYPE = "application/x-saswebcalc-binary"
+# The first bytes of every binary response
+BINARY_MAGIC = b"SWCB"
+BINARY_FORMAT_VERSION = 1
+# The magic bytes, the format version, and the length of the JSON header, all little-endian
+_BINARY_PREFIX = struct.Struct("<4sHI")
+# Array buffers start on multiples of this many bytes so clients can view them without copying
+_BINARY_ALIGNMENT = 8
+
+
+def _encode_numpy(value):
+    """Convert numpy arrays and scalars into values the json module can encode"""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def get_array_digest(*arrays) -> str:
+    """Gets a digest of the shape, type, and contents of numpy arrays, for use as a cache key
+
+    :param arrays: The arrays, or values that can be converted to arrays
+    :return: A hexadecimal SHA-1 digest
+    :rtype: str
+    """
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.shape, array.dtype.str)).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
 
 
 def encode_json(value=None):
     """Convert value to a JSON string so it can be passed the front-end
 
-    :param dict, list, tuple, string, int, float, bool, none value: - Any value that can be converted to a JSON string. This includes dict, list, tuple, string, int, float, bool, none, amongst others.
+    :param dict, list, tuple, string, int, float, bool, none value: - Any value that can be converted to a JSON string. This includes dict, list, tuple, string, int, float, bool, none, numpy arrays, amongst others.
 
     :return: A JSON-encoded string, if successful, otherwise an error related to the object type passed to the method.
     :rtype: str
     """
     try:
-        return json.dumps(value)
+        return json.dumps(value, default=_encode_numpy)
     except TypeError:
         return f"Unable to convert {type(value).__name__} to JSON string."
 
 
+def encode_binary(value: dict, dtype: Optional[str] = "<f8") -> bytes:
+    """Convert a dictionary to the binary format, where numpy arrays are stored as raw buffers instead of text
+
+    The format is the magic bytes b'SWCB', a uint16 format version, a uint32 header length, the JSON header, and the
+    array buffers. The header is {"values": {...}, "arrays": {name: {"dtype", "shape", "offset"}}} where values holds
+    everything that is not a numpy array and each offset is from the start of the first buffer. The header is padded
+    with spaces so all buffers are aligned to 8 bytes.
+
+    :param dict value: A dictionary whose top level numpy arrays are sent as buffers
+    :param str dtype: The little-endian float type of the buffers, '<f8' (float64) or '<f4' (float32), or None to
+        keep float32 arrays as float32 and send every other array as float64
+    :return: The binary encoded dictionary
+    :rtype: bytes
+    """
+    dtype = np.dtype(dtype).newbyteorder('<') if dtype is not None else None
+    values = {}
+    arrays = {}
+    buffers = []
+    offset = 0
+    for name, item in value.items():
+        if not isinstance(item, np.ndarray):
+            values[name] = item
+            continue
+        item_dtype = dtype or np.dtype('<f4' if item.dtype == np.float32 else '<f8')
+        buffer = np.ascontiguousarray(item, dtype=item_dtype).tobytes()
+        arrays[name] = {"dtype": item_dtype.str, "shape": list(item.shape), "offset": offset}
+        padding = -len(buffer) % _BINARY_ALIGNMENT
+        buffers.append(buffer + b"\0" * padding)
+        offset += len(buffer) + padding
+    header = encode_json({"values": values, "arrays": arrays}).encode()
+    header += b" " * (-(_BINARY_PREFIX.size + len(header)) % _BINARY_ALIGNMENT)
+    return _BINARY_PREFIX.pack(BINARY_MAGIC, BINARY_FORMAT_VERSION, len(header)) + header + b"".join(buffers)
+
+
+def decode_binary(value: bytes) -> dict:
+    """Convert a value created by encode_binary back into a dictionary with numpy arrays
+
+    :param bytes value: The binary encoded dictionary
+    :return: The decoded dictionary
+    :rtype: dict
+    """
+    magic, version, header_length = _BINARY_PREFIX.unpack_from(value)
+    if magic != BINARY_MAGIC or version != BINARY_FORMAT_VERSION:
+        raise ValueError(f"Unable to decode binary data with magic {magic} and version {version}.")
+    start = _BINARY_PREFIX.size + header_length
+    header = json.loads(value[_BINARY_PREFIX.size:start])
+    decoded = header["values"]
+    for name, array in header["arrays"].items():
+        dtype = np.dtype(array["dtype"])
+        count = int(np.prod(array["shape"]))
+        decoded[name] = np.frombuffer(value, dtype=dtype, count=count,
+                                      offset=start + array["offset"]).reshape(array["shape"])
+    return decoded
+
+
 def decode_json(value=''):
     """Convert value from a JSON encoded string to a python object
 
@@ -30,3 +124,32 @@ def decode_json(value=''):
         return decoded, type(decoded).__name__
     except JSONDecodeError:
         return None, f"Unable to convert {value} to python object."
+
+
+if __name__ == '__main__':
+    # Ensure every array is decoded with its values and shape, from an aligned offset, and other values are kept
+    results = {"qValues": np.linspace(0.001, 0.5, 7), "fSubs": np.ones((3, 5)), "iqCount": np.arange(3),
+               "float32": np.linspace(0.0, 1.0, 5, dtype=np.float32), "instrument": "NG7SANS", "nPts": 7,
+               "nested": {"beamStop": [1.0, 2.0]}, "empty": None}
+    for dtype in ["<f8", "<f4", None]:
+        encoded = encode_binary(results, dtype)
+        assert encoded.startswith(BINARY_MAGIC)
+        header_length = _BINARY_PREFIX.unpack_from(encoded)[2]
+        assert (_BINARY_PREFIX.size + header_length) % _BINARY_ALIGNMENT == 0
+        assert all(array["offset"] % _BINARY_ALIGNMENT == 0 for array in
+                   json.loads(encoded[_BINARY_PREFIX.size:_BINARY_PREFIX.size + header_length])["arrays"].values())
+        decoded = decode_binary(encoded)
+        assert decoded.keys() == results.keys()
+        for name, item in results.items():
+            if not isinstance(item, np.ndarray):
+                assert decoded[name] == item
+                continue
+            expected = np.dtype(dtype or ('<f4' if item.dtype == np.float32 else '<f8'))
+            assert decoded[name].dtype == expected and decoded[name].shape == item.shape
+            assert np.array_equal(decoded[name], item.astype(expected))
+    # Ensure data that is not in the binary format is refused
+    try:
+        decode_binary(encode_json(results).encode())
+        raise AssertionError("JSON was decoded as binary")
+    except ValueError:
+        pass
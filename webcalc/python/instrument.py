@@ -10,9 +10,13 @@ from .slicers import Sector
 from .slicers import Rectangular
 from .slicers import Elliptical
 from .instrumentJSParams import generate_js_array
+from .timing import timed
 
 Number = Union[float, int]
 
+# The 1D averages of a detector bank, by their name in the python return dictionary
+BANK_AVERAGES = ["nCells", "qsq", "sigmaAve", "qAverage", "sigmaQ", "fSubs", "qValues"]
+
 
 def set_params(instance, params, float_params=None):
     """ Set class attributes based on a dictionary of values. The dict should map <param_name> -> <value>.
@@ -52,6 +56,51 @@ def set_params(instance, params, float_params=None):
             print(f"The parameter {key} is not a known {instance} attribute. Unable to set it to {value}.")
 
 
+def create_bank_slicer(averaging_type: str, slicer_params: Dict):
+    """ Creates the slicer for an averaging type, which bins the detector as it is created. This is the detector bank
+    job run by the process pool.
+
+    :param str averaging_type: The averaging type
+    :param dict slicer_params: The slicer parameters of a detector bank, from Instrument.get_slicer_params
+    :return: The slicer
+    :rtype: Slicer
+    """
+    if averaging_type == "sector":
+        return Sector(slicer_params)
+    elif averaging_type == "rectangular":
+        return Rectangular(slicer_params)
+    elif averaging_type == "elliptical":
+        return Elliptical(slicer_params)
+    else:
+        return Circular(slicer_params)
+
+
+def get_bank_return(slicer) -> Dict[str, np.ndarray]:
+    """Gets the 1D averages of a detector bank from its slicer
+
+    :param Slicer slicer: The slicer of the bank
+    :return: A dictionary mapping each name in BANK_AVERAGES to its array
+    :rtype: Dict
+    """
+    values = [slicer.n_cells, slicer.d_sq, slicer.sigma_ave, slicer.q_average, slicer.sigma_q, slicer.f_subs,
+              slicer.q_values]
+    return {name: np.asarray(value) for name, value in zip(BANK_AVERAGES, values)}
+
+
+def stitch_banks(banks: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    """Merges the 1D averages of several detector banks into a single I(Q) ordered by Q. Bins no pixel of a bank fell
+    into, e.g. the Q values between the beam and a bank away from the beam, are left out.
+
+    :param list banks: The averages of each bank, from get_bank_return
+    :return: A dictionary mapping each name in BANK_AVERAGES to the stitched array
+    :rtype: Dict
+    """
+    stitched = {name: np.concatenate([bank[name] for bank in banks]) for name in BANK_AVERAGES}
+    used = np.flatnonzero(stitched["nCells"] > 0)
+    order = used[np.argsort(stitched["qValues"][used], kind="stable")]
+    return {name: value[order] for name, value in stitched.items()}
+
+
 class Aperture:
     """A class for storing and manipulating Aperture data.
 
@@ -773,32 +822,46 @@ class Data:
         solid_angle = (math.pi / 4) * ((source_aperture / SSD) * (source_aperture / SSD))
         self.flux = area * d2_phi * lambda_spread * solid_angle * total_trans
 
-    def calculate_min_and_max_q(self, index=0):
-        """ Calculate the maximum and minimum q range and max horizontal and vertical q values
+    def calculate_min_and_max_q(self):
+        """ Calculate the maximum and minimum q range and max horizontal and vertical q values, over every detector bank
 
         :return: Nothing as it calculates and sets the q_max, q_min, q_max_horizon, and q_max_vert
         :rtype: None
         """
-        sdd = self.parent.get_sample_to_detector_distance()
-        offset = self.parent.get_detector_offset()
+        q_ranges = [self.get_min_and_max_q(index) for index in range(len(self.parent.detectors))]
+        self.q_min = min(q_range[0] for q_range in q_ranges)
+        self.q_max = max(q_range[1] for q_range in q_ranges)
+        self.q_max_horizon = max(q_range[2] for q_range in q_ranges)
+        self.q_max_vert = max(q_range[3] for q_range in q_ranges)
+
+    def get_min_and_max_q(self, index=0):
+        """ Calculate the maximum and minimum q range and max horizontal and vertical q values of a detector bank
+
+        :param index: The index in the detector array
+        :return: A tuple of the q_min, q_max, q_max_horizon, and q_max_vert of the bank
+        :rtype: Tuple
+        """
+        sdd = self.parent.get_sample_to_detector_distance(index)
+        offset = self.parent.get_detector_offset(index)
         wave = self.parent.get_wavelength()
         pixel_size_x = self.parent.detectors[index].get_pixel_size_x()
         pixel_size_y = self.parent.detectors[index].get_pixel_size_y()
         det_width = pixel_size_x * self.parent.detectors[index].pixel_no_x
-        bs_projection = math.fabs(self.parent.calculate_beam_stop_projection())
+        bs_projection = math.fabs(self.parent.calculate_beam_stop_projection(index))
         # Calculate Q-maximum and populate the page
         radial = math.sqrt(math.pow(0.5 * det_width, 2) + math.pow((0.5 * det_width) + offset, 2))
         pi_over_lambda = math.pi / wave
         four_pi_wave = 4 * pi_over_lambda
-        self.q_max = four_pi_wave * math.sin(0.5 * math.atan(radial / sdd))
+        q_max = four_pi_wave * math.sin(0.5 * math.atan(radial / sdd))
         # Calculate Q-minimum and populate the page
-        self.q_min = pi_over_lambda * (bs_projection + pixel_size_x + pixel_size_y) / sdd  # Working correctly
+        q_min = pi_over_lambda * (bs_projection + pixel_size_x + pixel_size_y) / sdd  # Working correctly
         # Calculate Q-maximum and populate the page
         theta = math.atan(((det_width / 2.0) + offset) / sdd)
-        self.q_max_horizon = four_pi_wave * math.sin(0.5 * theta)
+        q_max_horizon = four_pi_wave * math.sin(0.5 * theta)
         # Calculate Q-maximum and populate the page
         theta = math.atan(((det_width / 2.0) / sdd))
-        self.q_max_vert = four_pi_wave * math.sin(0.5 * theta)
+        q_max_vert = four_pi_wave * math.sin(0.5 * theta)
+        return q_min, q_max, q_max_horizon, q_max_vert
 
     def calculate_figure_of_merit(self):
         """ Calculates the figure of merit from the wavelength and beam flux value
@@ -920,7 +983,10 @@ class Instrument:
 
     :param String self.averaging_type: The averaging type for slicer
     :param  self.slicer_params: Parameters for slicer
-    :param Slicer self.slicer: A slicer object for the calculation of the predicted data
+    :param Slicer self.slicer: A slicer object for the calculation of the predicted data, of the first detector bank
+    :param list self.slicers: The slicer of every detector bank
+    :param self.bank_map: A function like the built-in map that creates the slicers of the detector banks, e.g. in
+        parallel in the worker processes of an ExecutionPool, or None to create them one at a time
     :param Converter self.d_converter: A distance converter object, typically in CM
     :param Converter self.t_converter: A time converter object, typically in s
     :param Data self.data: A Data object that contains more parameters
@@ -949,6 +1015,8 @@ class Instrument:
         self.averaging_type = None
         self.slicer_params = None
         self.slicer = None
+        self.slicers = []
+        self.bank_map = None
         self.d_converter = Converter('cm')
         self.t_converter = Converter('s')
         self.data = None
@@ -1073,6 +1141,10 @@ class Instrument:
         # Slicer
         params["slicer"] = {}
         params["average_type"] = calculate_params["slicer"]
+        # The other averaging parameters are only used by the JS to draw the averaging region
+        user_mask = (calculate_params.get("slicer_params") or {}).get("user_mask")
+        if user_mask is not None:
+            params["slicer"]["user_mask"] = user_mask
 
         # Wavelength
         params["wavelength"] = {}
@@ -1154,6 +1226,7 @@ class Instrument:
         self.averaging_type = params.get("average_type", "ERROR")
         self.slicer_params = params.get('slicer', {})
 
+    @timed("instrument")
     def sas_calc(self) -> Dict[str, Union[Number, str, List[Union[Number, str]]]]:
         """ The main function that runs all the calculation and returns the results
 
@@ -1184,22 +1257,30 @@ class Instrument:
         python_return["user_inaccessible"]["QRange"]["maximumQ"] = self.data.q_max
         python_return["user_inaccessible"]["QRange"]["minimumQ"] = self.data.q_min
         # TODO Question: Do we even use half of thease
-        python_return["nCells"] = self.slicer.n_cells.tolist()
-        python_return["qsq"] = self.slicer.d_sq.tolist()
-        python_return["sigmaAve"] = self.slicer.sigma_ave.tolist()
-        python_return["qAverage"] = self.slicer.q_average.tolist()
-        python_return["sigmaQ"] = self.slicer.sigma_q.tolist()
-        python_return["fSubs"] = self.slicer.f_subs.tolist()
-        python_return["qxValues"] = self.slicer.qx_values.tolist()
-        python_return["qyValues"] = self.slicer.qy_values.tolist()
-        python_return["q2DValues"] = self.slicer.q_2d_values.tolist()
-        python_return["intensity2D"] = self.slicer.intensity_2D.tolist()
-        python_return["qValues"] = self.slicer.q_values.tolist()
+        banks = [get_bank_return(slicer) for slicer in (self.slicers or [self.slicer])]
+        # Instruments with several detector banks return one I(Q) stitched from every bank, and each bank's averages
+        averages = banks[0] if len(banks) == 1 else stitch_banks(banks)
+        python_return["nCells"] = averages["nCells"]
+        python_return["qsq"] = averages["qsq"]
+        python_return["sigmaAve"] = averages["sigmaAve"]
+        python_return["qAverage"] = averages["qAverage"]
+        python_return["sigmaQ"] = averages["sigmaQ"]
+        python_return["fSubs"] = averages["fSubs"]
+        python_return["qxValues"] = self.slicer.qx_values
+        python_return["qyValues"] = self.slicer.qy_values
+        python_return["q2DValues"] = self.slicer.q_2d_values
+        python_return["intensity2D"] = self.slicer.intensity_2D
+        python_return["qValues"] = averages["qValues"]
         python_return["slicer_params"] = self.slicer.slicer_return()
+        # The 2D masks of the first bank, replaced by their digests before they are sent to the front end
+        python_return["masks"] = self.slicer.get_masks()
+        if len(banks) > 1:
+            python_return["banks"] = banks
         # Return bare dictionary to allow easier access to data upstream
-        #  Note - this forces JSON encoding upstream
+        #  Note - arrays are returned as numpy arrays, so this forces JSON or binary encoding upstream
         return python_return
 
+    @timed("instrument.parameters")
     def calculate_instrument_parameters(self):
         """Uses the many functions to calculate all the necessary parameters necessary for an instrument
 
@@ -1209,7 +1290,8 @@ class Instrument:
         :return: It returns nothing as each function sets the value it calculates
         :rtype: None
         """
-        self.calculate_sample_to_detector_distance()
+        for index in range(len(self.detectors)):
+            self.calculate_sample_to_detector_distance(index)
         # Calculate the estimated beam flux
         self.data.calculate_beam_flux()
         # Calculate the figure of merit
@@ -1217,7 +1299,7 @@ class Instrument:
         # Calculate the number of attenuators
         self.calculate_attenuator_number()
         self.data.calculate_min_and_max_q()
-        self.calculate_slicer()
+        self.calculate_slicers()
 
     def calculate_attenuation_factor(self, index=0):
         """Calculates the attenuation factors from te sample aperture diameter and returns the calculated value
@@ -1287,7 +1369,9 @@ class Instrument:
             detector = self.detectors[index]
         except IndexError:
             detector = self.detectors[0]
-        detector.sdd = self.collimation.detector_distance + self.collimation.space_offset
+        # Banks after the first are at the distance given by the instrument, or with the first bank if none is given
+        if detector is self.detectors[0] or not detector.sdd:
+            detector.sdd = self.collimation.detector_distance + self.collimation.space_offset
         return detector
 
     # Various class updaters
@@ -1303,21 +1387,58 @@ class Instrument:
     # Use these to be sure units are correct
 
     def calculate_slicer(self, index=0):
-        """ Creates a dictionary of slicer parameter
+        """ Creates the slicer of a detector bank
 
         :param index: The index in the detector array
         :return: It returns nothing as the parameters it calculates are referenced in the return
         :rtype: None
         """
-        slicer_params = self.slicer_params
+        self.slicer = self.create_slicer(self.get_slicer_params(index))
+
+    def calculate_slicers(self):
+        """ Creates a slicer for every detector bank, each with its own geometry. The banks are averaged by bank_map if
+        it is set, e.g. in parallel by the worker processes, and one at a time otherwise.
 
-        # QUESTION      [0] Do I need to run a loop here? how does this work with multiple detectors
-        self.detectors[index].calculate_all_beam_centers()
-        slicer_params["x_center"] = self.detectors[index].beam_center_x
-        slicer_params["y_center"] = self.detectors[index].beam_center_y
-        slicer_params["pixel_size"] = self.detectors[index].pixel_size_x
+        :return: It returns nothing as the slicers are stored in slicers, and the first one in slicer
+        :rtype: None
+        """
+        # The parameters are found one bank at a time, as finding them updates the detectors
+        bank_params = [self.get_slicer_params(index) for index in range(len(self.detectors))]
+        # The beam stop returned is the one of the first bank
+        self.data.calculate_beam_stop_diameter()
+        if self.bank_map is not None:
+            self.slicers = list(self.bank_map(create_bank_slicer, [self.averaging_type] * len(bank_params),
+                                              bank_params))
+        else:
+            self.slicers = [self.create_slicer(slicer_params) for slicer_params in bank_params]
+        self.slicer = self.slicers[0]
+
+    def get_slicer_params(self, index=0):
+        """ Creates a dictionary of slicer parameters for a detector bank
+
+        :param index: The index in the detector array
+        :return: A new dictionary of the instrument slicer parameters updated with the values of the bank
+        :rtype: Dict
+        """
+        slicer_params = dict(self.slicer_params)
+        if index > 0:
+            # A user mask is drawn on the 2D data, which is the first bank
+            slicer_params.pop("user_mask", None)
+        detector = self.detectors[index]
+        detector.calculate_all_beam_centers()
+        slicer_params["x_center"] = detector.beam_center_x
+        slicer_params["y_center"] = detector.beam_center_y
+        slicer_params["pixel_size"] = detector.pixel_size_x
+        # Detectors are not always square, so each direction has its own pixel size and number of pixels
+        slicer_params["pixel_size_x"] = detector.pixel_size_x
+        slicer_params["pixel_size_y"] = detector.pixel_size_y or detector.pixel_size_x
+        if detector.pixel_no_x and detector.pixel_no_y:
+            slicer_params["x_pixels"] = int(detector.pixel_no_x)
+            slicer_params["y_pixels"] = int(detector.pixel_no_y)
         slicer_params["lambda_val"] = self.wavelength.get_wavelength()
-        slicer_params["detector_distance"] = self.collimation.detector_distance
+        # Banks further from the sample than the first bank are that much further from the sample aperture
+        slicer_params["detector_distance"] = self.collimation.detector_distance + (
+                self.get_sample_to_detector_distance(index) - self.get_sample_to_detector_distance())
 
         slicer_params["lambda_width"] = self.wavelength.wavelength_spread
         slicer_params["guides"] = self.collimation.guides.number_of_guides
@@ -1326,19 +1447,22 @@ class Instrument:
         # and sampleAperture differently
         slicer_params["source_aperture"] = self.get_source_aperture_size()
         slicer_params["sample_aperture"] = self.get_sample_aperture_size()
+        # The beam stop is chosen for the beam at the distance of the bank
+        self.data.calculate_beam_stop_diameter(index)
         print(self.data.get_calculated_beam_stop_diameter())
         slicer_params["beam_stop_size"] = self.data.get_calculated_beam_stop_diameter()
         slicer_params["SSD"] = self.get_source_to_sample_aperture_distance()
-        slicer_params["SDD"] = self.get_sample_to_detector_distance()
-        averaging_type = self.averaging_type
-        if averaging_type == "sector":
-            self.slicer = Sector(slicer_params)
-        elif averaging_type == "rectangular":
-            self.slicer = Rectangular(slicer_params)
-        elif averaging_type == "elliptical":
-            self.slicer = Elliptical(slicer_params)
-        else:
-            self.slicer = Circular(slicer_params)
+        slicer_params["SDD"] = self.get_sample_to_detector_distance(index)
+        return slicer_params
+
+    def create_slicer(self, slicer_params):
+        """ Creates the slicer for the averaging type, which bins the detector as it is created
+
+        :param dict slicer_params: The slicer parameters of a detector bank, from get_slicer_params
+        :return: The slicer
+        :rtype: Slicer
+        """
+        return create_bank_slicer(self.averaging_type, slicer_params)
 
     # TODO Fix these run functions and should just be getting values
     def get_attenuation_factor(self):
@@ -1382,13 +1506,16 @@ class Instrument:
     def get_beam_stop_diameter(self, index=0):
         """ Gets the beam stop diameter value from the beam stops class at the specified index
 
-        :param index: The index in the beam stops array
+        :param index: The index in the beam stops array, the first beam stop if there is none at the index
         :return: Returns the value of the beam stop diameter
         :rtype: int
         """
         # Beam stop diameter in inches
         # TODO: Convert to centimeters
-        return self.beam_stops[index].beam_stop_diameter
+        try:
+            return self.beam_stops[index].beam_stop_diameter
+        except IndexError:
+            return self.beam_stops[0].beam_stop_diameter
 
     def get_number_of_guides(self):
         """Gets the value for the number of guides from the collimation class
@@ -1544,3 +1671,56 @@ class Instrument:
 #     def load_params(self, params):
 #         print("VSANS Load Params")
 #         super().load_objects(params)
+
+
+if __name__ == '__main__':
+    import contextlib
+    import copy
+    import io
+    from .instruments.NG7SANS import NG7SANS
+    from .registry import InstrumentRegistry
+
+    class TwoBankNG7SANS(NG7SANS):
+        """NG7SANS with a second, smaller bank further from the sample and away from the beam"""
+        def load_params(self, params):
+            params["detectors"].append({"sdd": 400.0, "offset": 60.0, "pixel_size_x": 0.8, "pixel_size_y": 0.8,
+                                        "pixel_no_x": 64, "pixel_no_y": 128})
+            super().load_params(params)
+
+    registry = InstrumentRegistry()
+    with contextlib.redirect_stdout(io.StringIO()):
+        registry.load()
+        # Build the parameters the front end sends, with the first option chosen where there is no default
+        instrument_params = json.loads(registry.get_js_params_json("NG7SANS"))
+        for category in instrument_params.values():
+            for param in category.values():
+                if isinstance(param, dict) and "default" not in param and param.get("options"):
+                    param["default"] = param["options"][0]
+        calculate_params = {"instrument_params": instrument_params, "slicer": "Circular", "slicer_params": {}}
+        single = NG7SANS("", copy.deepcopy(calculate_params)).sas_calc()
+        two_bank_instrument = TwoBankNG7SANS("", copy.deepcopy(calculate_params))
+        two_bank = two_bank_instrument.sas_calc()
+    # Ensure every bank is averaged, the first bank is unchanged, and the stitched I(Q) is ordered by Q
+    assert "banks" not in single and len(two_bank["banks"]) == len(two_bank_instrument.slicers) == 2
+    for name in BANK_AVERAGES:
+        assert np.array_equal(two_bank["banks"][0][name], single[name])
+        assert len(two_bank[name]) == len(two_bank["qValues"])
+    assert np.all(np.diff(two_bank["qValues"]) >= 0)
+    assert len(two_bank["qValues"]) > len(single["qValues"])
+    # Ensure banks averaged in parallel by worker processes give the same results
+    from .executor import ExecutionPool
+    pool = ExecutionPool(workers=2, max_queue=2)
+    with contextlib.redirect_stdout(io.StringIO()):
+        pooled_instrument = TwoBankNG7SANS("", copy.deepcopy(calculate_params))
+        pooled_instrument.bank_map = pool.map
+        pooled = pooled_instrument.sas_calc()
+    pool.shutdown()
+    for name in BANK_AVERAGES:
+        assert np.array_equal(pooled[name], two_bank[name])
+    # Ensure the beam stop returned is the one of the first bank
+    assert pooled["user_inaccessible"]["Detector"] == single["user_inaccessible"]["Detector"]
+    # Ensure each bank's Q range uses its own beam stop
+    projections = [two_bank_instrument.calculate_beam_stop_projection(index) for index in range(2)]
+    assert projections[0] != projections[1]
+    q_min = math.pi / two_bank_instrument.get_wavelength() * (projections[1] + 0.8 + 0.8) / 400.0
+    assert math.isclose(two_bank_instrument.data.get_min_and_max_q(1)[0], q_min)
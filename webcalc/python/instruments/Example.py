@@ -110,11 +110,11 @@ class Example(Instrument):
         python_return = {}
         python_return["user_inaccessible"] = {}
         # TODO Question: Do we even use half of thease
-        python_return["qValues"] = self.slicer.q_values.tolist()
-        python_return["fSubs"] = self.slicer.f_subs.tolist()
-        python_return["qxValues"] = self.slicer.qx_values.tolist()
-        python_return["qyValues"] = self.slicer.qy_values.tolist()
-        python_return["intensity2D"] = self.slicer.intensity_2D.tolist()
+        python_return["qValues"] = self.slicer.q_values
+        python_return["fSubs"] = self.slicer.f_subs
+        python_return["qxValues"] = self.slicer.qx_values
+        python_return["qyValues"] = self.slicer.qy_values
+        python_return["intensity2D"] = self.slicer.intensity_2D
         return python_return
 
     def calculate_instrument_parameters(self):
@@ -166,7 +166,6 @@ class NoInstrument:
         :rtype: 2D Array
         """
         stop_points = round(self.arm_to_point * self.q_min)  # How many points to take out of the center
-        what_points = []  # An array of The points that should be removed
         odd_points = False  # Is the number of points odd or even?
         center = self.n_pts / 2  # The center of the data
 
@@ -186,40 +185,23 @@ class NoInstrument:
         if (odd_points and stop_points % 2 == 0) or (stop_points % 2 == 1 and not odd_points):
             stop_points = stop_points + 1
 
-        # Loops adds the 0's at the correct size points
+        # The rows and columns the beam stop covers, a contiguous range around the center
         if stop_points % 2 == 0:
-            for num in range(int(stop_points / 2) + 1):
-                what_points.append(center + num)
-                what_points.append(center - num - 1)
+            what_points = np.arange(center - stop_points // 2 - 1, center + stop_points // 2 + 1)
         else:
-            what_points.append(center)
-            if stop_points > 1:
-                for num in range(int(stop_points / 2 - 0.5)):
-                    what_points.append(center + num + 1)
-                    what_points.append(center - num - 1)
-        what_points.sort()  # Sort the points in order
-
-        # If the points are uneven set the middle to be correctly
-        if len(what_points) % 2 == 1:
-            # Remove the ones in center
-            center_array = what_points[int(len(what_points) / 2 - .5)]
-            for num in what_points:
-                intensity2d[center_array][num] = 0
-
-        half_len = math.ceil(len(what_points) / 2)
-        # Remove in both center
-        for num in range(half_len):
-            # Creates an array of the points that should be at this cross-section
-            if odd_points:
-                short_what_points = what_points[half_len - num - 1:half_len + num]
-            else:
-                short_what_points = what_points[half_len - num - 1:half_len + num + 1]
-            # Edit the Array for one side
-            for num2 in short_what_points:
-                intensity2d[what_points[0 + num]][num2] = 0
-            # Edit the array for the other side
-            for num2 in short_what_points:
-                intensity2d[what_points[len(what_points) - 1 - num]][num2] = 0
+            what_points = np.arange(center - stop_points // 2, center + stop_points // 2 + 1)
+        length = len(what_points)
+        half_len = math.ceil(length / 2)
+
+        # Each row of the beam stop covers a span of its columns that widens from the outer rows to the middle rows
+        rows = np.arange(length)
+        distance = np.minimum(rows, length - 1 - rows)
+        lower = half_len - distance - 1
+        upper = half_len + distance - (1 if odd_points else 0)
+        covered = (rows[np.newaxis, :] >= lower[:, np.newaxis]) & (rows[np.newaxis, :] <= upper[:, np.newaxis])
+        # Only the covered pixels are set, as index arrays, instead of looping over every pixel
+        row_indices, column_indices = np.nonzero(covered)
+        intensity2d[what_points[row_indices], what_points[column_indices]] = 0
 
         return intensity2d
 
@@ -231,11 +213,11 @@ class NoInstrument:
         """
         python_return = {}
         # TODO return the rest  of the calculated values when required by the js
-        python_return["fSubs"] = self.one_dimensional.get("fSubS", {}).tolist()
-        python_return["qxValues"] = self.two_dimensional.get("Qx", {}).tolist()
-        python_return["qyValues"] = self.two_dimensional.get("Qy", {}).tolist()
+        python_return["fSubs"] = self.one_dimensional.get("fSubS", {})
+        python_return["qxValues"] = self.two_dimensional.get("Qx", {})
+        python_return["qyValues"] = self.two_dimensional.get("Qy", {})
         python_return["intensity2D"] = self.two_dimensional.get("intensity2D", {})
-        python_return["qValues"] = self.one_dimensional.get("Q", {}).tolist()
+        python_return["qValues"] = self.one_dimensional.get("Q", {})
         return python_return
 
     @staticmethod
@@ -1,17 +1,89 @@
 import json
+import os
 import sys
-from typing import Union, Dict, List
+import threading
+from contextlib import contextmanager
+from typing import Union, Dict, Iterable, List, Optional, Tuple
 
 import numpy as np
 
 from sasmodels.core import list_models, load_model, load_model_info
-from sasmodels.direct_model import call_kernel
+from sasmodels.direct_model import call_kernel, get_mesh, make_kernel_args
 
-from .helpers import encode_json
+from .cache import LRUCache
+from .helpers import encode_json, get_array_digest
+from .timing import span, timed
 
 Number = Union[float, int]
 
 
+class CachedKernel:
+    """A sasmodels kernel in the kernel cache, with the lock that must be held while calling it
+
+    sasmodels kernels reuse their result buffers, so only one thread may call a kernel at once. Callers hold the entry
+    from get_kernel until they are done with it, and the kernel is only released once it has been evicted and no
+    caller holds it, as a released kernel, e.g. the PyKernel of a python model, cannot be called again.
+
+    :param self.kernel: The sasmodels kernel
+    :param threading.Lock self.lock: The lock held while calling the kernel
+    """
+
+    def __init__(self, kernel):
+        self.kernel = kernel
+        self.lock = threading.Lock()
+        # The entry is created for, and held by, the caller that missed the cache
+        self._users = 1
+        self._evicted = False
+        self._state_lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        """Holds the entry, unless it was evicted
+
+        :return: False if the entry was evicted and must not be used
+        :rtype: bool
+        """
+        with self._state_lock:
+            if self._evicted:
+                return False
+            self._users += 1
+            return True
+
+    def release(self):
+        """Stops holding the entry, releasing the kernel if it was evicted and this was the last holder
+
+        :rtype: None
+        """
+        with self._state_lock:
+            self._users -= 1
+            release = self._evicted and self._users == 0
+        if release:
+            self.kernel.release()
+
+    def evict(self):
+        """Marks the entry as evicted, releasing the kernel now if no caller holds it
+
+        :rtype: None
+        """
+        with self._state_lock:
+            self._evicted = True
+            release = self._users == 0
+        if release:
+            self.kernel.release()
+
+
+# Loaded sasmodels KernelModel objects keyed by the model string, including model@structure_factor products.
+#  Evicted models are not released as cached kernels may still be using them.
+MODEL_CACHE_SIZE = int(os.environ.get("SASWEBCALC_MODEL_CACHE_SIZE", 64))
+MODEL_CACHE = LRUCache("sasmodels_models", MODEL_CACHE_SIZE)
+# Kernels built by make_kernel keyed by the model string and a digest of the Q vectors, as CachedKernel entries
+KERNEL_CACHE_SIZE = int(os.environ.get("SASWEBCALC_KERNEL_CACHE_SIZE", 16))
+KERNEL_CACHE = LRUCache("sasmodels_kernels", KERNEL_CACHE_SIZE, on_evict=CachedKernel.evict)
+# Comma separated model strings, e.g. sphere,cylinder@hardsphere, loaded by prewarm_models when the web and calculation
+#  processes start
+PREWARM_MODELS = [model.strip() for model in os.environ.get("SASWEBCALC_PREWARM_MODELS", "").split(",")
+                  if model.strip()]
+
+
 def get_model_list(category=None):
     """Gets the model list from sasmodels
 
@@ -48,7 +120,9 @@ def get_multiplicity_models():
     return_array = []  # The return array
     # Loop though all the models
     for model in get_model_list():
-        model_params = get_params(model, encode=False)
+        # Only the model info is needed, which avoids compiling every model
+        parameters = load_model_info(model).parameters
+        model_params = list(parameters.common_parameters) + list(parameters.kernel_parameters)
         simple_model_params = [key.name for key in model_params]  # A list of just the name of model parameters
         # Find the keyword
         for param in simple_model_params:
@@ -59,16 +133,91 @@ def get_multiplicity_models():
     return return_array
 
 
-def get_model(model_string):
+def get_model(model_string, dtype: Optional[str] = None):
     """Loads model params for the specified model
 
+    Loaded models are cached, so only the first call for each model string and precision loads and compiles the
+    model.
+
     :param str model_string:
+    :param str dtype: The precision of the compiled model, 'single' or 'double', the sasmodels default if None
     :return: A PyModel object that contains
     :rtype: PyModel
     """
     if not model_string:
         return None
-    return load_model(model_string)
+    key = model_string if dtype is None else (model_string, dtype)
+    return MODEL_CACHE.get_or_create(key, lambda: load_model(model_string, dtype=dtype))
+
+
+def get_kernel(model_string, q, dtype: Optional[str] = None) -> CachedKernel:
+    """Gets a kernel for the model and Q vectors, reusing the previous kernel if the Q vectors are identical. The entry
+    is held for the caller, who must call its release method when done, see use_kernel.
+
+    :param str model_string: The string name of the model
+    :param q: A list of numpy arrays with Q values that will be used to calculate the model function
+    :param str dtype: The precision of the kernel, 'single' or 'double', the sasmodels default if None
+    :return: The held cache entry of the kernel
+    :rtype: CachedKernel
+    """
+    q = [np.asarray(q_i) for q_i in q]
+    key = (model_string, dtype, get_array_digest(*q))
+    while True:
+        created = []
+
+        def _create():
+            created.append(CachedKernel(get_model(model_string, dtype).make_kernel(q)))
+            return created[0]
+        entry = KERNEL_CACHE.get_or_create(key, _create)
+        # A created entry is already held. A cached entry may have been evicted since it was found, then a new one is
+        #  created on the next lookup.
+        if created and entry is created[0] or entry.acquire():
+            return entry
+
+
+@contextmanager
+def use_kernel(model_string, q, dtype: Optional[str] = None):
+    """Holds the cached kernel for the model and Q vectors and its lock while the block calls it
+
+    :param str model_string: The string name of the model
+    :param q: A list of numpy arrays with Q values that will be used to calculate the model function
+    :param str dtype: The precision of the kernel, 'single' or 'double', the sasmodels default if None
+    :return: The kernel
+    """
+    entry = get_kernel(model_string, q, dtype)
+    try:
+        with entry.lock:
+            yield entry.kernel
+    finally:
+        entry.release()
+
+
+def prewarm_models(model_strings: Iterable[str]):
+    """Loads models into the model cache ahead of time so the first request using them is fast
+
+    :param model_strings: The model strings to load, including any model@structure_factor products
+    :return: A list of the model strings that could not be loaded
+    :rtype: List
+    """
+    failed = []
+    for model_string in model_strings:
+        try:
+            get_model(model_string)
+        except Exception as e:
+            print(f"Unable to prewarm {model_string}: {e}")
+            failed.append(model_string)
+    return failed
+
+
+def evict_model(model_string):
+    """Removes a model and all of its kernels from the caches
+
+    :param str model_string: The string name of the model
+    :rtype: None
+    """
+    MODEL_CACHE.evict(model_string)
+    for key in [key for key in KERNEL_CACHE.keys() if key[0] == model_string]:
+        KERNEL_CACHE.evict(key)
 
 
 def encode_params(params,json_encode = True):
@@ -126,30 +275,87 @@ def get_params(model_string, all=False, encode=True,json_encode=True):
         # Calls parameters from sasmodels
         params = model.info.parameters.call_parameters
     elif model:
-        params = model.info.parameters.common_parameters
+        # Copy the list as the model, and its parameter lists, are shared through the model cache
+        params = list(model.info.parameters.common_parameters)
         params.extend(model.info.parameters.kernel_parameters)
     else:
         params = []
     return encode_params(params,json_encode=json_encode) if encode else params
 
 
-def calculate_model(model_string: str, q: List[np.ndarray], params: Dict[str, float]) -> List[Number]:
+@timed("model")
+def calculate_model(model_string: str, q: List[np.ndarray], params: Dict[str, float]) -> np.ndarray:
     """ Takes the model and runs a sequence of code to calculate it
 
     :param str model_string: The string name of the model
     :param q: A list of numpy arrays with Q values that will be used to calculate the model function
     :param params: The list of params probably passed from a previous method
-    :return: A list of calculated data from the model
-    :rtype: A json-like string representation of a list of intensities.
+    :return: The calculated intensities from the model
+    :rtype: np.ndarray
     """
-    kernel_model = get_model(model_string)
-    kernel = kernel_model.make_kernel(q)
-    i_q = call_kernel(kernel, params)
+    with use_kernel(model_string, q) as kernel:
+        i_q = call_kernel(kernel, params)
     # Use built-in numpy.where for value replacement
     i_q = np.where(i_q != np.inf, i_q, 9999999)
     i_q = np.where(~np.isnan(i_q), i_q, 8888888)
-    # Return a list representation of the numpy array
-    return i_q.tolist()
+    return i_q
+
+
+def calculate_model_1d_2d(model_string: str, q_1d: List[np.ndarray], q_2d: Optional[List[np.ndarray]],
+                          params: Dict[str, float],
+                          dtype_2d: Optional[str] = None) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Calculates the model for a 1D and a 2D set of Q values with a single parameter setup
+
+    The dispersity mesh is built once, for the 2D kernel, and the 1D mesh is derived from it by dropping the
+    dispersity of the orientation parameters, which sasmodels ignores in 1D. The 1D model is always calculated in
+    the default precision, and the 2D model in dtype_2d, e.g. single precision for a faster kernel and float32
+    intensities.
+
+    :param str model_string: The string name of the model
+    :param q_1d: A list with one numpy array of Q values
+    :param q_2d: A list with the qx and qy numpy arrays, or None to skip the 2D calculation
+    :param params: A dictionary mapping the sasmodels parameter name to the value
+    :param str dtype_2d: The precision of the 2D model, 'single' or 'double', the sasmodels default if None
+    :return: A tuple of the 1D intensities and the 2D intensities, which are None if q_2d is None
+    :rtype: Tuple
+    """
+    model = get_model(model_string)
+    parameters = model.info.parameters
+    with span("model.mesh"):
+        mesh_2d = get_mesh(model.info, params, dim='2d')
+        # Orientation dispersity is inactive in 1D; reuse every other weight vector as-is
+        mesh_1d = [(value, [value if p.relative_pd else 0.0], [1.0])
+                   if p.polydisperse and p.name not in parameters.pd_1d else (value, dispersity, weight)
+                   for p, (value, dispersity, weight) in zip(parameters.call_parameters, mesh_2d)]
+    with span("model.1d"):
+        i_q_1d = _call_kernel_mesh(model_string, q_1d, mesh_1d)
+    i_q_2d = None
+    if q_2d is not None:
+        with span("model.2d"):
+            i_q_2d = _call_kernel_mesh(model_string, q_2d, mesh_2d, dtype_2d)
+    return i_q_1d, i_q_2d
+
+
+def _call_kernel_mesh(model_string: str, q: List[np.ndarray], mesh, dtype: Optional[str] = None) -> np.ndarray:
+    """Calls the cached kernel for the Q values with a prebuilt dispersity mesh, the same way call_kernel does
+
+    :param str model_string: The string name of the model
+    :param q: A list of numpy arrays with Q values
+    :param mesh: The (value, dispersity, weight) tuples from get_mesh
+    :param str dtype: The precision of the kernel, the sasmodels default if None
+    :return: The calculated intensities in the precision of the kernel, with infinite and NaN values replaced like
+        calculate_model
+    :rtype: np.ndarray
+    """
+    with use_kernel(model_string, q, dtype) as kernel:
+        call_details, values, is_magnetic = make_kernel_args(kernel, mesh)
+        i_q = kernel(call_details, values, 0., is_magnetic)
+        kernel_dtype = kernel.dtype
+    # sasmodels returns float64 whatever the kernel precision, so single precision results are kept as float32
+    i_q = np.asarray(i_q, dtype=kernel_dtype)
+    i_q = np.where(i_q != np.inf, i_q, kernel_dtype.type(9999999))
+    i_q = np.where(~np.isnan(i_q), i_q, kernel_dtype.type(8888888))
+    return i_q
 
 
 if __name__ == '__main__':
@@ -160,8 +366,36 @@ if __name__ == '__main__':
     assert type(list_models()) is list
     # Ensure sphere model gives 5 basic params
     assert len(json.loads(get_params(model_string)).keys()) == 5
-    # Ensure sphere model gives 14 total params, including orientation and dispersity params
-    assert len(json.loads(get_all_params(model_string)).keys()) == 14
+    # Ensure sphere model gives 15 total params, including the magnetic params of sasmodels 1.1
+    assert len(json.loads(get_all_params(model_string)).keys()) == 15
     # Ensure get_params(all=True) returns same as get_all_params()
     assert get_params(model_string, True) == get_all_params(model_string)
-    assert type(json.loads(calculate_model(model_string, q, params))) is list
+    assert isinstance(calculate_model(model_string, [q], params), np.ndarray)
+    # Ensure models and kernels are reused for identical model strings and Q vectors
+    kernel = get_kernel(model_string, [q])
+    assert get_model(model_string) is get_model(model_string)
+    assert get_kernel(model_string, [q.copy()]) is kernel
+    other = get_kernel(model_string, [q * 2])
+    assert other is not kernel
+    for entry in [kernel, kernel, other]:
+        entry.release()
+    # Ensure a kernel evicted while it is held is only released once it is no longer held
+    with use_kernel('power_law', [q]) as power_law:
+        KERNEL_CACHE.clear()
+        assert isinstance(call_kernel(power_law, {}), np.ndarray)
+    assert power_law.q_input is None
+    assert calculate_model('power_law', [q], {}).shape == q.shape
+    assert prewarm_models([model_string, 'sphere@hardsphere']) == []
+    assert 'sphere@hardsphere' in MODEL_CACHE
+    # Ensure the combined calculation matches separate 1D and 2D calculations, including orientation dispersity
+    qx, qy = np.meshgrid(np.linspace(-0.1, 0.1, 20), np.linspace(-0.1, 0.1, 20))
+    cylinder_params = {'radius_pd': 0.1, 'radius_pd_n': 10, 'theta_pd': 10.0, 'theta_pd_n': 5, 'theta': 30.0}
+    i_1d, i_2d = calculate_model_1d_2d('cylinder', [q], [qx.flatten(), qy.flatten()], cylinder_params)
+    assert np.array_equal(i_1d, calculate_model('cylinder', [q], cylinder_params))
+    assert np.array_equal(i_2d, calculate_model('cylinder', [qx.flatten(), qy.flatten()], cylinder_params))
+    assert calculate_model_1d_2d('cylinder', [q], None, cylinder_params)[1] is None
+    # Ensure the single precision 2D model is float32 and close to the double precision model
+    i_1d_single, i_2d_single = calculate_model_1d_2d('cylinder', [q], [qx.flatten(), qy.flatten()], cylinder_params,
+                                                     'single')
+    assert np.array_equal(i_1d_single, i_1d) and i_2d_single.dtype == np.float32
+    assert np.allclose(i_2d_single, i_2d, rtol=1e-4)
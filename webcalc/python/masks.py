@@ -0,0 +1,354 @@
+import base64
+import hashlib
+import json
+import os
+import tempfile
+from typing import Any, Dict, Tuple
+
+import numpy as np
+
+from .cache import LRUCache
+from .helpers import encode_json
+
+# The number of edge and beam stop masks kept, by detector shape and beam stop size
+MASK_CACHE_SIZE = int(os.environ.get("SASWEBCALC_MASK_CACHE_SIZE", 64))
+MASK_CACHE = LRUCache("detector_masks", MASK_CACHE_SIZE)
+# The name of the encoding of serialized masks, the bits of np.packbits in row-major pixel order
+MASK_ENCODING = "packbits"
+# The directory serialized masks are stored in until the front end fetches them, shared by every worker on the host
+MASK_STORE_DIRECTORY = os.environ.get("SASWEBCALC_MASK_STORE_DIR", os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "saswebcalc_masks"))
+# The maximum number of serialized masks stored, or 0 to send the masks in every response instead
+MASK_STORE_SIZE = int(os.environ.get("SASWEBCALC_MASK_STORE_SIZE", 1024))
+# The number of seconds a serialized mask is kept
+MASK_STORE_TTL = float(os.environ.get("SASWEBCALC_MASK_STORE_TTL", 24 * 3600))
+
+
+class DetectorMask:
+    """The masked pixels of a detector, stored as one bit per pixel in row-major order
+
+    Masks are combined with | and &, and only expanded to one value per pixel when to_array is called. The binning
+    looks up the bits of the pixels it needs with contains, and the pixels to change with indices. Masks are never
+    changed after they are created, so they are shared through the mask cache.
+
+    :param tuple self.shape: The (y_pixels, x_pixels) shape of the detector, one row per pixel row
+    :param np.ndarray self.packed: The bits of every pixel, 1 if it is masked, from np.packbits
+    """
+
+    def __init__(self, shape: Tuple[int, int], packed: np.ndarray):
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.packed = np.asarray(packed, dtype=np.uint8)
+        if self.packed.size != (self.size + 7) // 8:
+            raise ValueError(f"A mask of shape {self.shape} needs {(self.size + 7) // 8} bytes, not {self.packed.size}")
+        self.packed.setflags(write=False)
+        self._indices = None
+        self._array = None
+
+    @classmethod
+    def from_array(cls, array) -> "DetectorMask":
+        """Creates a mask from an array with one value per pixel, where every non-zero pixel is masked
+
+        :param array: A 2D array of mask values
+        :return: The packed mask
+        :rtype: DetectorMask
+        """
+        array = np.asarray(array)
+        if array.ndim != 2:
+            raise ValueError(f"A mask must have one value per pixel, not shape {array.shape}")
+        return cls(array.shape, np.packbits(array.reshape(-1) != 0))
+
+    @classmethod
+    def from_indices(cls, shape: Tuple[int, int], indices) -> "DetectorMask":
+        """Creates a mask from the flat, row-major indices of the masked pixels
+
+        :param tuple shape: The (y_pixels, x_pixels) shape of the detector
+        :param indices: The indices of the masked pixels
+        :return: The packed mask
+        :rtype: DetectorMask
+        """
+        bits = np.zeros(int(shape[0]) * int(shape[1]), dtype=bool)
+        bits[np.asarray(indices, dtype=np.intp)] = True
+        return cls(shape, np.packbits(bits))
+
+    @classmethod
+    def from_dict(cls, value: Dict[str, Any]) -> "DetectorMask":
+        """Creates a mask from the dictionary given by to_dict
+
+        :param dict value: The serialized mask
+        :return: The packed mask
+        :rtype: DetectorMask
+        """
+        if value.get("encoding", MASK_ENCODING) != MASK_ENCODING:
+            raise ValueError(f"Unable to decode a mask with the encoding {value.get('encoding')}")
+        return cls(value["shape"], np.frombuffer(base64.b64decode(value["data"]), dtype=np.uint8))
+
+    @classmethod
+    def from_value(cls, value, shape: Tuple[int, int]) -> "DetectorMask":
+        """Creates a mask from a request value, either a serialized mask or an array of mask values, ensuring it
+        matches the detector
+
+        :param value: A DetectorMask, a dictionary from to_dict, or a 2D array with one value per pixel
+        :param tuple shape: The (y_pixels, x_pixels) shape of the detector
+        :return: The packed mask
+        :rtype: DetectorMask
+        """
+        if isinstance(value, DetectorMask):
+            mask = value
+        elif isinstance(value, dict):
+            mask = cls.from_dict(value)
+        else:
+            mask = cls.from_array(value)
+        if mask.shape != tuple(shape):
+            raise ValueError(f"A mask of shape {mask.shape} does not match a detector of shape {tuple(shape)}")
+        return mask
+
+    @property
+    def size(self) -> int:
+        """The number of pixels"""
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def digest(self) -> str:
+        """A digest of the shape and bits, the same for equal masks, used as the key the front end fetches it by"""
+        digest = hashlib.sha1(str(self.shape).encode())
+        digest.update(self.packed.tobytes())
+        return digest.hexdigest()
+
+    @property
+    def indices(self) -> np.ndarray:
+        """The flat, row-major indices of the masked pixels, found the first time they are asked for"""
+        if self._indices is None:
+            indices = np.flatnonzero(np.unpackbits(self.packed, count=self.size))
+            indices.setflags(write=False)
+            self._indices = indices
+        return self._indices
+
+    def count(self) -> int:
+        """Gets the number of masked pixels
+
+        :return: The number of pixels whose bit is set
+        :rtype: int
+        """
+        return len(self.indices)
+
+    def contains(self, indices) -> np.ndarray:
+        """Looks up whether pixels are masked directly in the packed bits, without expanding the mask
+
+        :param indices: The flat, row-major indices of the pixels
+        :return: A boolean array that is True for every masked pixel
+        :rtype: np.ndarray
+        """
+        indices = np.asarray(indices, dtype=np.intp)
+        return (self.packed[indices >> 3] >> (7 - (indices & 7)).astype(np.uint8)) & 1 == 1
+
+    def to_array(self) -> np.ndarray:
+        """Gets the mask with one value per pixel, True for masked pixels, created the first time it is asked for
+
+        :return: A read-only boolean array of the detector shape
+        :rtype: np.ndarray
+        """
+        if self._array is None:
+            array = np.unpackbits(self.packed, count=self.size).astype(bool).reshape(self.shape)
+            array.setflags(write=False)
+            self._array = array
+        return self._array
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serializes the mask for the front end, as its shape and base64 encoded bits
+
+        :return: A JSON serializable dictionary
+        :rtype: Dict
+        """
+        return {"shape": list(self.shape), "encoding": MASK_ENCODING,
+                "data": base64.b64encode(self.packed.tobytes()).decode("ascii")}
+
+    def _combine(self, other: "DetectorMask", operation) -> "DetectorMask":
+        if not isinstance(other, DetectorMask):
+            return NotImplemented
+        if other.shape != self.shape:
+            raise ValueError(f"Unable to combine masks of shapes {self.shape} and {other.shape}")
+        return DetectorMask(self.shape, operation(self.packed, other.packed))
+
+    def __or__(self, other: "DetectorMask") -> "DetectorMask":
+        """Masks every pixel masked by either mask"""
+        return self._combine(other, np.bitwise_or)
+
+    def __and__(self, other: "DetectorMask") -> "DetectorMask":
+        """Masks the pixels masked by both masks"""
+        return self._combine(other, np.bitwise_and)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, DetectorMask) and self.shape == other.shape and \
+            np.array_equal(self.packed, other.packed)
+
+    def __hash__(self) -> int:
+        return hash(self.digest)
+
+    def __getstate__(self):
+        # Only the bits are sent to and from worker processes, the expanded arrays are created again when needed
+        return {"shape": self.shape, "packed": self.packed}
+
+    def __setstate__(self, state):
+        self.__init__(state["shape"], state["packed"])
+
+    def __repr__(self) -> str:
+        return f"DetectorMask(shape={self.shape}, masked={self.count()})"
+
+
+def get_edge_mask(x_pixels: int, y_pixels: int, width: int = 2) -> DetectorMask:
+    """Gets the mask of the pixels at the edges of a detector from the process-wide cache, creating it if necessary
+
+    :param int x_pixels: The number of pixels in the x direction
+    :param int y_pixels: The number of pixels in the y direction
+    :param int width: The number of pixels masked at each edge
+    :return: The shared mask
+    :rtype: DetectorMask
+    """
+    key = ("edge", int(y_pixels), int(x_pixels), int(width))
+    return MASK_CACHE.get_or_create(key, lambda: _create_edge_mask(*key[1:]))
+
+
+def _create_edge_mask(y_pixels: int, x_pixels: int, width: int) -> DetectorMask:
+    x_indices = np.arange(x_pixels)[np.newaxis, :]
+    y_indices = np.arange(y_pixels)[:, np.newaxis]
+    masked = (x_indices < width) | (x_indices >= x_pixels - width) | (y_indices < width) | \
+             (y_indices >= y_pixels - width)
+    return DetectorMask.from_array(masked)
+
+
+def get_beam_stop_mask(q_grid, min_q: float) -> DetectorMask:
+    """Gets the mask of the pixels behind the beam stop, every pixel whose Q is not above the smallest Q the beam stop
+    lets through, from the process-wide cache, creating it if necessary
+
+    :param QGrid q_grid: The Q grid of the detector
+    :param float min_q: The Q of the edge of the beam stop projected onto the detector
+    :return: The shared mask
+    :rtype: DetectorMask
+    """
+    key = ("beam_stop", q_grid.shape, q_grid.digest, float(min_q))
+    return MASK_CACHE.get_or_create(key, lambda: DetectorMask.from_array(~(np.abs(q_grid.q_2d_values) > min_q)))
+
+
+def publish_masks(params: Dict[str, Any], store) -> Dict[str, Any]:
+    """Replaces the masks of a sas_calc result by their digests, so the front end fetches each mask once. Call it for
+    every response, so masks the store has removed since they were last sent are stored again. A mask is serialized
+    in the result instead if the store is disabled or it cannot be stored, e.g. because the disk is full.
+
+    :param dict params: The python return dictionary of sas_calc
+    :param SharedResultCache store: The store shared by the workers, see result_cache.SharedResultCache
+    :return: A copy of the dictionary with the masks replaced
+    :rtype: Dict
+    """
+    masks = params.get("masks")
+    if not isinstance(masks, dict):
+        return params
+    published = {}
+    for name, mask in masks.items():
+        if not isinstance(mask, DetectorMask):
+            published[name] = mask
+        elif store.enabled and (store.get(mask.digest) is not None or
+                                store.put(mask.digest, encode_json(mask.to_dict()).encode(), "application/json")):
+            published[name] = mask.digest
+        else:
+            published[name] = mask.to_dict()
+    return dict(params, masks=published)
+
+
+def put_mask_references(store, key: str, params: Dict[str, Any]):
+    """Records the digests of the masks a stored response refers to, see has_mask_references
+
+    :param SharedResultCache store: The mask store
+    :param str key: The key of the stored response
+    :param dict params: The response, after publish_masks
+    :rtype: None
+    """
+    if store.enabled:
+        digests = [value for value in (params.get("masks") or {}).values() if isinstance(value, str)]
+        store.put("references:" + key, encode_json(digests).encode(), "application/json")
+
+
+def has_mask_references(store, key: str) -> bool:
+    """Checks that every mask a stored response refers to can still be fetched, marking them as used. A response whose
+    masks were removed from the store must be calculated again, which stores them again.
+
+    :param SharedResultCache store: The mask store
+    :param str key: The key of the stored response
+    :return: True if the response can be used
+    :rtype: bool
+    """
+    if not store.enabled:
+        return True
+    references = store.get("references:" + key)
+    if references is None:
+        return False
+    return all(store.get(digest) is not None for digest in json.loads(references[0]))
+
+
+if __name__ == '__main__':
+    edge = get_edge_mask(6, 5)
+    assert edge is get_edge_mask(6, 5) and edge.shape == (5, 6)
+    expected = np.ones((5, 6), dtype=bool)
+    expected[2:3, 2:4] = False
+    assert np.array_equal(edge.to_array(), expected) and edge.count() == 28
+    # Ensure bits are looked up without expanding the mask, including in the last, partly used byte
+    assert edge.contains([0, 14, 15, 16, 29]).tolist() == [True, False, False, True, True]
+    # Ensure masks combine and serialize without changing their bits
+    user = DetectorMask.from_indices((5, 6), [14])
+    combined = edge | user
+    assert combined.count() == 29 and (edge & user).count() == 0 and edge.count() == 28
+    assert DetectorMask.from_dict(combined.to_dict()) == combined
+    assert DetectorMask.from_value(combined.to_dict(), (5, 6)).digest == combined.digest != edge.digest
+    assert DetectorMask.from_value(expected.astype(int), (5, 6)) == edge
+    try:
+        DetectorMask.from_value(expected, (6, 5))
+        raise AssertionError("Masks of a different shape must not be accepted")
+    except ValueError:
+        pass
+    # Ensure only the bits are pickled, for worker processes
+    import pickle
+    edge.to_array()
+    assert pickle.loads(pickle.dumps(edge)) == edge and len(pickle.dumps(edge)) < 1000
+    # Ensure published masks can be fetched by their digest, or are sent in the result when there is no store
+    from .result_cache import SharedResultCache
+    store = SharedResultCache("masks_test", tempfile.mkdtemp(), maxsize=4, version=MASK_ENCODING)
+    result = {"qValues": [0.1], "masks": {"detector": combined, "beamStop": None}}
+    params = publish_masks(result, store)
+    assert params["masks"] == {"detector": combined.digest, "beamStop": None} and result["masks"]["detector"] is combined
+    body, mimetype = store.get(combined.digest)
+    assert mimetype == "application/json" and DetectorMask.from_dict(json.loads(body)) == combined
+    # Ensure a mask removed from the store is stored again by the next response referring to it, and stored responses
+    #  referring to it are not used until then
+    put_mask_references(store, "response", params)
+    assert has_mask_references(store, "response") and not has_mask_references(store, "other")
+    store.clear()
+    assert not has_mask_references(store, "response") and store.get(combined.digest) is None
+    publish_masks(result, store)
+    assert store.get(combined.digest) is not None
+    params = publish_masks({"masks": {"detector": combined}}, SharedResultCache("masks_disabled", maxsize=0))
+    assert DetectorMask.from_dict(params["masks"]["detector"]) == combined
+    # Ensure masks that cannot be stored, e.g. as the disk is full, are sent in the result
+    unwritable = tempfile.mkstemp()[1]
+    params = publish_masks({"masks": {"detector": combined}}, SharedResultCache("masks_unwritable", unwritable, maxsize=4))
+    assert DetectorMask.from_dict(params["masks"]["detector"]) == combined
+    # Ensure a user mask sent in the averaging parameters of a request reaches the slicer and changes the averages
+    import contextlib
+    import io
+    from .executor import run_sas_calc
+    from .registry import InstrumentRegistry
+    registry = InstrumentRegistry()
+    with contextlib.redirect_stdout(io.StringIO()):
+        registry.load()
+        # Build the parameters the front end sends, with the first option chosen where there is no default
+        instrument_params = json.loads(registry.get_js_params_json("NG7SANS"))
+        for category in instrument_params.values():
+            for param in category.values():
+                if isinstance(param, dict) and "default" not in param and param.get("options"):
+                    param["default"] = param["options"][0]
+        user_mask = np.zeros((128, 128), dtype=int)
+        user_mask[54:74, 54:74] = 1
+        unmasked = run_sas_calc("NG7SANS", {"instrument_params": instrument_params, "slicer": "Circular",
+                                            "slicer_params": {}}, registry)
+        masked = run_sas_calc("NG7SANS", {"instrument_params": instrument_params, "slicer": "Circular",
+                                          "slicer_params": {"user_mask": user_mask.tolist()}}, registry)
+    assert masked["masks"]["detector"].count() == unmasked["masks"]["detector"].count() + 400
+    assert np.sum(masked["nCells"]) < np.sum(unmasked["nCells"])
@@ -0,0 +1,243 @@
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from .cache import get_cache_stats
+from .timing import HISTOGRAM_BUCKETS, Histogram, get_timing_stats
+
+# The directory each process writes its metrics to, so /metrics can add up every gunicorn worker. Without a directory
+#  only the metrics of the process answering /metrics are reported. Clear the directory when the server starts.
+METRICS_DIRECTORY = os.environ.get("SASWEBCALC_METRICS_DIR", "")
+# The minimum number of seconds between writes of the metrics of a process
+FLUSH_INTERVAL = float(os.environ.get("SASWEBCALC_METRICS_FLUSH_INTERVAL", 1.0))
+# The upper bounds of the payload size histogram buckets, in bytes
+SIZE_BUCKETS = (1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8, float("inf"))
+# The content type of the Prometheus text format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# The type and description of every metric
+METRICS = {
+    "saswebcalc_requests_total": ("counter", "Requests handled, by route, method, and status"),
+    "saswebcalc_request_duration_seconds": ("histogram", "Request latency, by route"),
+    "saswebcalc_request_size_bytes": ("histogram", "Request body size, by route"),
+    "saswebcalc_response_size_bytes": ("histogram", "Response body size, by route, excluding streamed responses"),
+    "saswebcalc_calculation_duration_seconds": ("histogram", "Calculation latency, by instrument and averaging type"),
+    "saswebcalc_model_evaluations_total": ("counter", "Model evaluations, by model"),
+    "saswebcalc_cache_hits_total": ("counter", "Cache lookups that found a stored value, by cache"),
+    "saswebcalc_cache_misses_total": ("counter", "Cache lookups that did not find a stored value, by cache"),
+    "saswebcalc_cache_evictions_total": ("counter", "Cache entries removed to stay within the size bound, by cache"),
+    "saswebcalc_cache_write_errors_total": ("counter", "Entries a shared cache could not store, by cache"),
+    "saswebcalc_cache_size": ("gauge", "Entries stored in a cache, by cache and process"),
+    "saswebcalc_cache_maxsize": ("gauge", "The size bound of a cache, by cache and process"),
+    "saswebcalc_stage_duration_seconds": ("histogram", "Duration of each timed stage, when SASWEBCALC_TIMING is set"),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _get_labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((str(name), str(value)) for name, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    labels = list(labels) + ([extra] if extra else [])
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class MetricsRegistry:
+    """The counters and histograms of this process, written to a shared directory so every process can report them
+
+    Each process writes a JSON snapshot named after its process id. Counters and histograms of all snapshots are
+    added together, including those of processes that have exited, while gauges are only reported for processes
+    that are still running.
+
+    :param str self.directory: The shared directory, or an empty string for a single process
+    :param float self.flush_interval: The minimum number of seconds between writes
+    """
+
+    def __init__(self, directory: str = METRICS_DIRECTORY, flush_interval: float = FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+
+    def inc(self, name: str, labels: Dict[str, str], amount: float = 1):
+        """Increases a counter
+
+        :param str name: The name of the counter, one of METRICS
+        :param dict labels: The labels of the counter
+        :param amount: The amount added
+        :rtype: None
+        """
+        key = (name, _get_labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, labels: Dict[str, str], value: float,
+                buckets: Tuple[float, ...] = HISTOGRAM_BUCKETS):
+        """Adds a value to a histogram
+
+        :param str name: The name of the histogram, one of METRICS
+        :param dict labels: The labels of the histogram
+        :param float value: The value
+        :param buckets: The upper bounds of the buckets, used when the histogram is first created
+        :rtype: None
+        """
+        key = (name, _get_labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def snapshot(self) -> Dict:
+        """Gets the metrics of this process, including the cache statistics and stage timings
+
+        :return: A dictionary of counters, histograms, and gauges, as lists of [name, labels, value]
+        :rtype: Dict
+        """
+        with self._lock:
+            counters = [[name, labels, value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, labels, histogram.to_dict()]
+                          for (name, labels), histogram in self._histograms.items()]
+        gauges = []
+        for cache, stats in get_cache_stats().items():
+            labels = (("cache", cache),)
+            for stat in ("hits", "misses", "evictions"):
+                counters.append([f"saswebcalc_cache_{stat}_total", labels, stats[stat]])
+            if "write_errors" in stats:
+                counters.append(["saswebcalc_cache_write_errors_total", labels, stats["write_errors"]])
+            gauges.append(["saswebcalc_cache_size", labels, stats["size"]])
+            gauges.append(["saswebcalc_cache_maxsize", labels, stats["maxsize"]])
+        for stage, histogram in get_timing_stats().items():
+            histograms.append(["saswebcalc_stage_duration_seconds", (("stage", stage),), histogram])
+        return {"pid": os.getpid(), "counters": counters, "histograms": histograms, "gauges": gauges}
+
+    def flush(self, force: bool = False):
+        """Writes the snapshot of this process to the shared directory, at most once per flush interval
+
+        :param bool force: Write even if the last write was less than a flush interval ago
+        :rtype: None
+        """
+        if not self.directory:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = now
+        os.makedirs(self.directory, exist_ok=True)
+        # Write to a temporary file and rename it, so readers never see a partial snapshot
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path, os.path.join(self.directory, f"metrics_{os.getpid()}.json"))
+
+    def collect(self) -> Dict:
+        """Adds up the snapshots of every process
+
+        :return: A dictionary with counters, histograms, and gauges dictionaries keyed by (name, labels)
+        :rtype: Dict
+        """
+        snapshots = [self.snapshot()]
+        if self.directory:
+            for path in glob.glob(os.path.join(self.directory, "metrics_*.json")):
+                try:
+                    with open(path) as f:
+                        snapshot = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if snapshot["pid"] != os.getpid():
+                    snapshots.append(snapshot)
+        counters, histograms, gauges = {}, {}, {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, histogram in snapshot["histograms"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                total = histograms.setdefault(key, {"count": 0, "sum": 0.0, "buckets": {}})
+                total["count"] += histogram["count"]
+                total["sum"] += histogram["sum"]
+                for bound, count in histogram["buckets"]:
+                    total["buckets"][bound] = total["buckets"].get(bound, 0) + count
+            if snapshot["pid"] == os.getpid() or _is_alive(snapshot["pid"]):
+                for name, labels, value in snapshot["gauges"]:
+                    labels = tuple(tuple(label) for label in labels) + (("pid", str(snapshot["pid"])),)
+                    gauges[(name, labels)] = value
+        return {"counters": counters, "histograms": histograms, "gauges": gauges}
+
+    def render(self) -> str:
+        """Gets the metrics of every process in the Prometheus text format
+
+        :return: The metrics text
+        :rtype: str
+        """
+        collected = self.collect()
+        samples = {}
+        for kind in ("counters", "gauges"):
+            for (name, labels), value in collected[kind].items():
+                samples.setdefault(name, []).append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        for (name, labels), histogram in collected["histograms"].items():
+            lines = samples.setdefault(name, [])
+            for bound, count in sorted(histogram["buckets"].items()):
+                lines.append(f"{name}_bucket{_format_labels(labels, ('le', _format_value(bound)))} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(histogram['sum'])}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+        output = []
+        for name, lines in samples.items():
+            kind, description = METRICS.get(name, ("untyped", name))
+            output.append(f"# HELP {name} {description}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(lines)
+        return "\n".join(output) + "\n"
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+    first = MetricsRegistry(directory)
+    second = MetricsRegistry(directory)
+    first.inc("saswebcalc_model_evaluations_total", {"model": "sphere"})
+    first.observe("saswebcalc_request_size_bytes", {"route": "/calculate/"}, 500, SIZE_BUCKETS)
+    first.flush()
+    second.inc("saswebcalc_model_evaluations_total", {"model": "sphere"}, 2)
+    second.observe("saswebcalc_request_size_bytes", {"route": "/calculate/"}, 5e6, SIZE_BUCKETS)
+    # Ensure the written metrics of other processes are added, here pretending the first registry is another process
+    os.replace(os.path.join(directory, f"metrics_{os.getpid()}.json"), os.path.join(directory, "metrics_1.json"))
+    with open(os.path.join(directory, "metrics_1.json")) as f:
+        snapshot = json.load(f)
+    snapshot["pid"] = 1
+    with open(os.path.join(directory, "metrics_1.json"), "w") as f:
+        json.dump(snapshot, f)
+    text = second.render()
+    assert 'saswebcalc_model_evaluations_total{model="sphere"} 3' in text
+    assert 'saswebcalc_request_size_bytes_bucket{route="/calculate/",le="1000"} 1' in text
+    assert 'saswebcalc_request_size_bytes_bucket{route="/calculate/",le="+Inf"} 2' in text
+    assert 'saswebcalc_request_size_bytes_count{route="/calculate/"} 2' in text
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import math
+import re
+from typing import Any, Dict, Optional, Tuple
+
+from .cache import LRUCache
+from .registry import InstrumentRegistry
+from .units import Converter
+
+# The keys of an instrument parameter that are read by the instruments. Others, e.g. options and limits, only
+#  describe the input to the front end.
+INSTRUMENT_PARAM_KEYS = ["default", "unit", "type"]
+# The keys of a model parameter that are read by the calculation
+MODEL_PARAM_KEYS = ["default"]
+# The units each instrument declares for its parameters, by (class name, parameters JSON)
+DECLARED_UNITS_CACHE = LRUCache("declared_units", maxsize=16)
+
+_integer = re.compile(r"^[+-]?\d+$")
+_number = re.compile(r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$")
+
+
+def normalize_value(value: Any) -> Any:
+    """Converts a value to its canonical type. Numbers, and strings holding numbers, become ints if they are whole, as
+    the front end sends them, and floats otherwise. Other strings have surrounding white space removed.
+
+    :param value: The value from a request
+    :return: The canonical value, or None for a blank string
+    """
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, str):
+        value = value.strip()
+        if value == "":
+            return None
+        if _integer.match(value):
+            return int(value)
+        if not _number.match(value):
+            return value
+        value = float(value)
+    if isinstance(value, float) and math.isfinite(value) and value.is_integer():
+        return int(value)
+    return value
+
+
+def get_declared_units(instrument: str, registry: Optional[InstrumentRegistry]) -> Dict[Tuple[str, str], str]:
+    """Gets the unit each parameter of an instrument is declared in
+
+    :param str instrument: The class name of the instrument
+    :param InstrumentRegistry registry: The registry the instrument is in
+    :return: A dictionary mapping (category, name) to the declared unit
+    :rtype: Dict
+    """
+    js_params = registry.get_js_params_json(instrument) if registry is not None else None
+    if js_params is None:
+        return {}
+
+    def _create():
+        units = {}
+        for category, params in json.loads(js_params).items():
+            if not isinstance(params, dict):
+                continue
+            for name, param in params.items():
+                if isinstance(param, dict) and param.get("unit"):
+                    units[(category, name)] = param["unit"]
+        return units
+    # The JSON string is replaced when the instruments are reloaded, so reloaded units are found again
+    return DECLARED_UNITS_CACHE.get_or_create((instrument, js_params), _create)
+
+
+def _convert_unit(value: Any, unit: str, declared_unit: str) -> Tuple[Any, str]:
+    """Converts a number to the declared unit, leaving it as it is if either unit is not known to units.Converter"""
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or unit == declared_unit:
+        return value, unit
+    try:
+        return normalize_value(Converter(unit).scale(declared_unit, value)), declared_unit
+    except (ValueError, KeyError):
+        return value, unit
+
+
+def normalize_instrument_params(instrument_params: Dict, declared_units: Dict[Tuple[str, str], str] = None) -> Dict:
+    """Converts instrument parameters from the front end into their canonical form. The structure is kept, but each
+    parameter only keeps the keys the instruments read, blank values are removed, and values given in a unit other
+    than the one the instrument declares are converted to the declared unit.
+
+    :param dict instrument_params: The instrument parameters of a request, by category and name
+    :param dict declared_units: The declared unit of each (category, name), from get_declared_units
+    :return: The canonical instrument parameters
+    :rtype: Dict
+    """
+    declared_units = declared_units or {}
+    normalized = {}
+    for category, params in instrument_params.items():
+        if not isinstance(params, dict):
+            normalized[category] = params
+            continue
+        normalized[category] = {}
+        for name, param in params.items():
+            if not isinstance(param, dict) or not any(key in param for key in INSTRUMENT_PARAM_KEYS):
+                # Not a parameter, e.g. the display name of the category
+                normalized[category][name] = param
+                continue
+            param = {key: param[key] for key in INSTRUMENT_PARAM_KEYS if key in param}
+            if "default" in param:
+                param["default"] = normalize_value(param["default"])
+                if param["default"] is None:
+                    del param["default"]
+            declared_unit = declared_units.get((category, name))
+            if "default" in param and param.get("unit") and declared_unit:
+                param["default"], param["unit"] = _convert_unit(param["default"], param["unit"], declared_unit)
+            normalized[category][name] = param
+    return normalized
+
+
+def normalize_model_params(model_params: Dict) -> Dict:
+    """Converts model parameters from the front end into their canonical form, keeping only the value of each.
+    Parameters with a blank value are removed, so the sasmodels default is used.
+
+    :param dict model_params: The model parameters of a request, by name
+    :return: The canonical model parameters
+    :rtype: Dict
+    """
+    normalized = {}
+    for name, param in model_params.items():
+        if not isinstance(param, dict):
+            normalized[name] = normalize_value(param)
+            continue
+        param = {key: normalize_value(param[key]) for key in MODEL_PARAM_KEYS if key in param}
+        if "default" in param and param["default"] is None:
+            continue
+        normalized[name] = param
+    return normalized
+
+
+def normalize_slicer_params(slicer_params: Dict) -> Dict:
+    """Converts averaging parameters into their canonical form, removing blank values
+
+    :param dict slicer_params: The averaging parameters of a request, by name
+    :return: The canonical averaging parameters
+    :rtype: Dict
+    """
+    normalized = {name: normalize_value(value) for name, value in slicer_params.items()}
+    return {name: value for name, value in normalized.items() if value is not None}
+
+
+def normalize_request(json_like: dict, registry: Optional[InstrumentRegistry] = None) -> dict:
+    """Converts a /calculate/ request into its canonical form, so requests that would give the same result are equal.
+    The canonical request is what should be calculated, so equal requests always calculate the same thing.
+
+    :param dict json_like: The decoded request
+    :param InstrumentRegistry registry: The registry the instrument is in, used to find the declared units
+    :return: A new request with the canonical instrument, averaging, and model parameters
+    :rtype: dict
+    """
+    normalized = dict(json_like)
+    instrument_params = json_like.get("instrument_params")
+    if isinstance(instrument_params, dict):
+        declared_units = get_declared_units(json_like.get("instrument", ""), registry)
+        normalized["instrument_params"] = normalize_instrument_params(instrument_params, declared_units)
+    if isinstance(json_like.get("averaging_params"), dict):
+        normalized["averaging_params"] = normalize_slicer_params(json_like["averaging_params"])
+    if isinstance(json_like.get("model_params"), dict):
+        normalized["model_params"] = normalize_model_params(json_like["model_params"])
+    return normalized
+
+
+def get_params_digest(value: Any) -> str:
+    """Gets a stable digest of normalized parameters, the key shared by every cache of calculation results
+
+    :param value: JSON serializable parameters, e.g. from normalize_request
+    :return: The SHA-256 digest of the canonical JSON
+    :rtype: str
+    """
+    canonical = json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+if __name__ == '__main__':
+    assert [normalize_value(value) for value in ["100", " 1.5 ", 100.0, "", "LENS", True, "1e-3", "inf"]] == \
+        [100, 1.5, 100, None, "LENS", True, 0.001, "inf"]
+    declared = {("Detector", "sDDInputBox"): "cm"}
+    first = {"Detector": {"name": "Detector Settings",
+                          "sDDInputBox": {"name": "Detector Distance", "default": "100", "unit": "cm", "type": "number",
+                                          "lower_limit": 90},
+                          "offsetInputBox": {"default": "", "unit": "cm"}}}
+    second = {"Detector": {"offsetInputBox": {"unit": "cm"}, "sDDInputBox": {"default": 1, "unit": "m",
+                                                                             "type": "number"},
+                           "name": "Detector Settings"}}
+    # Ensure the same detector distance given differently gives the same parameters and digest
+    assert normalize_instrument_params(first, declared) == normalize_instrument_params(second, declared)
+    assert normalize_instrument_params(first, declared)["Detector"]["sDDInputBox"] == \
+        {"default": 100, "unit": "cm", "type": "number"}
+    assert get_params_digest(normalize_instrument_params(first, declared)) == \
+        get_params_digest(normalize_instrument_params(second, declared))
+    # Ensure model parameters only keep their values, and blank values fall back to the sasmodels defaults
+    assert normalize_model_params({"radius": {"default": "20", "units": "Ang", "lower_limit": "0.0"},
+                                   "scale": {"default": ""}}) == {"radius": {"default": 20}}
+    # Ensure the declared units of a real instrument are found
+    registry = InstrumentRegistry()
+    registry.load()
+    assert get_declared_units("NG7SANS", registry)[("Detector", "sDDInputBox")] == "cm"
@@ -0,0 +1,115 @@
+import os
+import threading
+from typing import Any, Dict, List
+
+import numpy as np
+
+from .cache import LRUCache
+from .normalize import get_params_digest
+from .slicers import get_q_grid
+
+# The number of instrument and slicer results kept, so requests that only change the model skip the instrument
+INSTRUMENT_CACHE_SIZE = int(os.environ.get("SASWEBCALC_INSTRUMENT_CACHE_SIZE", 32))
+INSTRUMENT_CACHE = LRUCache("instrument_results", maxsize=INSTRUMENT_CACHE_SIZE)
+
+
+def get_instrument_key(instrument: str, instrument_params: Dict, averaging_type: str, averaging_params: Dict) -> str:
+    """Gets the key of the instrument and slicer part of a request, everything its results depend on
+
+    :param str instrument: The class name of the instrument
+    :param dict instrument_params: The normalized instrument parameters
+    :param str averaging_type: The averaging type
+    :param dict averaging_params: The normalized averaging parameters
+    :return: The digest
+    :rtype: str
+    """
+    return get_params_digest([instrument, instrument_params, averaging_type, averaging_params])
+
+
+class InstrumentResult:
+    """The results of an instrument and its slicer, shared by every request with the same instrument inputs
+
+    The arrays are made read-only, so a request cannot change the results another request sees. Requests copy
+    params before replacing values in it.
+
+    :param dict self.params: The python return dictionary of sas_calc
+    """
+
+    def __init__(self, params: Dict[str, Any]):
+        for value in params.values():
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+        self.params = params
+        self._q_grid = None
+        self._arrays = {}
+        self._lock = threading.Lock()
+
+    @property
+    def q_1d(self) -> List[np.ndarray]:
+        """The Q values of the 1D model"""
+        return [np.asarray(self.params.get('qValues', []))]
+
+    def get_array(self, name: str, dtype=np.float64) -> np.ndarray:
+        """Gets a result as an array of the given type, converting it the first time
+
+        :param str name: The key of the result in params
+        :param dtype: The numpy type of the array
+        :return: The read-only array
+        :rtype: np.ndarray
+        """
+        key = (name, np.dtype(dtype).str)
+        with self._lock:
+            if key not in self._arrays:
+                array = np.asarray(self.params.get(name, []), dtype=dtype)
+                array.flags.writeable = False
+                self._arrays[key] = array
+            return self._arrays[key]
+
+    def get_q_2d(self, dtype=np.float64) -> List[np.ndarray]:
+        """Gets the qx and qy value of every pixel of the 2D model from the Q grid shared with the slicer, creating
+        them the first time for each type
+
+        :param dtype: The numpy type of the arrays, e.g. np.float32 for single precision models
+        :return: A list of the flattened qx and qy arrays
+        :rtype: List
+        """
+        with self._lock:
+            if self._q_grid is None:
+                # qx and qy values are 1D arrays of base values, the grid creates the value of every pixel
+                self._q_grid = get_q_grid(self.params.get('qxValues', []), self.params.get('qyValues', []))
+        return self._q_grid.get_flattened(dtype)
+
+
+def get_instrument_result(key: str, calculate) -> InstrumentResult:
+    """Gets the cached results of an instrument and slicer, calculating them if they are not cached
+
+    :param str key: The key from get_instrument_key
+    :param calculate: A function without arguments returning the python return dictionary of sas_calc
+    :return: The instrument results
+    :rtype: InstrumentResult
+    """
+    return INSTRUMENT_CACHE.get_or_create(key, lambda: InstrumentResult(calculate()))
+
+
+if __name__ == '__main__':
+    calls = []
+
+    def calculate():
+        calls.append(1)
+        return {'qValues': np.array([0.1, 0.2]), 'qxValues': np.array([-0.1, 0.1]), 'qyValues': np.array([-0.2, 0.2])}
+
+    key = get_instrument_key('NG7SANS', {'Detector': {'sDDInputBox': {'default': 100}}}, 'Circular', {})
+    assert key == get_instrument_key('NG7SANS', {'Detector': {'sDDInputBox': {'default': 100}}}, 'Circular', {})
+    assert key != get_instrument_key('NG7SANS', {'Detector': {'sDDInputBox': {'default': 400}}}, 'Circular', {})
+    # Ensure the instrument is only calculated once and its results cannot be changed
+    result = get_instrument_result(key, calculate)
+    assert get_instrument_result(key, calculate) is result and len(calls) == 1
+    assert not result.params['qValues'].flags.writeable
+    qx, qy = result.get_q_2d()
+    assert qx.tolist() == [-0.1, 0.1, -0.1, 0.1] and qy.tolist() == [-0.2, -0.2, 0.2, 0.2]
+    assert result.get_q_2d()[0] is qx
+    # Ensure single precision grids are kept separately
+    qx_single, _ = result.get_q_2d(np.float32)
+    assert qx_single.dtype == np.float32 and np.allclose(qx_single, qx) and result.get_q_2d(np.float32)[0] is qx_single
+    assert result.get_array('qValues') is result.params['qValues']
+    assert result.get_array('qValues', np.float32).dtype == np.float32
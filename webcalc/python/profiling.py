@@ -0,0 +1,340 @@
+import cProfile
+import hmac
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import warnings
+from collections import Counter
+from typing import Dict, Iterable, Optional
+
+# A request is only profiled, and profiles are only returned, when its X-Profile header or profile query parameter has
+#  this value
+PROFILING_TOKEN = os.environ.get("SASWEBCALC_PROFILING_TOKEN", "")
+# Whether requests may ask to be profiled. Profiles are stored with the request body, so only enable this where the
+#  people sending requests may have their payloads kept. Profiling is never enabled without a token.
+PROFILING_ENABLED = os.environ.get("SASWEBCALC_PROFILING", "").lower() in ("1", "true", "yes")
+if PROFILING_ENABLED and not PROFILING_TOKEN:
+    warnings.warn("SASWEBCALC_PROFILING is set without SASWEBCALC_PROFILING_TOKEN. Profiling is disabled.")
+    PROFILING_ENABLED = False
+# The directory profiles are written to
+PROFILE_DIRECTORY = os.environ.get("SASWEBCALC_PROFILE_DIR",
+                                   os.path.join(tempfile.gettempdir(), "saswebcalc_profiles"))
+# The number of seconds between stack samples of a profiled request
+REQUEST_SAMPLE_INTERVAL = float(os.environ.get("SASWEBCALC_PROFILE_REQUEST_INTERVAL", 0.001))
+# The number of seconds between samples of continuous profiling, or 0 to disable it
+CONTINUOUS_SAMPLE_INTERVAL = float(os.environ.get("SASWEBCALC_PROFILE_SAMPLE_INTERVAL", 0))
+# The number of seconds between writes of the continuous profile
+CONTINUOUS_WRITE_INTERVAL = float(os.environ.get("SASWEBCALC_PROFILE_WRITE_INTERVAL", 60))
+# The ways a single request can be profiled
+PROFILE_MODES = ["cprofile", "sample"]
+
+# Only one deterministic profiler can run in a process at a time
+_cprofile_lock = threading.Lock()
+# The names of files in the profile directory
+_profile_file_name = re.compile(r"^[A-Za-z0-9_.\-]+\.(pstats|collapsed|request)$")
+
+
+def get_frame_name(frame) -> str:
+    """Gets the name of a frame used in collapsed stacks, the file name and function name
+
+    :param frame: The python frame
+    :return: The name, e.g. slicers.py:calculate
+    :rtype: str
+    """
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+
+def get_collapsed_stack(frame) -> str:
+    """Gets a stack in the collapsed format read by flamegraph tools, outermost frame first
+
+    :param frame: The innermost python frame
+    :return: The frame names joined by semicolons
+    :rtype: str
+    """
+    names = []
+    while frame is not None:
+        names.append(get_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def format_collapsed_stacks(stacks: Counter) -> str:
+    """Formats stack counts as collapsed stack text, one "stack count" line per stack
+
+    :param Counter stacks: The number of samples of each collapsed stack
+    :return: The collapsed stack text
+    :rtype: str
+    """
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class StackSampler:
+    """Samples the python stacks of threads at a fixed interval from a background thread
+
+    :param self.thread_ids: The ids of the threads to sample, or None for every thread but the sampler
+    :param set self.excluded_ids: The ids of threads that are not sampled
+    :param float self.interval: The number of seconds between samples
+    :param Counter self.stacks: The number of samples of each collapsed stack
+    """
+
+    def __init__(self, interval: float, thread_ids: Optional[Iterable[int]] = None):
+        self.interval = interval
+        self.thread_ids = set(thread_ids) if thread_ids is not None else None
+        self.excluded_ids = set()
+        self.stacks = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        """Takes one sample of every sampled thread
+
+        :rtype: None
+        """
+        own_id = threading.get_ident()
+        frames = sys._current_frames()
+        with self._lock:
+            for thread_id, frame in frames.items():
+                if thread_id == own_id or thread_id in self.excluded_ids or \
+                        (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+                self.stacks[get_collapsed_stack(frame)] += 1
+
+    def take_stacks(self) -> Counter:
+        """Gets the stacks sampled so far and starts counting again
+
+        :return: The number of samples of each collapsed stack
+        :rtype: Counter
+        """
+        with self._lock:
+            stacks, self.stacks = self.stacks, Counter()
+        return stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        """Starts sampling in a daemon thread
+
+        :rtype: None
+        """
+        self._thread = threading.Thread(target=self._run, name="webcalc-stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling and waits for the sampling thread
+
+        :rtype: None
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+class RequestProfile:
+    """The profile of a single request, written to the profile directory when it finishes
+
+    :param str self.profile_id: The name the profile files start with
+    :param str self.mode: cprofile or sample
+    """
+
+    def __init__(self, mode: str, directory: str = PROFILE_DIRECTORY):
+        self.mode = mode
+        self.directory = directory
+        self.profile_id = f"{time.strftime('%Y%m%dT%H%M%S')}_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+        self._profiler = None
+        self._sampler = None
+
+    def start(self) -> bool:
+        """Starts profiling the calling thread
+
+        :return: False if another request is already being profiled with cProfile
+        :rtype: bool
+        """
+        if self.mode == "sample":
+            self._sampler = StackSampler(REQUEST_SAMPLE_INTERVAL, [threading.get_ident()])
+            self._sampler.start()
+            return True
+        if not _cprofile_lock.acquire(blocking=False):
+            return False
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+        return True
+
+    def finish(self, request_body: bytes) -> str:
+        """Stops profiling and writes the profile, with the request body so the request can be replayed
+
+        :param bytes request_body: The body of the profiled request
+        :return: The name of the profile file
+        :rtype: str
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        if self._profiler is not None:
+            self._profiler.disable()
+            _cprofile_lock.release()
+            file_name = f"{self.profile_id}.pstats"
+            self._profiler.dump_stats(os.path.join(self.directory, file_name))
+        else:
+            self._sampler.stop()
+            file_name = f"{self.profile_id}.collapsed"
+            with open(os.path.join(self.directory, file_name), "w") as f:
+                f.write(format_collapsed_stacks(self._sampler.take_stacks()))
+        with open(os.path.join(self.directory, f"{self.profile_id}.request"), "wb") as f:
+            f.write(request_body)
+        return file_name
+
+
+def is_profiling_allowed(headers: Dict[str, str], args: Dict[str, str], enabled: Optional[bool] = None,
+                         token: Optional[str] = None) -> bool:
+    """Checks that profiling is enabled and a request has the X-Profile header or profile query parameter set to
+    SASWEBCALC_PROFILING_TOKEN
+
+    :param headers: The request headers
+    :param args: The request query parameters
+    :param bool enabled: Whether profiling is enabled, SASWEBCALC_PROFILING by default
+    :param str token: The token, SASWEBCALC_PROFILING_TOKEN by default
+    :return: True if the request may be profiled or read profiles
+    :rtype: bool
+    """
+    enabled = PROFILING_ENABLED if enabled is None else enabled
+    token = PROFILING_TOKEN if token is None else token
+    if not enabled or not token:
+        return False
+    value = headers.get("X-Profile") or args.get("profile") or ""
+    # Compared in constant time, so the token cannot be guessed from how long a refusal takes
+    return hmac.compare_digest(value.encode("utf-8"), token.encode("utf-8"))
+
+
+def get_requested_mode(headers: Dict[str, str], args: Dict[str, str]) -> Optional[str]:
+    """Gets the profile mode a request asks for, if profiling is enabled and the request has the token
+
+    The mode is chosen with an X-Profile-Mode header or profile_mode query parameter, and is cprofile by default.
+
+    :param headers: The request headers
+    :param args: The request query parameters
+    :return: The profile mode, or None if the request is not profiled
+    """
+    if not is_profiling_allowed(headers, args):
+        return None
+    mode = headers.get("X-Profile-Mode") or args.get("profile_mode") or "cprofile"
+    return mode if mode in PROFILE_MODES else None
+
+
+def get_profile_path(file_name: str, directory: str = PROFILE_DIRECTORY) -> Optional[str]:
+    """Gets the path of a stored profile file, refusing names that are not profile files
+
+    :param str file_name: The name of the file
+    :param str directory: The profile directory
+    :return: The path, or None if the name is not allowed or the file does not exist
+    :rtype: str
+    """
+    if not _profile_file_name.match(file_name):
+        return None
+    path = os.path.join(directory, file_name)
+    return path if os.path.isfile(path) else None
+
+
+class ContinuousProfiler:
+    """Samples every thread at a low rate for the life of the process and periodically adds the stacks to
+    stacks_<pid>.collapsed in the profile directory
+
+    :param StackSampler self.sampler: The sampler
+    :param float self.write_interval: The number of seconds between writes
+    """
+
+    def __init__(self, interval: float = CONTINUOUS_SAMPLE_INTERVAL, write_interval: float = CONTINUOUS_WRITE_INTERVAL,
+                 directory: str = PROFILE_DIRECTORY):
+        self.sampler = StackSampler(interval)
+        self.write_interval = write_interval
+        self.directory = directory
+        self.path = os.path.join(directory, f"stacks_{os.getpid()}.collapsed")
+        self._totals = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def write(self):
+        """Adds the stacks sampled since the last write to the stack file
+
+        :rtype: None
+        """
+        self._totals.update(self.sampler.take_stacks())
+        os.makedirs(self.directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(format_collapsed_stacks(self._totals))
+        os.replace(path, self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.write_interval):
+            self.write()
+
+    def start(self):
+        """Starts sampling and writing in daemon threads
+
+        :rtype: None
+        """
+        self.sampler.start()
+        self._thread = threading.Thread(target=self._run, name="webcalc-profile-writer", daemon=True)
+        self._thread.start()
+        self.sampler.excluded_ids.add(self._thread.ident)
+
+    def stop(self):
+        """Stops sampling and writes the remaining stacks
+
+        :rtype: None
+        """
+        self.sampler.stop()
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write()
+
+
+if __name__ == '__main__':
+    import pstats
+
+    def busy(seconds):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            sum(range(1000))
+
+    directory = tempfile.mkdtemp()
+    # Ensure both request modes write a profile that names the busy function, and the request body
+    file_names = {}
+    for mode, extension in [("cprofile", ".pstats"), ("sample", ".collapsed")]:
+        profile = RequestProfile(mode, directory)
+        assert profile.start()
+        busy(0.05)
+        file_names[mode] = profile.finish(b"{}")
+        assert file_names[mode].endswith(extension) and get_profile_path(file_names[mode], directory)
+        assert get_profile_path(f"{profile.profile_id}.request", directory)
+    stats = pstats.Stats(get_profile_path(file_names["cprofile"], directory))
+    assert any(function == "busy" for _, _, function in stats.stats)
+    with open(get_profile_path(file_names["sample"], directory)) as f:
+        assert "profiling.py:busy" in f.read()
+    # Ensure only one request is profiled with cProfile at a time
+    first = RequestProfile("cprofile", directory)
+    assert first.start() and not RequestProfile("cprofile", directory).start()
+    first.finish(b"")
+    assert get_profile_path("../etc/passwd", directory) is None
+    # Ensure profiling needs the token, and is never allowed without one
+    assert is_profiling_allowed({"X-Profile": "secret"}, {}, True, "secret")
+    assert is_profiling_allowed({}, {"profile": "secret"}, True, "secret")
+    assert not is_profiling_allowed({"X-Profile": "guess"}, {}, True, "secret")
+    assert not is_profiling_allowed({}, {}, True, "secret")
+    assert not is_profiling_allowed({"X-Profile": "secret"}, {}, False, "secret")
+    assert not is_profiling_allowed({"X-Profile": "1"}, {}, True, "")
+    assert not is_profiling_allowed({"X-Profile": "\u00e9"}, {}, True, "secret")
+    # Ensure continuous profiling samples other threads
+    continuous = ContinuousProfiler(0.001, 3600, directory)
+    continuous.start()
+    busy(0.05)
+    continuous.stop()
+    with open(continuous.path) as f:
+        stacks = f.read()
+    assert "profiling.py:busy" in stacks and "profiling.py:_run" not in stacks
@@ -0,0 +1,210 @@
+import importlib
+import inspect
+import os
+import threading
+from typing import Dict, Optional
+
+from .helpers import encode_json
+
+# The directory containing the built-in instrument modules, independent of the working directory
+INSTRUMENTS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "instruments")
+# The package the built-in instrument modules are imported from
+INSTRUMENTS_PACKAGE = __name__.rsplit('.', 1)[0] + ".instruments"
+# The entry point group other packages can use to add instruments
+ENTRY_POINT_GROUP = "saswebcalc.instruments"
+# Instrument classes that are never shown to users
+EXCLUDED_INSTRUMENTS = ["Example"]
+
+# Instrument classes registered with the register_instrument decorator
+_registered_instruments = {}
+
+
+def register_instrument(cls):
+    """A class decorator that adds an instrument class to every InstrumentRegistry, even if it is not in the
+    instruments directory
+
+    :param cls: The instrument class, which must define class_name
+    :return: The unchanged class
+    """
+    if not hasattr(cls, "class_name"):
+        raise ValueError(f"{cls.__name__} must define class_name to be registered as an instrument")
+    _registered_instruments[cls.__name__] = cls
+    return cls
+
+
+def _get_entry_points(group: str):
+    """Gets the installed entry points for a group on all supported python versions"""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return []
+    found = entry_points()
+    if hasattr(found, "select"):
+        return found.select(group=group)
+    return found.get(group, [])
+
+
+class InstrumentRegistry:
+    """The instrument classes available to webcalc, found once instead of on every request
+
+    Instruments are found by importing every module in the instruments directory, by the register_instrument
+    decorator, and by the saswebcalc.instruments entry point group.
+
+    :param str self.directory: The directory of instrument modules
+    :param str self.package: The package the instrument modules are imported from
+    :param dict self.instruments: A dictionary mapping the class name to the instrument class
+    """
+
+    def __init__(self, directory: str = INSTRUMENTS_DIRECTORY, package: str = INSTRUMENTS_PACKAGE):
+        """Creates an empty registry. Call load to find the instruments.
+
+        :param str directory: The directory of instrument modules
+        :param str package: The package the instrument modules are imported from
+        """
+        self.directory = directory
+        self.package = package
+        self.instruments = {}
+        self._modules = []
+        self._js_params = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.instruments
+
+    def __getitem__(self, name: str):
+        return self.instruments[name]
+
+    def get(self, name: str, default=None):
+        """Gets an instrument class by name
+
+        :param str name: The class name of the instrument
+        :param default: The value returned if the instrument does not exist
+        :return: The instrument class or default
+        """
+        return self.instruments.get(name, default)
+
+    def load(self, reload_modules: bool = False):
+        """Finds all instruments
+
+        :param bool reload_modules: Reload already imported instrument modules to pick up code changes
+        :rtype: None
+        """
+        instruments = {}
+        modules = []
+        # Get a list of all Python files in the directory
+        files = sorted(file[:-3] for file in os.listdir(self.directory)
+                       if file.endswith('.py') and not file.startswith('__'))
+        for file in files:
+            module = importlib.import_module(f"{self.package}.{file}")
+            if reload_modules:
+                module = importlib.reload(module)
+            modules.append(module)
+            for name, cls in inspect.getmembers(module, inspect.isclass):
+                if hasattr(cls, "class_name"):
+                    instruments[name] = cls
+        instruments.update(_registered_instruments)
+        for entry_point in _get_entry_points(ENTRY_POINT_GROUP):
+            try:
+                cls = entry_point.load()
+            except Exception as e:
+                print(f"Unable to load the instrument entry point {entry_point.name}: {e}")
+                continue
+            instruments[cls.__name__] = cls
+        for name in EXCLUDED_INSTRUMENTS:
+            instruments.pop(name, None)
+        with self._lock:
+            self.instruments = instruments
+            self._modules = modules
+            self._js_params = {}
+
+    def reload(self):
+        """Reloads every instrument module and finds all instruments again. This is meant for development, where
+        instrument files change while the server is running.
+
+        :rtype: None
+        """
+        self.load(reload_modules=True)
+
+    def get_instrument_names(self) -> Dict[str, str]:
+        """Gets the names of all the instruments
+
+        :return: A dictionary mapping the class name to the name shown to users
+        :rtype: Dict
+        """
+        instrument_list = {}
+        for cls in self.instruments.values():
+            code_name = cls.class_name if hasattr(cls, "class_name") else str(cls)
+            front_name = cls.name_shown if hasattr(cls, "name_shown") else code_name
+            instrument_list[code_name] = front_name
+        return instrument_list
+
+    def get_js_params_json(self, name: str) -> Optional[str]:
+        """Gets the JSON encoded get_js_params output of an instrument, encoding it only the first time
+
+        :param str name: The class name of the instrument
+        :return: The JSON encoded parameters or None if the instrument does not exist
+        :rtype: str
+        """
+        if name not in self._js_params:
+            cls = self.instruments.get(name)
+            if cls is None:
+                return None
+            self._js_params[name] = encode_json(cls.get_js_params())
+        return self._js_params[name]
+
+
+if __name__ == '__main__':
+    import contextlib
+    import io
+    import json
+    import sys
+    import tempfile
+
+    # Ensure decorated classes need a class name, and are added to every registry
+    try:
+        register_instrument(type("Unnamed", (), {}))
+        raise AssertionError("An instrument without class_name was registered")
+    except ValueError:
+        pass
+
+    @register_instrument
+    class Registered:
+        class_name = "Registered"
+        name_shown = "Registered Instrument"
+        js_params = {"instrument": {"name": "Registered"}}
+
+        @classmethod
+        def get_js_params(cls):
+            return cls.js_params
+
+    # Ensure instruments are found from an installed package's entry points, and broken entry points are skipped
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "saswebcalc_example_instruments.py"), "w") as module:
+            module.write("class EntryPoint:\n    class_name = 'EntryPoint'\n\n"
+                         "    @classmethod\n    def get_js_params(cls):\n        return {}\n")
+        dist_info = os.path.join(directory, "saswebcalc_example_instruments-1.0.dist-info")
+        os.mkdir(dist_info)
+        with open(os.path.join(dist_info, "METADATA"), "w") as metadata:
+            metadata.write("Metadata-Version: 2.1\nName: saswebcalc-example-instruments\nVersion: 1.0\n")
+        with open(os.path.join(dist_info, "entry_points.txt"), "w") as entry_points_file:
+            entry_points_file.write(f"[{ENTRY_POINT_GROUP}]\nentry_point = saswebcalc_example_instruments:EntryPoint\n"
+                                    f"broken = saswebcalc_example_instruments:Missing\n")
+        sys.path.insert(0, directory)
+        # The instruments package is found from the package of this module, as __name__ is __main__ here
+        registry = InstrumentRegistry(package=f"{__spec__.parent}.instruments")
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            registry.load()
+        sys.path.remove(directory)
+    assert "EntryPoint" in registry and "broken" in output.getvalue()
+    assert "Registered" in registry and registry.get_instrument_names()["Registered"] == "Registered Instrument"
+    assert "NG7SANS" in registry and "Example" not in registry and registry.get("Missing") is None
+    # Ensure the encoded parameters are cached until the instruments are reloaded
+    js_params = registry.get_js_params_json("Registered")
+    assert json.loads(js_params) == Registered.js_params and registry.get_js_params_json("Missing") is None
+    Registered.js_params = {"instrument": {"name": "Reloaded"}}
+    assert registry.get_js_params_json("Registered") is js_params
+    with contextlib.redirect_stdout(io.StringIO()):
+        registry.reload()
+    assert json.loads(registry.get_js_params_json("Registered")) == Registered.js_params
+    assert registry.instruments.keys() >= {"NG7SANS", "Registered"}
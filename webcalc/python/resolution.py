@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from sasmodels.resolution import Pinhole1D, PINHOLE_N_SIGMA
+
+from .cache import LRUCache
+from .helpers import get_array_digest
+
+# Resolution matrices keyed by a digest of the Q values and resolutions. Both only change with the instrument
+#  configuration, so the matrix is shared by every model calculated for the same configuration.
+RESOLUTION_CACHE_SIZE = int(os.environ.get("SASWEBCALC_RESOLUTION_CACHE_SIZE", 32))
+RESOLUTION_CACHE = LRUCache("pinhole_resolution", RESOLUTION_CACHE_SIZE)
+# The resolution types that can be requested
+RESOLUTION_TYPES = ["None", "Pinhole"]
+
+
+class PinholeResolution:
+    """The sasmodels Pinhole1D resolution, stored as a sparse matrix
+
+    Each Q value only has weights for the calculated Q values within -2.5 to +3 sigma, so most of the dense Pinhole1D
+    matrix is zero. Storing the transposed matrix in compressed sparse row format makes smearing a single sparse
+    matrix-vector product. All arrays are read-only as instances are shared through the resolution cache.
+
+    :param np.ndarray self.q: The Q values the smeared intensities are calculated at
+    :param np.ndarray self.sigma_q: The resolution, as a 1-sigma gaussian width, at each Q value
+    :param np.ndarray self.q_calc: The oversampled Q values the model needs to be calculated at
+    :param csr_matrix self.weight_matrix: The (len(q), len(q_calc)) resolution weights
+    """
+
+    def __init__(self, q: np.ndarray, sigma_q: np.ndarray, nsigma=PINHOLE_N_SIGMA):
+        """Builds the resolution matrix
+
+        :param np.ndarray q: The Q values the smeared intensities are calculated at
+        :param np.ndarray sigma_q: The resolution at each Q value
+        :param nsigma: The width of the resolution function in sigma, or a (low, high) tuple
+        """
+        self.q = np.array(q, dtype=float)
+        self.sigma_q = np.array(sigma_q, dtype=float)
+        pinhole = Pinhole1D(self.q, self.sigma_q, nsigma=nsigma)
+        self.q_calc = np.ascontiguousarray(pinhole.q_calc)
+        self.weight_matrix = csr_matrix(pinhole.weight_matrix.T)
+        for array in (self.q, self.sigma_q, self.q_calc, self.weight_matrix.data):
+            array.flags.writeable = False
+
+    def apply(self, theory: np.ndarray) -> np.ndarray:
+        """Smears a model calculated at q_calc
+
+        :param np.ndarray theory: The model intensities at each value in q_calc
+        :return: The smeared intensities at each value in q
+        :rtype: np.ndarray
+        """
+        return self.weight_matrix.dot(np.asarray(theory))
+
+
+def get_pinhole_resolution(q: np.ndarray, sigma_q: np.ndarray) -> PinholeResolution:
+    """Gets the pinhole resolution for Q values and resolutions, building it only the first time
+
+    :param np.ndarray q: The Q values the smeared intensities are calculated at
+    :param np.ndarray sigma_q: The resolution at each Q value
+    :return: The shared resolution
+    :rtype: PinholeResolution
+    """
+    key = get_array_digest(np.asarray(q, dtype=float), np.asarray(sigma_q, dtype=float))
+    return RESOLUTION_CACHE.get_or_create(key, lambda: PinholeResolution(q, sigma_q))
+
+
+if __name__ == '__main__':
+    from sasmodels.resolution import apply_resolution_matrix
+    q = np.logspace(-3, -1, 100)
+    sigma_q = 0.05 * q
+    resolution = get_pinhole_resolution(q, sigma_q)
+    # Ensure the resolution is shared and matches the dense sasmodels calculation
+    assert get_pinhole_resolution(q.copy(), sigma_q.copy()) is resolution
+    pinhole = Pinhole1D(q, sigma_q)
+    theory = 1.0 / (1.0 + (resolution.q_calc * 50) ** 4)
+    assert np.allclose(resolution.apply(theory), apply_resolution_matrix(pinhole.weight_matrix, theory))
+    assert resolution.weight_matrix.nnz < resolution.weight_matrix.shape[0] * resolution.weight_matrix.shape[1] / 2
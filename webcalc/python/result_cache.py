@@ -0,0 +1,368 @@
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import sasmodels
+
+from .cache import CACHES
+from .normalize import get_params_digest
+
+# The directory responses are stored in, shared by every worker on the host. /dev/shm keeps them in memory.
+RESULT_CACHE_DIRECTORY = os.environ.get("SASWEBCALC_RESULT_CACHE_DIR", os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "saswebcalc_results"))
+# The maximum number of responses stored, or 0 to disable the cache
+RESULT_CACHE_SIZE = int(os.environ.get("SASWEBCALC_RESULT_CACHE_SIZE", 256))
+# The maximum total size of the stored responses, in bytes, at most half the free space of the directory by default
+RESULT_CACHE_BYTES = int(os.environ.get("SASWEBCALC_RESULT_CACHE_BYTES", 0)) or None
+# The largest default size of the stored responses, in bytes
+DEFAULT_RESULT_CACHE_BYTES = 256 * 1024 * 1024
+# The number of seconds a response is kept
+RESULT_CACHE_TTL = float(os.environ.get("SASWEBCALC_RESULT_CACHE_TTL", 3600))
+# The request fields that change the result of a /calculate/ request
+RESULT_KEY_FIELDS = ["instrument", "instrument_params", "averaging_type", "averaging_params", "model",
+                     "structure_factor", "model_params", "resolution"]
+
+_ENTRY_SUFFIX = ".response"
+# The webcalc package, including webcalc.py, which combines the instrument and model results into the response
+_PACKAGE_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_code_version() -> str:
+    """Gets a digest of the calculation code, every python module of the webcalc package and the sasmodels version,
+    so responses stored by a different deployment are never used
+
+    :return: The digest
+    :rtype: str
+    """
+    digest = hashlib.sha1(sasmodels.__version__.encode())
+    for directory, directories, files in os.walk(_PACKAGE_DIRECTORY):
+        directories.sort()
+        for name in sorted(files):
+            if name.endswith(".py"):
+                stat = os.stat(os.path.join(directory, name))
+                digest.update(f"{os.path.relpath(os.path.join(directory, name), _PACKAGE_DIRECTORY)}:"
+                              f"{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()
+
+
+def get_default_max_bytes(directory: str) -> int:
+    """Gets the default size bound of a cache directory, DEFAULT_RESULT_CACHE_BYTES or half the free space of the file
+    system it is on if that is smaller, e.g. the 64 MB /dev/shm of a Docker container
+
+    :param str directory: The cache directory, which does not have to exist yet
+    :return: The maximum total size of the stored responses, in bytes
+    :rtype: int
+    """
+    existing = os.path.abspath(directory)
+    while not os.path.isdir(existing) and os.path.dirname(existing) != existing:
+        existing = os.path.dirname(existing)
+    try:
+        free = shutil.disk_usage(existing).free
+    except OSError:
+        return DEFAULT_RESULT_CACHE_BYTES
+    return min(DEFAULT_RESULT_CACHE_BYTES, free // 2)
+
+
+def get_request_digest(json_like: dict, *variant) -> str:
+    """Gets the key of a /calculate/ request, a digest of the fields that change its result, so the same request gives
+    the same key whatever the order of its fields. Pass requests through normalize.normalize_request first, so
+    requests that differ only in how their values are written also share a key.
+
+    :param dict json_like: The decoded request
+    :param variant: Anything else that changes the response, e.g. the dimensions and response format
+    :return: The digest
+    :rtype: str
+    """
+    fields = {field: json_like.get(field) for field in RESULT_KEY_FIELDS}
+    return get_params_digest([fields, list(variant)])
+
+
+class SharedResultCache:
+    """Stores encoded responses as files in a directory shared by every worker process on a host
+
+    Each response is written to a temporary file and renamed, so readers never see a partial response. The
+    modification time of a file is when it was stored, and is used for the time to live. The access time is set on
+    every hit and is used to evict the least recently used responses when the cache is over its size bounds. The
+    directory is only used if it is owned by this user with mode 0700, otherwise the cache is disabled. Each process
+    counts the responses and bytes it stored since it last scanned the directory, and only scans it again to evict
+    responses when these approximate totals are over the bounds.
+
+    :param str self.directory: The shared directory
+    :param int self.maxsize: The maximum number of responses stored
+    :param int self.max_bytes: The maximum total size of the stored responses
+    :param float self.ttl: The number of seconds a response is kept
+    :param int self.hits: The number of lookups in this process that found a response
+    :param int self.misses: The number of lookups in this process that did not find a response
+    :param int self.evictions: The number of responses this process removed to stay within the bounds
+    :param int self.write_errors: The number of responses this process could not store, e.g. as the disk was full
+    """
+
+    def __init__(self, name: str = "results", directory: str = RESULT_CACHE_DIRECTORY,
+                 maxsize: int = RESULT_CACHE_SIZE, max_bytes: Optional[int] = RESULT_CACHE_BYTES,
+                 ttl: float = RESULT_CACHE_TTL,
+                 version: Optional[str] = None):
+        """Creates the cache and registers it by name, so its statistics are reported with the other caches
+
+        :param str name: The name of the cache
+        :param str directory: The shared directory
+        :param int maxsize: The maximum number of responses stored, or 0 to disable the cache
+        :param int max_bytes: The maximum total size of the stored responses, from get_default_max_bytes if None
+        :param float ttl: The number of seconds a response is kept
+        :param str version: Part of every key, the digest of the calculation code if None
+        """
+        self.name = name
+        self.directory = directory
+        self.maxsize = max(int(maxsize), 0)
+        self.max_bytes = max_bytes if max_bytes is not None else get_default_max_bytes(directory)
+        self.ttl = ttl
+        self.version = get_code_version() if version is None and self.maxsize else version or ""
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.write_errors = 0
+        self._directory_checked = False
+        # The approximate number and total size of the stored responses, or None until the directory is scanned
+        self._approximate_count = None
+        self._approximate_bytes = 0
+        self._lock = threading.Lock()
+        CACHES[name] = self
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0
+
+    def _get_path(self, key: str) -> str:
+        digest = hashlib.sha256(f"{self.version}:{key}".encode()).hexdigest()
+        return os.path.join(self.directory, digest + _ENTRY_SUFFIX)
+
+    def _check_directory(self) -> bool:
+        """Creates the directory, then checks it is a directory, not a link, owned by this user with mode 0700 so no
+        other user can read or replace the stored responses. A directory that is not is refused and the cache
+        disabled.
+
+        :return: True if the directory can be used
+        :rtype: bool
+        """
+        if self._directory_checked:
+            return True
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        directory_stat = os.lstat(self.directory)
+        if (not stat.S_ISDIR(directory_stat.st_mode) or directory_stat.st_uid != os.getuid()
+                or stat.S_IMODE(directory_stat.st_mode) != 0o700):
+            print(f"Disabling the {self.name} cache, as {self.directory} must be a directory owned by this user "
+                  f"with mode 0700")
+            self.maxsize = 0
+            return False
+        self._directory_checked = True
+        return True
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        """Gets a stored response
+
+        :param str key: The request key from get_request_digest
+        :return: The response body and mimetype, or None if it is not stored or has expired
+        """
+        if not self.enabled:
+            return None
+        path = self._get_path(key)
+        try:
+            if not self._check_directory():
+                return None
+            with open(path, "rb") as f:
+                modified = os.fstat(f.fileno()).st_mtime
+                if time.time() - modified > self.ttl:
+                    self._count(False)
+                    return None
+                mimetype, body = f.read().split(b"\n", 1)
+            # Mark the response as used, keeping the time it was stored
+            os.utime(path, (time.time(), modified))
+        except (OSError, ValueError):
+            self._count(False)
+            return None
+        self._count(True)
+        return body, mimetype.decode()
+
+    def put(self, key: str, body: bytes, mimetype: str) -> bool:
+        """Stores a response, then evicts expired and least recently used responses if the cache is over its bounds.
+        A response that cannot be written, e.g. because the disk is full, is not stored and counted as a write error.
+
+        :param str key: The request key from get_request_digest
+        :param bytes body: The response body
+        :param str mimetype: The mimetype of the response
+        :return: True if the response was stored
+        :rtype: bool
+        """
+        if not self.enabled or len(body) > self.max_bytes:
+            return False
+        temporary = None
+        try:
+            if not self._check_directory():
+                return False
+            fd, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(mimetype.encode() + b"\n")
+                f.write(body)
+            os.replace(temporary, self._get_path(key))
+        except OSError:
+            with self._lock:
+                self.write_errors += 1
+            if temporary is not None:
+                try:
+                    os.remove(temporary)
+                except OSError:
+                    pass
+            return False
+        with self._lock:
+            if self._approximate_count is not None:
+                self._approximate_count += 1
+                self._approximate_bytes += len(mimetype.encode()) + 1 + len(body)
+            over_bounds = (self._approximate_count is None or self._approximate_count > self.maxsize
+                           or self._approximate_bytes > self.max_bytes)
+        if over_bounds:
+            self._trim()
+        return True
+
+    def _scan(self):
+        """Gets the (access time, modification time, size, path) of every stored response, removing temporary files
+        left by processes that were killed while writing"""
+        entries = []
+        now = time.time()
+        try:
+            scanned = list(os.scandir(self.directory))
+        except OSError:
+            return entries
+        for entry in scanned:
+            try:
+                stat = entry.stat()
+                if entry.name.endswith(_ENTRY_SUFFIX):
+                    entries.append((stat.st_atime, stat.st_mtime, stat.st_size, entry.path))
+                elif entry.name.endswith(".tmp") and now - stat.st_mtime > self.ttl:
+                    os.remove(entry.path)
+            except OSError:
+                # Removed by another process
+                continue
+        return entries
+
+    def _trim(self):
+        """Removes expired responses, then the least recently used until the cache fits within its bounds"""
+        now = time.time()
+        entries = sorted(self._scan())
+        count = len(entries)
+        size = sum(entry[2] for entry in entries)
+        for accessed, modified, entry_size, path in entries:
+            expired = now - modified > self.ttl
+            if not expired and count <= self.maxsize and size <= self.max_bytes:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            count -= 1
+            size -= entry_size
+            if not expired:
+                with self._lock:
+                    self.evictions += 1
+        with self._lock:
+            self._approximate_count = count
+            self._approximate_bytes = size
+
+    def clear(self):
+        """Removes every stored response, e.g. after the instruments were reloaded, and resets the counters
+
+        :rtype: None
+        """
+        for _, _, _, path in self._scan():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.write_errors = 0
+            self._approximate_count = 0
+            self._approximate_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Gets the size of the shared cache and the counters of this process
+
+        :return: A dictionary of the cache statistics
+        :rtype: Dict
+        """
+        size = len(self._scan()) if self.enabled else 0
+        with self._lock:
+            return {"size": size, "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "write_errors": self.write_errors}
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+    first = SharedResultCache("results_first", directory, maxsize=2, max_bytes=1000, ttl=60)
+    second = SharedResultCache("results_second", directory, maxsize=2, max_bytes=1000, ttl=60)
+    request = {"instrument": "NG7SANS", "model": "sphere", "model_params": {"radius": 50, "scale": 1}}
+    reordered = {"model_params": {"scale": 1, "radius": 50}, "model": "sphere", "instrument": "NG7SANS"}
+    key = get_request_digest(request, True, "json")
+    # Ensure the key does not depend on field order, and does depend on the variant
+    assert key == get_request_digest(reordered, True, "json") != get_request_digest(request, False, "json")
+    # Ensure a response stored by one process is found by another
+    assert second.get(key) is None
+    first.put(key, b"{\"q\": [1]}\n", "text/html")
+    assert second.get(key) == (b"{\"q\": [1]}\n", "text/html")
+    # Ensure the least recently used response is evicted, and responses over the byte bound are not stored
+    first.put("b", b"b", "text/html")
+    second.get(key)
+    first.put("c", b"c", "text/html")
+    assert first.get("b") is None and first.get(key) is not None and first.stats()["size"] == 2
+    first.put("large", b"x" * 1001, "text/html")
+    assert first.get("large") is None
+    # Ensure expired responses and responses of other code versions are not used
+    expired = SharedResultCache("results_expired", directory, maxsize=2, max_bytes=1000, ttl=0)
+    assert expired.get(key) is None
+    assert SharedResultCache("results_other", directory, maxsize=2, version="other").get(key) is None
+    first.clear()
+    assert second.get(key) is None
+    # Ensure a response that cannot be written is skipped, instead of failing the request
+    unwritable = SharedResultCache("results_unwritable", os.path.join(directory, "file", "cache"), maxsize=2)
+    open(os.path.join(directory, "file"), "w").close()
+    assert not unwritable.put(key, b"{}", "text/html")
+    assert unwritable.get(key) is None and unwritable.write_errors == 1
+    # Ensure the directory is only scanned when the responses stored since the last scan may be over the bounds
+    scans = []
+    counted = SharedResultCache("results_counted", os.path.join(directory, "counted"), maxsize=4, max_bytes=350)
+    scan = counted._scan
+    counted._scan = lambda: scans.append(True) or scan()
+    for name in ["a", "b", "c"]:
+        counted.put(name, b"x" * 100, "text/html")
+    assert len(scans) == 1
+    # Ensure the least recently used responses are evicted once either bound is passed
+    counted.put("d", b"x" * 100, "text/html")
+    assert len(scans) == 2 and counted.get("a") is None
+    counted.put("e", b"x", "text/html")
+    assert len(scans) == 2
+    counted.put("f", b"x", "text/html")
+    assert len(scans) == 3 and counted.get("b") is None and counted.get("f") is not None
+    # Ensure directories other users could read or change are refused, and the cache disabled
+    shared = os.path.join(directory, "shared")
+    os.mkdir(shared, 0o700)
+    os.chmod(shared, 0o755)
+    linked = os.path.join(directory, "linked")
+    os.symlink(os.path.join(directory, "counted"), linked)
+    for refused_directory in [shared, linked]:
+        refused = SharedResultCache("results_refused", refused_directory, maxsize=2)
+        assert not refused.put(key, b"{}", "text/html") and not refused.enabled and refused.get(key) is None
+    assert os.listdir(shared) == []
+    # Ensure the default size bound fits in the free space of the directory
+    assert 0 < get_default_max_bytes(os.path.join(directory, "missing")) <= DEFAULT_RESULT_CACHE_BYTES
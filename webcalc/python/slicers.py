@@ -1,11 +1,24 @@
 # TODO: Create slicer class and child slicers
 # built-in imports
 import math
+import os
+import threading
 from typing import Union
 
 import numpy as np
 from scipy.special import gamma, gammainc, erf
 
+from .cache import LRUCache
+from .helpers import get_array_digest
+from .masks import DetectorMask, get_beam_stop_mask, get_edge_mask
+from .timing import span, timed
+
+# The number of detector configurations whose geometry is kept in memory
+GEOMETRY_CACHE_SIZE = int(os.environ.get("SASWEBCALC_GEOMETRY_CACHE_SIZE", 32))
+GEOMETRY_CACHE = LRUCache("detector_geometry", GEOMETRY_CACHE_SIZE)
+# The Q grids shared by the slicers and the model, by the digest of their Qx and Qy values
+Q_GRID_CACHE = LRUCache("q_grids", GEOMETRY_CACHE_SIZE)
+
 
 #  Calculate the x or y distance from the beam center of a given pixel
 def calculate_distance_from_beam_center(pixel_value, pixel_center, pixel_size, coeff):
@@ -43,6 +56,247 @@ def add_at_location(array, location):
     pass
 
 
+def get_standard_mask(x_pixels, y_pixels):
+    """Gets the standard mask of a detector, where the outer two pixels are masked (1) and all others are not (0)
+
+    :param int x_pixels: The number of pixels in the x direction
+    :param int y_pixels: The number of pixels in the y direction
+    :return: An integer array with one row per pixel row
+    :rtype: np.ndarray
+    """
+    return get_edge_mask(x_pixels, y_pixels).to_array().astype(int)
+
+
+class QGrid:
+    """The Qx and Qy values of every pixel of a detector, from the Qx value of each pixel column and the Qy value of
+    each pixel row
+
+    The 2D views are broadcast from the 1D values, so they take no memory. Only the Q magnitude and the flattened
+    values the model is evaluated at are materialized, each once, so a grid shared with get_q_grid is only built once
+    per process. All arrays are read-only.
+
+    :param np.ndarray self.qx_values: The Qx value of each pixel column
+    :param np.ndarray self.qy_values: The Qy value of each pixel row
+    """
+
+    def __init__(self, qx_values, qy_values, digest=None):
+        self.qx_values = np.asarray(qx_values)
+        self.qy_values = np.asarray(qy_values)
+        self._q_2d_values = None
+        self._digest = digest
+        self._flattened = {}
+        self._lock = threading.Lock()
+
+    @property
+    def shape(self):
+        """The (rows, columns) shape of the detector"""
+        return len(self.qy_values), len(self.qx_values)
+
+    @property
+    def digest(self) -> str:
+        """A digest of the Qx and Qy values, the same for every grid of the same values"""
+        if self._digest is None:
+            self._digest = get_array_digest(self.qx_values, self.qy_values)
+        return self._digest
+
+    @property
+    def qx_2d(self) -> np.ndarray:
+        """The Qx value of every pixel, as a read-only view"""
+        return np.broadcast_to(self.qx_values[np.newaxis, :], self.shape)
+
+    @property
+    def qy_2d(self) -> np.ndarray:
+        """The Qy value of every pixel, as a read-only view"""
+        return np.broadcast_to(self.qy_values[:, np.newaxis], self.shape)
+
+    @property
+    def q_2d_values(self) -> np.ndarray:
+        """The magnitude of Q for every pixel"""
+        with self._lock:
+            if self._q_2d_values is None:
+                qx = self.qx_values[np.newaxis, :]
+                qy = self.qy_values[:, np.newaxis]
+                self._q_2d_values = np.sqrt(qx * qx + qy * qy)
+                self._q_2d_values.setflags(write=False)
+            return self._q_2d_values
+
+    def get_flattened(self, dtype=np.float64):
+        """Gets the flattened Qx and Qy values of every pixel, row by row, for evaluating a model on the detector.
+        Each array is copied once from the broadcast views, the first time each type is asked for.
+
+        :param dtype: The numpy type of the arrays, e.g. np.float32 for single precision models
+        :return: A list of the flattened Qx and Qy arrays
+        :rtype: List
+        """
+        key = np.dtype(dtype).str
+        with self._lock:
+            if key not in self._flattened:
+                qx = np.asarray(self.qx_values, dtype=dtype)[np.newaxis, :]
+                qy = np.asarray(self.qy_values, dtype=dtype)[:, np.newaxis]
+                flattened = [np.broadcast_to(qx, self.shape).reshape(-1), np.broadcast_to(qy, self.shape).reshape(-1)]
+                for q in flattened:
+                    q.setflags(write=False)
+                self._flattened[key] = flattened
+            return self._flattened[key]
+
+
+def get_q_grid(qx_values, qy_values) -> QGrid:
+    """Gets the QGrid for the Qx and Qy values from the process-wide cache, creating it if necessary, so the slicer and
+    the model evaluation of a request share one grid
+
+    :param qx_values: The Qx value of each pixel column
+    :param qy_values: The Qy value of each pixel row
+    :return: The shared grid
+    :rtype: QGrid
+    """
+    qx_values = np.asarray(qx_values)
+    qy_values = np.asarray(qy_values)
+    key = get_array_digest(qx_values, qy_values)
+    return Q_GRID_CACHE.get_or_create(key, lambda: QGrid(qx_values, qy_values, key))
+
+
+class DetectorGeometry:
+    """The pixel geometry of a detector for a single instrument configuration
+
+    Everything here only depends on the values used to create it, so instances are cached and shared between slicers
+    using get_detector_geometry. All arrays are read-only.
+
+    :param np.ndarray self.qx_values: The Qx value of each pixel column
+    :param np.ndarray self.qy_values: The Qy value of each pixel row
+    :param QGrid self.q_grid: The Q grid of the detector, shared with the model evaluation
+    :param np.ndarray self.q_2d_values: The magnitude of Q for every pixel
+    :param DetectorMask self.edge_mask: The standard mask where the outer two pixels are masked
+    :param np.ndarray self.x_distances: The x distance of every pixel from the beam center
+    :param np.ndarray self.y_distances: The y distance of every pixel from the beam center
+    :param np.ndarray self.num_dimensions: The number of sub-pixels per side each pixel is split into
+    :param np.ndarray self.center: The index of the center sub-pixel of each pixel
+    :param np.ndarray self.split: True for every pixel that is split into sub-pixels
+    :param np.ndarray self.split_indices: The flat, row-major index of every split pixel, in the order of the sub-pixels
+    :param np.ndarray self.sub_pixel_dx: The corrected x distances of the sub-pixels of all split pixels
+    :param np.ndarray self.sub_pixel_dy: The corrected y distances of the sub-pixels of all split pixels
+    :param np.ndarray self.sub_pixel_nd: The number of sub-pixels per side for the sub-pixels of all split pixels
+    """
+
+    def __init__(self, x_pixels, y_pixels, pixel_size_x, pixel_size_y, x_center, y_center, detector_distance,
+                 lambda_val, coeff):
+        """Calculates all geometry arrays for the detector configuration
+
+        :param int x_pixels: The number of pixels in the x direction
+        :param int y_pixels: The number of pixels in the y direction
+        :param float pixel_size_x: The size of a pixel in the x direction
+        :param float pixel_size_y: The size of a pixel in the y direction
+        :param float x_center: The beam center in the x direction, in pixels
+        :param float y_center: The beam center in the y direction, in pixels
+        :param float detector_distance: The distance from the sample to the detector
+        :param float lambda_val: The wavelength
+        :param float coeff: The coefficient used when calculating distances from the beam center
+        """
+        # Calculate Qx and Qy values
+        x_indices = np.arange(x_pixels)
+        x_distances = calculate_distance_from_beam_center(x_indices, x_center, pixel_size_x, coeff)
+        theta_x = np.arctan(x_distances / detector_distance) / 2.0
+        self.qx_values = (4 * math.pi / lambda_val) * np.sin(theta_x)
+        y_indices = np.arange(y_pixels)
+        y_distances = calculate_distance_from_beam_center(y_indices, y_center, pixel_size_y, coeff)
+        theta_y = np.arctan(y_distances / detector_distance) / 2
+        self.qy_values = (4 * math.pi / lambda_val) * np.sin(theta_y)
+        self.qx_values.setflags(write=False)
+        self.qy_values.setflags(write=False)
+        self.q_grid = get_q_grid(self.qx_values, self.qy_values)
+        self.q_2d_values = self.q_grid.q_2d_values
+        self.edge_mask = get_edge_mask(x_pixels, y_pixels)
+        self.calculate_pixel_distances(x_pixels, y_pixels, pixel_size_x, pixel_size_y, x_center, y_center, coeff)
+        self.calculate_sub_pixels(pixel_size_x, pixel_size_y)
+        for value in vars(self).values():
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+
+    @property
+    def shape(self):
+        """The (y_pixels, x_pixels) shape of every per-pixel array, one row per pixel row"""
+        return self.q_grid.shape
+
+    def calculate_pixel_distances(self, x_pixels, y_pixels, pixel_size_x, pixel_size_y, x_center, y_center, coeff):
+        """Calculate the distance of every pixel from the beam center and how finely each pixel is divided
+
+        The x distance only depends on the pixel column and the y distance on the pixel row, so both are broadcast views
+        of the per-column and per-row distances.
+        """
+        # The radius, in cm, from the center of the beam to slice pixels into a 3x3 grid
+        radius_center = 100
+        # x and y pixel indices
+        x_indices = np.arange(1, x_pixels + 1)
+        y_indices = np.arange(1, y_pixels + 1)
+        # Calculate distance array from the beam center
+        shape = (y_pixels, x_pixels)
+        x_distances = calculate_distance_from_beam_center(x_indices, x_center, pixel_size_x, coeff)
+        y_distances = calculate_distance_from_beam_center(y_indices, y_center, pixel_size_y, coeff)
+        self.x_distances = np.broadcast_to(x_distances[np.newaxis, :], shape)
+        self.y_distances = np.broadcast_to(y_distances[:, np.newaxis], shape)
+        # Calculate total distances for all pixels
+        total_distances = np.sqrt(self.x_distances * self.x_distances + self.y_distances * self.y_distances)
+        # Convert pixels near the center into 3x3 pixels
+        self.num_dimensions = np.ones(shape)
+        self.num_dimensions[total_distances <= radius_center] = 3
+        # Set existing pixel center value
+        self.center = np.ones(shape)
+        self.center[total_distances <= radius_center] = 2
+
+    def calculate_sub_pixels(self, pixel_size_x, pixel_size_y):
+        """Calculate the corrected distances of all sub-pixels, ordered identically to Slicer.calculate_reference"""
+        # Only pixels near the beam center are split into sub-pixels, all others are skipped by the per-pixel loop
+        self.split = self.num_dimensions > 1
+        self.split_indices = np.flatnonzero(self.split)
+        nd = int(self.num_dimensions[self.split].max()) if np.any(self.split) else 1
+        sub_pixels = np.arange(1, nd)
+        # Sub-pixel offsets for the k (x) and el (y) directions
+        center = self.center[self.split][:, np.newaxis]
+        offsets_x = (sub_pixels - center) * pixel_size_x / sub_pixels
+        offsets_y = (sub_pixels - center) * pixel_size_y / sub_pixels
+        sub_pixel_dx = self.x_distances[self.split][:, np.newaxis, np.newaxis] + offsets_x[:, :, np.newaxis]
+        sub_pixel_dy = self.y_distances[self.split][:, np.newaxis, np.newaxis] + offsets_y[:, np.newaxis, :]
+        shape = np.broadcast_shapes(sub_pixel_dx.shape, sub_pixel_dy.shape)
+        self.sub_pixel_dx = np.broadcast_to(sub_pixel_dx, shape).copy()
+        self.sub_pixel_dy = np.broadcast_to(sub_pixel_dy, shape).copy()
+        self.sub_pixel_nd = np.broadcast_to(self.num_dimensions[self.split][:, np.newaxis, np.newaxis], shape).copy()
+
+    def broadcast_to_sub_pixels(self, values):
+        """Broadcast a per-pixel array to the shape of the sub-pixel arrays without copying it
+
+        :param np.ndarray values: An array with one value per pixel
+        :return: A read-only view with one value per sub-pixel
+        :rtype: np.ndarray
+        """
+        return np.broadcast_to(np.asarray(values)[self.split][:, np.newaxis, np.newaxis], self.sub_pixel_dx.shape)
+
+    def broadcast_mask_to_sub_pixels(self, mask: DetectorMask):
+        """Broadcast a mask to the shape of the sub-pixel arrays, only looking up the bits of the split pixels
+
+        :param DetectorMask mask: The mask of the detector
+        :return: A read-only view that is True for every masked sub-pixel
+        :rtype: np.ndarray
+        """
+        masked = mask.contains(self.split_indices)
+        return np.broadcast_to(masked[:, np.newaxis, np.newaxis], self.sub_pixel_dx.shape)
+
+
+def get_detector_geometry(x_pixels, y_pixels, pixel_size_x, pixel_size_y, x_center, y_center, detector_distance,
+                          lambda_val, coeff):
+    """Gets the DetectorGeometry for a configuration from the process-wide cache, creating it if necessary
+
+    :return: The shared, read-only geometry for the configuration
+    :rtype: DetectorGeometry
+    """
+    key = (int(x_pixels), int(y_pixels), float(pixel_size_x), float(pixel_size_y), float(x_center), float(y_center),
+           float(detector_distance), float(lambda_val), float(coeff))
+    return GEOMETRY_CACHE.get_or_create(key, lambda: _create_detector_geometry(key))
+
+
+def _create_detector_geometry(key):
+    with span("slicer.geometry"):
+        return DetectorGeometry(*key)
+
+
 class Slicer:
 
     def __init__(self, params):
@@ -53,6 +307,11 @@ class Slicer:
 
         # Params needed for calculate_q_range_slicer
         self.mask: np.array = np.zeros_like(0)
+        # Pixels masked by the user, as a DetectorMask, its to_dict form, or an array with one value per pixel
+        self.user_mask = None
+        # The mask used for the averages, the edges and the user mask, and the pixels behind the beam stop
+        self.detector_mask: DetectorMask = None
+        self.beam_stop_mask: DetectorMask = None
         self.intensity_2D: np.array = np.zeros_like(0)
         self.detector_distance: float = 0.0
         self.x_pixels: int = 0
@@ -97,8 +356,10 @@ class Slicer:
         self.beam_stop_size: float = 5.08
         self.SSD: float = 1627
         self.SDD: float = 1530
-        # TODO: not all pixels are square => differentiate pixel_size_x from pixel_size_y
+        # The radial bin width, and the pixel size in each direction, which is pixel_size if not given
         self.pixel_size = 5.08
+        self.pixel_size_x: float = 0.0
+        self.pixel_size_y: float = 0.0
         self.coeff: float = 10000
         self.x_center: float = 64.5
         self.y_center: float = 64.5
@@ -116,7 +377,10 @@ class Slicer:
         # set params
         # TODO: set_params should be a class method
         set_params(self, params)
-        self.calculate_q_range_slicer()
+        self.pixel_size_x = self.pixel_size_x or self.pixel_size
+        self.pixel_size_y = self.pixel_size_y or self.pixel_size
+        with span("slicer"):
+            self.calculate_q_range_slicer()
         self.set_values()
 
     def set_values(self):
@@ -138,66 +402,102 @@ class Slicer:
         self.phi_to_ll_corner = math.atan(self.min_qy / self.min_qx) + math.pi
         self.phi_to_lr_corner = math.atan(self.min_qy / self.max_qx) + 2 * math.pi
 
+    @timed("slicer.bin")
     def calculate(self):
-        """Calculate the average intensity for all Q values at a given instrument configuration"""
-        large_number = 1.0
-        # The radius, in cm, from the center of the beam to slice pixels into a 3x3 grid
-        radius_center = 100
+        """Calculate the average intensity for all Q values at a given instrument configuration
+
+        All sub-pixels are binned at once using array operations. The results match calculate_reference, the original
+        per-pixel implementation, which is kept for equivalence testing.
+        """
+        geometry = self.get_geometry()
+        corrected_dx = geometry.sub_pixel_dx
+        corrected_dy = geometry.sub_pixel_dy
+        mask = geometry.broadcast_mask_to_sub_pixels(self.detector_mask)
+        data_px = geometry.broadcast_to_sub_pixels(self.intensity_2D)
+        n_d_sqr = geometry.sub_pixel_nd
+        # Boolean inclusion mask for every sub-pixel based on the averaging type
+        include = self.include_pixels(corrected_dx, corrected_dy, mask)
+        i_radius = self.get_i_radii(corrected_dx[include], corrected_dy[include])
+        n_d_sqr = n_d_sqr[include]
+        data_px = data_px[include]
+        # Weighted histograms over the radial bins
+        size = self.x_pixels * self.y_pixels
+        self.n_cells = np.bincount(i_radius, weights=1 / n_d_sqr, minlength=size)
+        self.d_sq = np.bincount(i_radius, weights=data_px * data_px / n_d_sqr, minlength=size)
+        self.ave_intensity = np.bincount(i_radius, weights=data_px / n_d_sqr, minlength=size)
+        nq = int(i_radius.max()) if i_radius.size else 0
+        self.calculate_averages(nq)
+
+    def calculate_reference(self):
+        """Calculate the average intensity for all Q values at a given instrument configuration one pixel at a time
+
+        This is the original implementation of calculate and is much slower. It is only kept as a reference for
+        ensuring calculate returns the same values.
+        """
         # Number of unique Q points used for the averaging
         nq = 0
-        # x and y pixel indices
-        x_indices = np.asarray(range(1, len(self.qx_values) + 1))
-        y_indices = np.asarray(range(1, len(self.qy_values) + 1))
-        # Calculate distance array from the beam center
-        x_distances = np.full((self.x_pixels, self.x_pixels),
-                              calculate_distance_from_beam_center(x_indices, self.x_center, self.pixel_size,
-                                                                  self.coeff))
-        y_distances = np.full((self.y_pixels, self.y_pixels),
-                              calculate_distance_from_beam_center(y_indices, self.y_center, self.pixel_size,
-                                                                  self.coeff))
-        # Calculate total distances for all pixels
-        total_distances = np.sqrt(x_distances * x_distances + y_distances * y_distances)
-        # Convert pixels near the center into 3x3 pixels
-        num_dimensions = np.ones(np.shape(total_distances))
-        num_dimensions[total_distances <= radius_center] = 3
-        # Set existing pixel center value
-        center = np.ones(np.shape(total_distances))
-        center[total_distances <= radius_center] = 2
-        num_d_squared = num_dimensions * num_dimensions
+        x_distances, y_distances, num_dimensions, center = self.calculate_pixel_distances()
         # Generate 1D arrays with size of x_pixels*y_pixels
         self.ave_intensity = np.zeros(self.x_pixels * self.y_pixels)
         self.d_sq = np.zeros(self.x_pixels * self.y_pixels)
         self.n_cells = np.zeros(self.x_pixels * self.y_pixels)
 
-        for i in range(self.x_pixels):
-            for j in range(self.y_pixels):
+        # Every per-pixel array has one row per pixel row
+        for i in range(self.y_pixels):
+            for j in range(self.x_pixels):
                 data_px = self.intensity_2D[i][j]
                 nd = int(num_dimensions[i][j])
                 for k in range(1, nd):
-                    corrected_dx = x_distances[i][j] + (k - center[i][j]) * self.pixel_size / k
+                    corrected_dx = x_distances[i][j] + (k - center[i][j]) * self.pixel_size_x / k
                     n_d_sqr = nd
                     for el in range(1, nd):
-                        corrected_dy = y_distances[i][j] + (el - center[i][j]) * self.pixel_size / el
+                        corrected_dy = y_distances[i][j] + (el - center[i][j]) * self.pixel_size_y / el
                         if not self.include_pixel(corrected_dx, corrected_dy, self.mask[i][j]):
                             continue
                         i_radius = self.get_i_radius(corrected_dx, corrected_dy)
                         self.n_cells[i_radius] += 1 / n_d_sqr
-                        self.ave_intensity[i_radius] = (0 if self.n_cells[i] == 0 or math.isnan(self.n_cells[i])
-                                                        else self.ave_intensity[i] / self.n_cells[i])
+                        self.ave_intensity[i_radius] += data_px / n_d_sqr
                         self.d_sq[i_radius] += data_px * data_px / n_d_sqr
                         nq = max(i_radius, nq)
+        self.calculate_averages(nq)
+
+    def calculate_pixel_distances(self):
+        """Gets the distance of every pixel from the beam center and how finely each pixel is divided
+
+        :return: A tuple of 2D arrays (x distances, y distances, number of sub-pixels per side, sub-pixel center)
+        :rtype: Tuple
+        """
+        geometry = self.get_geometry()
+        return geometry.x_distances, geometry.y_distances, geometry.num_dimensions, geometry.center
+
+    def get_geometry(self):
+        """Gets the shared detector geometry for the current configuration
 
+        :return: The cached geometry
+        :rtype: DetectorGeometry
+        """
+        return get_detector_geometry(self.x_pixels, self.y_pixels, self.pixel_size_x, self.pixel_size_y, self.x_center,
+                                     self.y_center, self.detector_distance, self.lambda_val, self.coeff)
+
+    def calculate_averages(self, nq: int):
+        """Trim the binned values to the number of Q points used, divide the binned intensities by the number of cells,
+        and calculate the Q values, errors, and resolution
+
+        :param int nq: The number of unique Q points used for the averaging
+        """
+        large_number = 1.0
         self.ave_intensity = self.ave_intensity[:nq]
         self.d_sq = self.d_sq[:nq]
         self.n_cells = self.n_cells[:nq]
         nq_array = np.arange(nq)
         self.calculate_q(nq_array)
-        ave_sq = self.ave_intensity * self.ave_intensity
-        ave_isq = np.asarray([self.d_sq[i] if (np.isfinite(self.n_cells[i]) or self.n_cells[i] <= 0)
-                              else self.d_sq[i] / self.n_cells[i] for i in nq_array])
-        diff = ave_isq - ave_sq
-        self.sigma_ave = np.asarray([large_number if diff[i] < 0 or self.n_cells[i] <= 1
-                                     else math.sqrt(diff[i] / (self.n_cells[i] - 1)) for i in nq_array])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.ave_intensity = np.where(self.n_cells > 0, self.ave_intensity / self.n_cells, 0.0)
+            ave_sq = self.ave_intensity * self.ave_intensity
+            ave_isq = np.where(np.isfinite(self.n_cells) | (self.n_cells <= 0), self.d_sq, self.d_sq / self.n_cells)
+            diff = ave_isq - ave_sq
+            self.sigma_ave = np.where((diff < 0) | (self.n_cells <= 1), large_number,
+                                      np.sqrt(diff / (self.n_cells - 1)))
         self.calculate_resolution()
 
     def calculate_q(self, i: Union[np.ndarray, int]):
@@ -217,6 +517,16 @@ class Slicer:
     def get_i_radius(self, x_val, y_val):
         return int(np.floor(np.sqrt(x_val * x_val + y_val * y_val) / self.pixel_size) + 1)
 
+    def get_i_radii(self, x_vals: np.ndarray, y_vals: np.ndarray) -> np.ndarray:
+        """Array version of get_i_radius that finds the radial bin index for many pixels at once
+
+        :param x_vals: An array of x distances from the beam center
+        :param y_vals: An array of y distances from the beam center
+        :return: An integer array of radial bin indices
+        """
+        return (np.floor(np.sqrt(x_vals * x_vals + y_vals * y_vals) / self.pixel_size) + 1).astype(int)
+
+    @timed("slicer.resolution")
     def calculate_resolution(self):
         velocity_neutron_1a = 3.956e5
         gravity_constant = 981.0
@@ -224,6 +534,8 @@ class Slicer:
         is_lenses = self.lens
         # Pixel size in mm
         pixel_size = self.pixel_size * 0.1
+        pixel_size_x = self.pixel_size_x * 0.1
+        pixel_size_y = self.pixel_size_y * 0.1
         # Base calculations
         # self.ssd is the issue
         lp = 1 / (1 / self.SDD + 1 / self.SSD)
@@ -235,25 +547,30 @@ class Slicer:
         else:
             var_beam = 0.25 * math.pow(self.source_aperture * self.SDD / self.SSD, 2) + 0.25 * math.pow(
                 self.sample_aperture * self.SDD / lp, 2)
-        var_detector = math.pow(pixel_size / 2.3548, 2) + (pixel_size + pixel_size) / 12
+        # The detector resolution and the pixel size squared over 12, as in the NCNR calculation, with the squared
+        #  sizes of non-square pixels averaged
+        var_pixel = (pixel_size_x * pixel_size_x + pixel_size_y * pixel_size_y) / 2
+        var_detector = math.pow(pixel_size / 2.3548, 2) + var_pixel / 12
         velocity_neutron = velocity_neutron_1a / self.lambda_val
         var_gravity = 0.5 * gravity_constant * self.SDD * (self.SSD + self.SDD) / math.pow(velocity_neutron, 2)
         r_zero = self.SDD * np.tan(2.0 * np.arcsin(self.lambda_val * np.asarray(self.q_values) / (4.0 * np.pi)))
         r_zero[r_zero < small_number] = small_number
         delta = 0.5 * np.power(self.beam_stop_size - r_zero, 2) / var_detector
-        inc_gamma = np.asarray([np.exp(np.log(gamma(1.5))) * (1 + gammainc(1.5, delta) / gamma(1.5)) if r_zero[i] >= self.beam_stop_size
-                                else np.exp(np.log(gamma(1.5))) * (1 - gammainc(1.5, delta) / gamma(1.5)) for i in range(len(r_zero))])
+        # Element-wise, as in the NCNR resolution calculation, so each Q value has one resolution. gammainc is
+        #  already regularized.
+        inc_gamma = gamma(1.5) * np.where(r_zero >= self.beam_stop_size, 1 + gammainc(1.5, delta),
+                                          1 - gammainc(1.5, delta))
         f_sub_s = 0.5 * (1.0 + erf((r_zero - self.beam_stop_size) / math.sqrt(2.0 * var_detector)))
         f_sub_s[f_sub_s < small_number] = small_number
-        fr = 1.0 + np.sqrt(var_detector) * np.exp(-1.0 * delta) / (r_zero * f_sub_s * np.sqrt(2.0 + np.pi))
+        fr = 1.0 + np.sqrt(var_detector) * np.exp(-1.0 * delta) / (r_zero * f_sub_s * np.sqrt(2.0 * np.pi))
         fv = inc_gamma / (f_sub_s * np.sqrt(math.pi)) - r_zero * r_zero * np.power(fr - 1.0, 2) / var_detector
-        rmd = fr + r_zero
+        rmd = fr * r_zero
         var_r1 = var_beam + var_detector * fv + var_gravity
         rm = rmd + 0.5 * var_r1 / rmd
         var_r = var_r1 - 0.5 * (var_r1 / rmd) * (var_r1 / rmd)
         var_r[var_r < 0] = 0.0
         self.q_average = (4.0 * np.pi / self.lambda_val) * np.sin(0.5 * np.arctan(rm / self.SDD))
-        self.sigma_q = self.q_average * np.sqrt((var_r / rmd) * (var_r / rmd) + var_lambda)
+        self.sigma_q = self.q_average * np.sqrt(var_r / (rmd * rmd) + var_lambda)
         self.f_subs = f_sub_s
 
     def calculate_distance_from_beam_center(self, pixel_value, x_or_y):
@@ -266,39 +583,53 @@ class Slicer:
     # Calculate Q Range Slicer and its helper methods
     def calculate_q_range_slicer(self):
         # Detector values pixel size in mm
+        geometry = self.get_geometry()
         self.generate_ones_data()
-        self.generate_standard_mask()
-        # Calculate Qx and Qy values
-        x_pixels = np.array([i for i in range(self.x_pixels)])
-        x_distances = calculate_distance_from_beam_center(x_pixels, self.x_center, self.pixel_size, self.coeff)
-        theta_x = np.arctan(x_distances / self.detector_distance) / 2.0
-        self.qx_values = (4 * math.pi / self.lambda_val) * np.sin(theta_x)
-        y_pixels = np.array([i for i in range(self.y_pixels)])
-        y_distances = calculate_distance_from_beam_center(y_pixels, self.y_center, self.pixel_size, self.coeff)
-        theta_y = np.arctan(y_distances / self.detector_distance) / 2
-        self.qy_values = (4 * math.pi / self.lambda_val) * np.sin(theta_y)
-        qx_2d = np.full((self.x_pixels, self.y_pixels), self.qx_values)
-        qy_2d = np.transpose(np.full((self.y_pixels, self.x_pixels), self.qy_values))
-        self.q_2d_values = np.sqrt(qx_2d * qx_2d + qy_2d * qy_2d)
+        self.detector_mask = geometry.edge_mask
+        if self.user_mask is not None:
+            self.detector_mask = self.detector_mask | DetectorMask.from_value(self.user_mask, geometry.shape)
+        self.mask = self.detector_mask.to_array()
+        self.qx_values = geometry.qx_values
+        self.qy_values = geometry.qy_values
+        self.q_2d_values = geometry.q_2d_values
         min_theta = math.tan(self.beam_stop_size / (2 * self.detector_distance))
         min_q = (4 * math.pi / self.lambda_val) * math.sin(min_theta / 2)
-        self.intensity_2D = np.where(abs(self.q_2d_values) > min_q, self.intensity_2D, 1e-10)
+        # Only the few pixels behind the beam stop are changed, instead of copying the whole detector
+        self.beam_stop_mask = get_beam_stop_mask(geometry.q_grid, min_q)
+        np.put(self.intensity_2D, self.beam_stop_mask.indices, 1e-10)
         self.calculate()
 
+    def get_masks(self):
+        """Gets the masks of the detector, which are sent to the front end once and then referred to by their digest
+
+        :return: A dictionary of the mask used for the averages and the mask of the pixels behind the beam stop
+        :rtype: Dict
+        """
+        return {"detector": self.detector_mask, "beamStop": self.beam_stop_mask}
+
     def generate_ones_data(self):
         """Create an array of 1s as a basis for the 2D intensity values. These 1s willed be scaled relative to the
         average intensity for each pixel"""
-        self.intensity_2D = np.ones((self.x_pixels, self.y_pixels))
+        self.intensity_2D = np.ones((self.y_pixels, self.x_pixels))
 
     def generate_standard_mask(self):
         """ Generate an array that uses 1 to represent a masked pixel and 0 otherwise. The outer two pixels are masked
         by default."""
-        self.mask = [[1 if i <= 1 or i >= self.x_pixels - 2 or j <= 1 or j >= (self.y_pixels - 2) else 0
-                      for i in range(self.x_pixels)] for j in range(self.y_pixels)]
+        self.mask = get_standard_mask(self.x_pixels, self.y_pixels)
 
     def include_pixel(self, x_val, y_val, mask):
         return mask == 0
 
+    def include_pixels(self, x_vals: np.ndarray, y_vals: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        """Array version of include_pixel that decides which pixels are used in the average all at once
+
+        :param x_vals: An array of x distances from the beam center
+        :param y_vals: An array of y distances from the beam center
+        :param mask: An array of mask values matching the shape of x_vals
+        :return: A boolean array that is True for every pixel included in the average
+        """
+        return np.asarray(mask) == 0
+
     # Slicer recturn method for all the values need to return to slicer
     def slicer_return(self):
         slicer_return = {}
@@ -343,6 +674,27 @@ class Sector(Slicer):
         right = self.detector_sections == "right" and forward
         return (both or left or right) and (mask == 0)
 
+    def include_pixels(self, x_vals, y_vals, mask):
+        """Array version of include_pixel that finds all pixels inside the sector(s) defined by phi and d_phi
+
+        :param x_vals: An array of x distances from the beam center
+        :param y_vals: An array of y distances from the beam center
+        :param mask: An array of mask values matching the shape of x_vals
+        :return: A boolean array that is True for every pixel included in the average
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pixel_angles = np.arctan(x_vals / y_vals)
+        is_correct_angle = (pixel_angles > self.phi_lower) & (pixel_angles < self.phi_upper)
+        if self.detector_sections == "both":
+            sections = x_vals != 0
+        elif self.detector_sections == "left":
+            sections = x_vals < 0
+        elif self.detector_sections == "right":
+            sections = x_vals > 0
+        else:
+            return np.zeros(np.shape(x_vals), dtype=bool)
+        return is_correct_angle & sections & (np.asarray(mask) == 0)
+
 
 class Rectangular(Slicer):
     def __init__(self, params):
@@ -360,6 +712,31 @@ class Rectangular(Slicer):
         d = self.detector_sections == "right" and dot_product < 0
         return a and (b or c or d) and (mask == 0)
 
+    def include_pixels(self, x_vals, y_vals, mask):
+        """Array version of include_pixel that finds all pixels within the strip of width q_width along phi
+
+        :param x_vals: An array of x distances from the beam center
+        :param y_vals: An array of y distances from the beam center
+        :param mask: An array of mask values matching the shape of x_vals
+        :return: A boolean array that is True for every pixel included in the average
+        """
+        corrected_radius = np.sqrt(x_vals * x_vals + y_vals * y_vals)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dot_product = (x_vals * self.phi_x + y_vals * self.phi_y) / corrected_radius
+        # Rounding can push the dot product just outside of [-1, 1] where arccos is undefined
+        dphi_pixels = np.arccos(np.clip(dot_product, -1.0, 1.0))
+        d_perpendicular = corrected_radius * np.sin(dphi_pixels)
+        in_strip = d_perpendicular <= 0.5 * self.q_width * self.pixel_size
+        if self.detector_sections == "both":
+            sections = True
+        elif self.detector_sections == "left":
+            sections = dot_product >= 0
+        elif self.detector_sections == "right":
+            sections = dot_product < 0
+        else:
+            return np.zeros(np.shape(x_vals), dtype=bool)
+        return in_strip & sections & (np.asarray(mask) == 0)
+
 
 class Elliptical(Slicer):
     def __init__(self, params):
@@ -371,15 +748,34 @@ class Elliptical(Slicer):
         return super().calculate_q(theta)
 
     def calculate_radius(self, x_val, y_val):
-        # Supposed to be super().calculate _radius but DNE in slicer class
-        i_circular = super().get_i_radius(x_val, y_val)
-        rho = math.atan(x_val / y_val) - self.phi
-        return math.floor(i_circular * math.sqrt(
+        # The circular radius in pixels, before it is binned
+        r_circular = math.sqrt(x_val * x_val + y_val * y_val) / self.pixel_size
+        # atan2 avoids dividing by zero along the x-axis and gives the same cos^2 and sin^2 as atan(x / y)
+        rho = math.atan2(x_val, y_val) - self.phi
+        return math.floor(r_circular * math.sqrt(
             math.cos(rho) * math.cos(rho) + self.aspect_ratio * math.sin(rho) * math.sin(rho))) + 1
 
+    def get_i_radius(self, x_val, y_val):
+        return self.calculate_radius(x_val, y_val)
+
+    def get_i_radii(self, x_vals, y_vals):
+        """Array version of calculate_radius that bins pixels along ellipses with the given aspect ratio
+
+        :param x_vals: An array of x distances from the beam center
+        :param y_vals: An array of y distances from the beam center
+        :return: An integer array of radial bin indices
+        """
+        r_circular = np.sqrt(x_vals * x_vals + y_vals * y_vals) / self.pixel_size
+        rho = np.arctan2(x_vals, y_vals) - self.phi
+        cos_rho = np.cos(rho)
+        sin_rho = np.sin(rho)
+        return (np.floor(r_circular * np.sqrt(cos_rho * cos_rho + self.aspect_ratio * sin_rho * sin_rho))
+                + 1).astype(int)
+
 
 if __name__ == '__main__':
-    # Quick test to ensure
+    # Quick test to ensure. slicers is part of the python package, so run it from the webcalc directory as a module,
+    #  python -m python.slicers, as running the file directly cannot resolve its imports.
     params = {
         'x_pixels': 128,
         'y_pixels': 128,
@@ -394,3 +790,88 @@ if __name__ == '__main__':
     assert len(slicer.intensity_2D) == 128
     assert slicer.intensity_2D.shape == (128, 128)
     assert np.all(slicer.intensity_2D == 1)
+    # Ensure the detector geometry is shared between slicers and cannot be modified
+    geometry = get_detector_geometry(128, 128, 5.08, 5.08, 64.5, 64.5, 6.0, 6.0, 10000)
+    assert geometry is slicer.get_geometry()
+    assert not geometry.q_2d_values.flags.writeable
+    # Ensure the shared Q grid matches the full grids and is shared with grids of the same values
+    qx_2d = np.full((128, 128), geometry.qx_values)
+    qy_2d = np.transpose(np.full((128, 128), geometry.qy_values))
+    assert np.array_equal(geometry.q_2d_values, np.sqrt(qx_2d * qx_2d + qy_2d * qy_2d))
+    assert np.array_equal(geometry.q_grid.qx_2d, qx_2d) and np.array_equal(geometry.q_grid.qy_2d, qy_2d)
+    assert get_q_grid(geometry.qx_values.copy(), geometry.qy_values.copy()) is geometry.q_grid
+    qx, qy = geometry.q_grid.get_flattened()
+    assert np.array_equal(qx, qx_2d.flatten()) and np.array_equal(qy, qy_2d.flatten())
+    assert geometry.q_grid.get_flattened()[0] is qx and geometry.q_grid.get_flattened(np.float32)[0].dtype == np.float32
+    # Ensure the array-based binning matches the per-pixel reference implementation
+    params.update({'x_center': 64.5, 'y_center': 64.5, 'pixel_size': 0.508, 'lambda_val': 6.0, 'SDD': 100.0,
+                   'detector_distance': 100.0})
+    for slicer_class, detector_sections in [(Circular, 'both'), (Sector, 'both'), (Sector, 'left'),
+                                            (Sector, 'right'), (Rectangular, 'both'), (Rectangular, 'left'),
+                                            (Rectangular, 'right'), (Elliptical, 'both')]:
+        params.update({'detector_sections': detector_sections, 'phi': 0.5, 'aspect_ratio': 2.0})
+        slicer = slicer_class(params)
+        slicer.calculate()
+        vectorized = [slicer.n_cells, slicer.d_sq, slicer.ave_intensity, slicer.sigma_ave, slicer.q_values, slicer.sigma_q]
+        slicer.calculate_reference()
+        reference = [slicer.n_cells, slicer.d_sq, slicer.ave_intensity, slicer.sigma_ave, slicer.q_values, slicer.sigma_q]
+        assert all(np.array_equal(v, r) for v, r in zip(vectorized, reference))
+    # Ensure detectors with different numbers and sizes of pixels in each direction are binned like the reference
+    params.update({'x_pixels': 96, 'y_pixels': 160, 'x_center': 48.5, 'y_center': 80.5, 'pixel_size_y': 0.7})
+    for slicer_class in [Circular, Sector, Rectangular, Elliptical]:
+        slicer = slicer_class(params)
+        assert slicer.intensity_2D.shape == slicer.mask.shape == slicer.q_2d_values.shape == (160, 96)
+        slicer.calculate()
+        vectorized = [slicer.n_cells, slicer.d_sq, slicer.ave_intensity, slicer.sigma_ave, slicer.q_values, slicer.sigma_q]
+        slicer.calculate_reference()
+        reference = [slicer.n_cells, slicer.d_sq, slicer.ave_intensity, slicer.sigma_ave, slicer.q_values, slicer.sigma_q]
+        assert all(np.array_equal(v, r) for v, r in zip(vectorized, reference))
+    # Ensure only the pixels behind the beam stop are changed, and user masks are combined with the edges
+    min_q = (4 * math.pi / 6.0) * math.sin(math.tan(slicer.beam_stop_size / 200.0) / 2)
+    assert np.array_equal(slicer.intensity_2D, np.where(abs(slicer.q_2d_values) > min_q, 1.0, 1e-10))
+    assert 0 < slicer.beam_stop_mask.count() < 100 and slicer.get_masks()["beamStop"] is slicer.beam_stop_mask
+    user_mask = np.zeros((160, 96), dtype=int)
+    user_mask[70:90, 40:60] = 1
+    slicer = Circular(dict(params, user_mask=DetectorMask.from_array(user_mask).to_dict()))
+    assert slicer.detector_mask.count() == slicer.get_geometry().edge_mask.count() + 400
+    vectorized = [slicer.n_cells, slicer.d_sq, slicer.ave_intensity, slicer.sigma_ave, slicer.q_values, slicer.sigma_q]
+    slicer.calculate_reference()
+    reference = [slicer.n_cells, slicer.d_sq, slicer.ave_intensity, slicer.sigma_ave, slicer.q_values, slicer.sigma_q]
+    assert all(np.array_equal(v, r) for v, r in zip(vectorized, reference))
+    # Ensure the binned intensities are averaged, so the flat intensity away from the beam stop averages to one
+    assert np.allclose(slicer.ave_intensity[2 * len(slicer.q_values) // 3:], 1.0)
+    assert np.all(slicer.ave_intensity[slicer.n_cells <= 0] == 0) and np.all(slicer.ave_intensity <= 1 + 1e-12)
+    # Ensure the resolution of each Q value matches the NCNR calculation, written out one Q value at a time, and stays
+    #  at the reference values of a 10 m configuration
+    params = {'x_pixels': 128, 'y_pixels': 128, 'x_center': 64.5, 'y_center': 64.5, 'pixel_size': 0.508,
+              'lambda_val': 6.0, 'lambda_width': 0.125, 'SDD': 1000.0, 'detector_distance': 1000.0, 'SSD': 1627.0,
+              'source_aperture': 5.08, 'sample_aperture': 1.27, 'beam_stop_size': 5.0}
+    slicer = Circular(params)
+    assert slicer.sigma_q.shape == slicer.f_subs.shape == slicer.q_average.shape == slicer.q_values.shape
+
+    def get_ncnr_resolution(q):
+        lp = 1 / (1 / 1000.0 + 1 / 1627.0)
+        var_beam = 0.25 * (5.08 * 1000.0 / 1627.0) ** 2 + 0.25 * (1.27 * 1000.0 / lp) ** 2
+        var_detector = (0.0508 / 2.3548) ** 2 + 0.0508 ** 2 / 12
+        var_gravity = 0.5 * 981.0 * 1000.0 * (1627.0 + 1000.0) / (3.956e5 / 6.0) ** 2
+        r_zero = 1000.0 * math.tan(2.0 * math.asin(6.0 * q / (4.0 * math.pi)))
+        delta = 0.5 * (5.0 - r_zero) ** 2 / var_detector
+        sign = 1 if r_zero >= 5.0 else -1
+        inc_gamma = math.exp(math.lgamma(1.5)) * (1 + sign * gammainc(1.5, delta))
+        f_sub_s = 0.5 * (1.0 + math.erf((r_zero - 5.0) / math.sqrt(2.0 * var_detector)))
+        fr = 1.0 + math.sqrt(var_detector) * math.exp(-delta) / (r_zero * f_sub_s * math.sqrt(2.0 * math.pi))
+        fv = inc_gamma / (f_sub_s * math.sqrt(math.pi)) - r_zero * r_zero * (fr - 1.0) ** 2 / var_detector
+        rmd = fr * r_zero
+        var_r1 = var_beam + var_detector * fv + var_gravity
+        rm = rmd + 0.5 * var_r1 / rmd
+        var_r = max(var_r1 - 0.5 * (var_r1 / rmd) ** 2, 0.0)
+        q_average = (4.0 * math.pi / 6.0) * math.sin(0.5 * math.atan(rm / 1000.0))
+        return q_average, q_average * math.sqrt(var_r / (rmd * rmd) + 0.125 * 0.125 / 6.0), f_sub_s
+
+    reference_values = {10: (0.005709965856215081, 0.002125222262570227, 0.9989183803450876),
+                        20: (0.010834179748977246, 0.002128687713973519, 1.0),
+                        60: (0.031972429166514625, 0.002611299272217984, 1.0)}
+    for index, reference in reference_values.items():
+        values = (slicer.q_average[index], slicer.sigma_q[index], slicer.f_subs[index])
+        assert np.allclose(values, get_ncnr_resolution(slicer.q_values[index]), rtol=1e-12)
+        assert np.allclose(values, reference, rtol=1e-9)
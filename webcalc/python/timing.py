@@ -0,0 +1,195 @@
+import contextvars
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from typing import Dict, List, Optional, Tuple
+
+# Whether spans are timed. When disabled, span returns a shared object that does nothing.
+TIMING_ENABLED = os.environ.get("SASWEBCALC_TIMING", "").lower() in ("1", "true", "yes")
+# The upper bounds of the histogram buckets, in seconds
+HISTOGRAM_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                     5.0, 10.0, float("inf"))
+
+# The spans of the request being handled in this context, or None outside a request
+_request_spans = contextvars.ContextVar("request_spans", default=None)
+_disabled_span = nullcontext()
+# Characters that are not allowed in a Server-Timing metric name
+_invalid_name_characters = re.compile(r"[^A-Za-z0-9!#$%&'*+\-.^_`|~]")
+
+
+class Histogram:
+    """The distribution of the durations of a span, in cumulative buckets
+
+    :param list self.buckets: The upper bounds of the buckets in seconds
+    :param list self.counts: The number of durations in each bucket, not cumulative
+    :param int self.count: The number of durations
+    :param float self.sum: The sum of the durations in seconds
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = HISTOGRAM_BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, duration: float):
+        """Adds a duration
+
+        :param float duration: The duration in seconds
+        :rtype: None
+        """
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    self.counts[i] += 1
+                    break
+            self.count += 1
+            self.sum += duration
+
+    def to_dict(self) -> Dict:
+        """Gets the histogram with cumulative bucket counts
+
+        :return: A dictionary of count, sum, and buckets, a list of [upper bound, cumulative count] pairs
+        :rtype: Dict
+        """
+        with self._lock:
+            cumulative = 0
+            buckets = []
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                buckets.append([bound, cumulative])
+            return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+# The histogram of each span name, for this process
+HISTOGRAMS = {}
+_histograms_lock = threading.Lock()
+
+
+def _get_histogram(name: str) -> Histogram:
+    histogram = HISTOGRAMS.get(name)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = HISTOGRAMS.setdefault(name, Histogram())
+    return histogram
+
+
+def record(name: str, duration: float):
+    """Records the duration of a stage in the histograms and, inside a request, in the request spans
+
+    :param str name: The name of the stage
+    :param float duration: The duration in seconds
+    :rtype: None
+    """
+    _get_histogram(name).observe(duration)
+    spans = _request_spans.get()
+    if spans is not None:
+        spans.append((name, duration))
+
+
+@contextmanager
+def _timed_span(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def span(name: str):
+    """Times the code in a with block as the named stage, if timing is enabled
+
+    :param str name: The name of the stage, e.g. slicer.calculate
+    :return: A context manager
+    """
+    if not TIMING_ENABLED:
+        return _disabled_span
+    return _timed_span(name)
+
+
+def timed(name: str):
+    """A decorator that times every call of a function as the named stage, if timing is enabled
+
+    :param str name: The name of the stage
+    :return: The decorator
+    """
+    def decorator(function):
+        if not TIMING_ENABLED:
+            return function
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with _timed_span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_request() -> Optional[contextvars.Token]:
+    """Starts collecting the spans of a request in the current context
+
+    :return: A token to pass to finish_request, or None if timing is disabled
+    """
+    if not TIMING_ENABLED:
+        return None
+    return _request_spans.set([])
+
+
+def finish_request(token: Optional[contextvars.Token]) -> List[Tuple[str, float]]:
+    """Stops collecting the spans of a request
+
+    :param token: The token from start_request
+    :return: A list of (name, duration) pairs in the order the spans finished
+    :rtype: List
+    """
+    if token is None:
+        return []
+    spans = _request_spans.get() or []
+    _request_spans.reset(token)
+    return spans
+
+
+def get_server_timing_header(spans: List[Tuple[str, float]]) -> str:
+    """Formats spans as a Server-Timing header, adding up spans with the same name
+
+    :param spans: A list of (name, duration in seconds) pairs
+    :return: The header value, with durations in milliseconds
+    :rtype: str
+    """
+    totals = {}
+    for name, duration in spans:
+        totals[name] = totals.get(name, 0.0) + duration
+    return ", ".join(f"{_invalid_name_characters.sub('_', name)};dur={duration * 1000:.3f}"
+                     for name, duration in totals.items())
+
+
+def get_timing_stats() -> Dict[str, Dict]:
+    """Gets the histograms of every stage timed in this process
+
+    :return: A dictionary mapping the stage name to its histogram
+    :rtype: Dict
+    """
+    with _histograms_lock:
+        histograms = dict(HISTOGRAMS)
+    return {name: histogram.to_dict() for name, histogram in histograms.items()}
+
+
+if __name__ == '__main__':
+    # Ensure spans are collected per request, added up by name, and observed in the histograms
+    token = _request_spans.set([])
+    for _ in range(2):
+        with _timed_span("slicer.bin"):
+            pass
+    record("model 2d", 0.002)
+    spans = finish_request(token)
+    assert [name for name, _ in spans] == ["slicer.bin", "slicer.bin", "model 2d"]
+    assert get_server_timing_header(spans).endswith("model_2d;dur=2.000")
+    assert get_timing_stats()["model 2d"]["buckets"][4] == [0.0025, 1]
+    assert get_timing_stats()["slicer.bin"]["count"] == 2
+    # Ensure disabled timing costs nothing but a shared no-op context manager
+    if not TIMING_ENABLED:
+        assert span("slicer.bin") is span("model")
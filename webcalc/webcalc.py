@@ -1,24 +1,182 @@
 ﻿# Decides what to do based on link given
+import atexit
+import functools
 import json
-import sys
-import importlib
-import inspect
 import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 from typing import Optional, Union, Dict, List
-from flask import Flask, render_template, request, send_file
+from flask import Flask, g, render_template, request, send_file
 
 # import specific methods from python files
-from python.link_to_sasmodels import get_model_list, get_params, get_structure_list, get_multiplicity_models
-from python.link_to_sasmodels import calculate_model as calculate_m
-from python.helpers import decode_json, encode_json
+from python.asgi import DISCONNECTED_KEY
+from python.capture import RequestCapture
+from python.catalog import Catalog
+from python.executor import ExecutionPool, JobCancelledError, JobTimeoutError, PoolBusyError, run_sas_calc
+from python.link_to_sasmodels import PREWARM_MODELS, get_params, prewarm_models
+from python.metrics import MetricsRegistry, SIZE_BUCKETS, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from python.link_to_sasmodels import calculate_model as calculate_m, calculate_model_1d_2d
+from python.helpers import decode_json, encode_json, encode_binary, BINARY_MIMETYPE
+from python.masks import MASK_ENCODING, MASK_STORE_DIRECTORY, MASK_STORE_SIZE, MASK_STORE_TTL, has_mask_references,\
+    publish_masks, put_mask_references
+from python.normalize import DECLARED_UNITS_CACHE, normalize_request
+from python.pipeline import INSTRUMENT_CACHE, get_instrument_key, get_instrument_result
+from python.profiling import CONTINUOUS_SAMPLE_INTERVAL, ContinuousProfiler, RequestProfile, get_profile_path,\
+    get_requested_mode, is_profiling_allowed
+from python.registry import InstrumentRegistry
+from python.resolution import get_pinhole_resolution
+from python.result_cache import SharedResultCache, get_request_digest
+from python.timing import TIMING_ENABLED, finish_request, get_server_timing_header, get_timing_stats, span,\
+    start_request
 
 Number = Union[float, int]
 
+# The averaging types the instruments know, as sent by the front end
+AVERAGING_TYPES = ['Circular', 'sector', 'rectangular', 'elliptical']
+# The number of threads each batch request calculates its variants with
+BATCH_WORKERS = int(os.environ.get("SASWEBCALC_BATCH_WORKERS", min(8, os.cpu_count() or 1)))
+# The largest number of instrument configurations accepted in one batch request
+BATCH_MAX_SIZE = int(os.environ.get("SASWEBCALC_BATCH_MAX_SIZE", 1000))
+# The precisions the 2D model can be calculated in, and the numpy type of its arrays
+PRECISIONS = {'double': np.float64, 'single': np.float32}
+# The precision of the 2D model unless a request sets precision_2d. The 1D model is always calculated in double.
+PRECISION_2D = os.environ.get("SASWEBCALC_2D_PRECISION", "double")
+
 
 def create_app():
     app = Flask(__name__)
+    # Find the instruments once, instead of on every request
+    registry = InstrumentRegistry()
+    registry.load()
+    # Load the models in SASWEBCALC_PREWARM_MODELS so the first requests using them are fast
+    prewarm_models(PREWARM_MODELS)
+    # CPU-bound calculations run in worker processes when SASWEBCALC_WORKERS is set
+    pool = ExecutionPool()
+    # Request and calculation metrics, shared between processes through SASWEBCALC_METRICS_DIR
+    metrics = MetricsRegistry()
+    atexit.register(metrics.flush, True)
+    # Encoded /calculate/ responses shared by every worker on the host, so repeated requests are not recalculated
+    result_cache = SharedResultCache()
+    # Serialized detector masks, fetched once by the front end from /masks/<digest> and shared by every worker
+    mask_store = SharedResultCache("masks", MASK_STORE_DIRECTORY, maxsize=MASK_STORE_SIZE, ttl=MASK_STORE_TTL,
+                                   version=MASK_ENCODING)
+    # Sampled request bodies are recorded for benchmarks.replay when SASWEBCALC_CAPTURE_DIR is set
+    capture = RequestCapture()
+    atexit.register(capture.close)
+    # Low rate sampling of every thread, written to SASWEBCALC_PROFILE_DIR, if SASWEBCALC_PROFILE_SAMPLE_INTERVAL is set
+    if CONTINUOUS_SAMPLE_INTERVAL > 0:
+        continuous_profiler = ContinuousProfiler()
+        continuous_profiler.start()
+        atexit.register(continuous_profiler.stop)
+
+    @app.before_request
+    def start_timing():
+        # Stages timed with python.timing.span are reported in a Server-Timing header when SASWEBCALC_TIMING is set
+        g.timing_token = start_request()
+        g.timing_start = time.perf_counter()
+
+    @app.after_request
+    def add_server_timing(response):
+        duration = time.perf_counter() - g.pop('timing_start', time.perf_counter())
+        spans = finish_request(g.pop('timing_token', None))
+        if TIMING_ENABLED:
+            spans.append(('total', duration))
+            response.headers['Server-Timing'] = get_server_timing_header(spans)
+        _record_request_metrics(response, duration)
+        return response
+
+    @app.before_request
+    def start_profile():
+        # Requests with an X-Profile header set to SASWEBCALC_PROFILING_TOKEN are profiled when SASWEBCALC_PROFILING is
+        #  set. The profile is stored with the request body, so slow requests can be replayed, and its file name is
+        #  returned in X-Profile-Id.
+        mode = get_requested_mode(request.headers, request.args)
+        if mode is not None and request.endpoint != 'get_profile':
+            profile = RequestProfile(mode)
+            if profile.start():
+                g.profile = profile
+
+    @app.after_request
+    def finish_profile(response):
+        profile = g.pop('profile', None)
+        if profile is not None:
+            response.headers['X-Profile-Id'] = profile.finish(request.get_data())
+        return response
+
+    @app.teardown_request
+    def stop_profile(exception=None):
+        # Requests that raised skip after_request, but must still release the profiler
+        profile = g.pop('profile', None)
+        if profile is not None:
+            profile.finish(request.get_data())
+
+    @app.route('/profiles/<name>', methods=['GET'])
+    def get_profile(name: str):
+        """Gets a stored profile or request body, with the same X-Profile header needed to create it"""
+        path = get_profile_path(name)
+        if not is_profiling_allowed(request.headers, request.args) or path is None:
+            return encode_json({}), 404
+        return send_file(path, as_attachment=True)
+
+    @app.after_request
+    def capture_request(response):
+        if capture.should_capture(request.path, request.content_length or 0):
+            capture.record(request.method, request.path, request.args, request.content_type, request.get_data(),
+                           response.status_code, response.mimetype)
+        return response
+
+    def _record_request_metrics(response, duration: float):
+        """Records the count, latency, and payload sizes of a request, by route rule to keep the labels bounded"""
+        route = {'route': request.url_rule.rule if request.url_rule is not None else 'unmatched'}
+        metrics.inc('saswebcalc_requests_total', dict(route, method=request.method, status=response.status_code))
+        metrics.observe('saswebcalc_request_duration_seconds', route, duration)
+        metrics.observe('saswebcalc_request_size_bytes', route, request.content_length or 0, SIZE_BUCKETS)
+        if not response.is_streamed:
+            metrics.observe('saswebcalc_response_size_bytes', route, response.calculate_content_length() or 0,
+                            SIZE_BUCKETS)
+        metrics.flush()
+
+    @app.route('/masks/<key>', methods=['GET'])
+    def get_mask(key: str):
+        """Gets a detector mask by the digest sent in the masks of a calculation, serialized by DetectorMask.to_dict.
+        Masks never change, so clients only fetch each one once."""
+        stored = mask_store.get(key)
+        if stored is None:
+            return encode_json({}), 404
+        response = app.response_class(stored[0], mimetype=stored[1])
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        """Gets the request, calculation, and cache metrics of every process in the Prometheus text format"""
+        return app.response_class(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+    @app.route('/timing/', methods=['GET'])
+    def get_timing():
+        """Gets the histogram of each timed stage in this process, when timing is enabled"""
+        if not TIMING_ENABLED:
+            return encode_json({}), 404
+        return encode_json(get_timing_stats())
+
+    @app.errorhandler(PoolBusyError)
+    def pool_busy(e):
+        response = app.response_class(encode_json({"error": str(e)}), status=503)
+        response.headers['Retry-After'] = '1'
+        return response
+
+    @app.errorhandler(JobTimeoutError)
+    def job_timeout(e):
+        return encode_json({"error": str(e)}), 504
+
+    @app.errorhandler(JobCancelledError)
+    def job_cancelled(e):
+        # The client has gone, so this is never read, but is logged as a client closed request
+        return encode_json({"error": str(e)}), 499
 
     # Launches the main program based on a basic link
     @app.route('/', methods=['GET', 'POST'])
@@ -57,27 +215,23 @@ def create_app():
 
     @app.route('/get/onLoad/', methods=['GET'])
     def get_all_onload():
-        return_array = {}
-        return_array["structures"] = get_structure_list()
-        return_array["multiplicity_models"] = get_multiplicity_models()
-        return_array["models"] = get_model_list()
-        return_array["instruments"] = _get_all_instruments()
-        return encode_json(return_array)
+        # The payload is built once per process and only changes when sasmodels or the instruments change
+        body, etag, last_modified = catalog.get_snapshot()
+        response = app.response_class(body)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
 
     def _get_all_instruments():
-        """Gets a list of all the instruments that are in the python.instruments directory
+        """Gets a list of all the instruments that are in the instrument registry
 
         :return: A dictionary of the structure that includes structure name and the user visible name
         :rtype: Dict
         """
-        instrument_list = {}
-        loaded_instruments = _import_instruments()
-        for instrument in loaded_instruments:
-            cls = loaded_instruments[instrument]
-            code_name = cls.class_name if hasattr(cls, "class_name") else str(cls)
-            front_name = cls.name_shown if hasattr(cls, "name_shown") else code_name
-            instrument_list[code_name] = front_name
-        return instrument_list
+        return registry.get_instrument_names()
+
+    catalog = Catalog(_get_all_instruments)
 
     @app.route('/get/params/<model_name>', methods=['GET'])
     @app.route('/get/params/model/<model_name>', methods=['GET'])
@@ -87,8 +241,25 @@ def create_app():
 
     @app.route('/get/params/instrument/<instrument_name>', methods=['GET'])
     def get_instrument_params(instrument_name):
-        loaded_instruments = _import_instruments()
-        return encode_json(loaded_instruments[instrument_name].get_js_params())
+        js_params = registry.get_js_params_json(instrument_name)
+        if js_params is None:
+            return encode_json({}), 404
+        return js_params
+
+    @app.route('/reload/instruments/', methods=['POST'])
+    def reload_instruments():
+        """Reloads the instrument modules so changes are used without restarting the server. Only available in
+        debug mode.
+        """
+        if not app.debug:
+            return encode_json({}), 404
+        registry.reload()
+        catalog.reset()
+        pool.restart()
+        result_cache.clear()
+        DECLARED_UNITS_CACHE.clear()
+        INSTRUMENT_CACHE.clear()
+        return encode_json(_get_all_instruments())
 
     @app.route('/update/params/', methods=['POST'])
     def model_params_update() -> dict:
@@ -179,12 +350,105 @@ def create_app():
         The primary method for calculating the neutron scattering for a particular model/instrument combination.
         Calls the instrument to get Q, dQ, and relative intensities.
         Calls the model to get real intensities for the Q range(s) calculated by the instrument.
-        :return: A json-like string representation of all the data
+        :return: A json-like string representation of all the data, or the binary format if requested
         """
 
+        with span('decode'):
+            data = decode_json(request.data)[0]
+            json_like = json.loads(data)
+        # Requests that only differ in how values are written are calculated, and cached, as the same request
+        with span('normalize'):
+            json_like = normalize_request(json_like, registry)
+        # Clients that only plot I(Q) can skip the 2D model with the dimensions=1d query parameter
+        include_2d = request.args.get('dimensions', '2d') != '1d'
+        precision_2d = request.args.get('precision_2d', PRECISION_2D)
+        if precision_2d not in PRECISIONS:
+            return encode_json({"error": f"precision_2d must be one of {', '.join(PRECISIONS)}"}), 400
+        # Identical requests are answered from the shared result cache, unless they are being profiled
+        use_cache = result_cache.enabled and g.get('profile') is None
+        if use_cache:
+            with span('result_cache'):
+                key = get_request_digest(json_like, include_2d, precision_2d, *_get_response_format(precision_2d))
+                cached = result_cache.get(key)
+                # Responses referring to masks that are no longer stored are calculated again, storing the masks
+                if cached is not None and not has_mask_references(mask_store, key):
+                    cached = None
+            if cached is not None:
+                response = app.response_class(cached[0], mimetype=cached[1])
+                response.headers['X-Result-Cache'] = 'hit'
+                return response
+        # Under the ASGI application, a calculation still waiting for the process pool is cancelled when the client
+        #  disconnects
+        params = _calculate_all(json_like, include_2d, precision_2d=precision_2d,
+                                cancelled=request.environ.get(DISCONNECTED_KEY))
+
+        # Return all data
+
+        with span('encode'):
+            response = app.make_response(_encode_response(params, precision_2d))
+        if use_cache:
+            if params:
+                result_cache.put(key, response.get_data(), response.mimetype)
+                put_mask_references(mask_store, key, params)
+            response.headers['X-Result-Cache'] = 'miss'
+        return response
+
+    @app.route('/calculate/batch/', methods=['POST'])
+    def calculate_batch():
+        """Calculates one model for many instrument configurations, e.g. a sweep of wavelengths or detector distances.
+
+        The request is the same as for /calculate/, except instrument_params is a list of instrument parameter
+        dictionaries. The variants are calculated by a pool of BATCH_WORKERS threads and share the cached model,
+        kernels, and detector geometry. Each result is streamed back as soon as it and every earlier result are done,
+        as one JSON object per line in the order of instrument_params.
+        :return: A streamed response of newline delimited JSON
+        """
         data = decode_json(request.data)[0]
         json_like = json.loads(data)
-
+        variants = json_like.get('instrument_params', [])
+        if not isinstance(variants, list):
+            return encode_json({"error": "instrument_params must be a list"}), 400
+        if len(variants) > BATCH_MAX_SIZE:
+            return encode_json({"error": f"A batch can have at most {BATCH_MAX_SIZE} instrument_params"}), 400
+        include_2d = request.args.get('dimensions', '2d') != '1d'
+        precision_2d = request.args.get('precision_2d', PRECISION_2D)
+        if precision_2d not in PRECISIONS:
+            return encode_json({"error": f"precision_2d must be one of {', '.join(PRECISIONS)}"}), 400
+
+        disconnected = request.environ.get(DISCONNECTED_KEY)
+
+        def _calculate_variant(variant):
+            try:
+                variant = normalize_request(dict(json_like, instrument_params=variant), registry)
+                return encode_json(_calculate_all(variant, include_2d, block=True, precision_2d=precision_2d,
+                                                  cancelled=disconnected))
+            except Exception as e:
+                return encode_json({"error": str(e)})
+
+        def _generate():
+            executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+            try:
+                for result in executor.map(_calculate_variant, variants):
+                    yield result + "\n"
+            finally:
+                # Drop the remaining variants if the client disconnects
+                executor.shutdown(wait=False, cancel_futures=True)
+
+        return app.response_class(_generate(), mimetype='application/x-ndjson')
+
+    def _calculate_all(json_like: dict, include_2d: bool = True, block: bool = False,
+                       precision_2d: str = PRECISION_2D, cancelled: Optional[threading.Event] = None) -> dict:
+        """Calculates the instrument, slicer, and model for a single /calculate/ request
+
+        :param dict json_like: The decoded request
+        :param bool include_2d: Whether the 2D model is calculated and returned
+        :param bool block: Wait for the worker pool instead of raising PoolBusyError when it is full
+        :param str precision_2d: The precision of the 2D model, 'single' for float32 kernels, Q values, and intensities
+        :param threading.Event cancelled: Cancels the jobs still waiting for the worker pool when set
+        :return: The calculation results, or an empty dictionary if there are no instrument params
+        :rtype: dict
+        """
+        start = time.perf_counter()
         # Get instrument and instrument params out of the dict
         instrument = json_like.get('instrument', '')
         instrument_params = json_like.get('instrument_params', {})
@@ -196,16 +460,20 @@ def create_app():
         if is_structure_factor:
             model = model + "@" + structure_factor
         model_params = json_like.get('model_params', {})
-        model_params = _model_params_restructure(model_params)
+        with span('params'):
+            model_params = _model_params_restructure(model_params)
 
         # Gets slicer and Slicer params out of dict
         slicer = json_like.get('averaging_type', '')
         slicer_params = json_like.get('averaging_params', {})
 
+        # Gets the resolution applied to the 1D model, either None or Pinhole
+        resolution_type = json_like.get('resolution', 'None')
+
         # Returns if array is empty
         if instrument_params == {}:
             print("Returning Blank")
-            return encode_json({})
+            return {}
 
         # Make slicer circular if none given
         if not slicer:
@@ -216,34 +484,78 @@ def create_app():
         # Creates params for calculation from all the params
         calculate_params = {"instrument_params": instrument_params, "slicer": slicer, "slicer_params": slicer_params}
 
-        # Calculate the instrument and slicer
-        params = _calculate_instrument(instrument, calculate_params)
+        # Calculate the instrument and slicer, unless a request with the same instrument inputs already did, e.g.
+        #  when only a model parameter was changed
+        instrument_key = get_instrument_key(instrument, instrument_params, slicer, slicer_params)
+        with span('calculate_instrument'):
+            instrument_result = get_instrument_result(
+                instrument_key, lambda: _calculate_instrument(instrument, calculate_params, block, cancelled))
+        # The cached results are shared, so the model results are put in a copy. The masks are published for every
+        #  response, as the cached results can outlive the stored masks.
+        params = publish_masks(dict(instrument_result.params), mask_store)
         # Get q in proper format
-        q_1d = [np.asarray(params.get('qValues', []))]
-        # qx and qy values are 1D arrays of base values -> Need to create 2D arrays for each
-        qx = np.asarray(params.get('qxValues', []))
-        qy = np.asarray(params.get('qyValues', []))
-        # Need size of 1D arrays for 2D array sizes
-        len_x = len(qx)
-        len_y = len(qy)
-        qx = np.tile(qx, [len_y, 1])
-        qy = np.transpose(np.tile(qy, [len_x, 1])[::-1])
-        q_2d = [qx, qy]
-
-        # Calculate the 1D model
-        model_1d = _calculate_model(model, model_params, q_1d)
+        q_1d = instrument_result.q_1d
+        q_2d = None
+        dtype_2d = PRECISIONS[precision_2d]
+        if include_2d:
+            with span('q_2d'):
+                q_2d = instrument_result.get_q_2d(dtype_2d)
+
+        # Pinhole smearing calculates the 1D model at oversampled Q values and smears it back to the slicer Q values
+        resolution = None
+        if resolution_type == 'Pinhole' and len(q_1d[0]):
+            with span('resolution'):
+                resolution = get_pinhole_resolution(q_1d[0], np.asarray(params.get('sigmaQ', [])))
+            q_1d = [resolution.q_calc]
+
+        # Calculate the 1D and 2D models from a single parameter setup
+        with span('calculate_model'):
+            model_1d, model_2d = pool.run(calculate_model_1d_2d, model, q_1d, q_2d, model_params, precision_2d,
+                                          block=block, cancelled=cancelled)
+        metrics.inc('saswebcalc_model_evaluations_total', {'model': model})
+        if resolution is not None:
+            with span('smear'):
+                model_1d = resolution.apply(model_1d)
         comb_1d = np.asarray(model_1d) * np.asarray(params.get('fSubs', []))
-        params['fSubs'] = comb_1d.tolist()
-        # Calculate the 2D model
-        model_2d = _calculate_model(model, model_params, q_2d)
-        i_2d = np.asarray(params.get('intensity2D', []))
-        comb_2d = np.asarray(model_2d).reshape(i_2d.shape) * i_2d
-        params['intensity2D'] = comb_2d.tolist()
-
-        # Return all data
-
+        params['fSubs'] = comb_1d
+        if include_2d:
+            i_2d = instrument_result.get_array('intensity2D', dtype_2d)
+            comb_2d = np.asarray(model_2d, dtype=dtype_2d).reshape(i_2d.shape) * i_2d
+            params['intensity2D'] = comb_2d
+        else:
+            # The instrument-only 2D intensity would be misleading without the model applied
+            params.pop('intensity2D', None)
+        # Unknown names are grouped so user input cannot add labels
+        labels = {'instrument': instrument if instrument in registry else 'unknown',
+                  'averaging_type': slicer if slicer in AVERAGING_TYPES else 'other'}
+        metrics.observe('saswebcalc_calculation_duration_seconds', labels, time.perf_counter() - start)
+        return params
+
+    def _encode_response(params, precision_2d: str = PRECISION_2D):
+        """Encodes calculation results as JSON, or in the binary format from helpers.encode_binary when the client
+        asks for it with an Accept header of application/x-saswebcalc-binary or a format=binary query parameter.
+        Binary arrays are float64 unless the precision=single query parameter is given, or the 2D model was
+        calculated in single precision, which sends the 2D intensities as float32.
+
+        :param dict params: The calculation results
+        :param str precision_2d: The precision the 2D model was calculated in
+        :return: The encoded results
+        """
+        response_format, dtype = _get_response_format(precision_2d)
+        if response_format == 'binary':
+            return app.response_class(encode_binary(params, dtype), mimetype=BINARY_MIMETYPE)
         return encode_json(params)
 
+    def _get_response_format(precision_2d: str = PRECISION_2D):
+        """Gets the format the client asked for, json or binary, and the dtype of binary arrays, None to keep the
+        float32 arrays of a single precision 2D model"""
+        accepted = request.accept_mimetypes.best_match(['application/json', BINARY_MIMETYPE])
+        if request.args.get('format', '') == 'binary' or accepted == BINARY_MIMETYPE:
+            if request.args.get('precision', '') == 'single':
+                return 'binary', '<f4'
+            return 'binary', None if precision_2d == 'single' else '<f8'
+        return 'json', None
+
     def _model_params_restructure(model_params):
         """Restructures the parameters for the model calculations
 
@@ -274,12 +586,12 @@ def create_app():
         return encode_json(_calculate_model(model_name, model_params, None))
 
     def _calculate_model(model_name: str, model_params: Dict[str, Union[Number, str]],
-                         q: Optional[List[np.ndarray]] = None) -> List[Number]:
+                         q: Optional[List[np.ndarray]] = None) -> np.ndarray:
         """Private method to directly call the model calculator
         :param model_name: The string representation of the model name used by sasmodels.
         :param model_params: A dictionary mapping the sasmodel parameter name to the parameter value.
         :param q: An n-dimensional array of Q values.
-        :return: A json-like string representation of a list of intensities.
+        :return: An array of intensities.
         """
         if q is None:
             # If no instrument data sent, use a default Q range of 0.0001 to 1.0 A^-1
@@ -290,50 +602,27 @@ def create_app():
     def calculate_instrument(instrument_name: str) -> str:
         params = decode_json(request.data)
         # Calculates all the values and returns them
-        return encode_json(_calculate_instrument(instrument_name, params))
-
-    def _import_instruments():
-        """Gets a list of the instruments in the python.instruments directory
+        return _encode_response(publish_masks(_calculate_instrument(instrument_name, params), mask_store))
 
-        :return: A dictionary that has the name and the object
-        :rtype; Dict
-        """
-        # Specify the directory containing the classes
-        directory = 'python/instruments'
-
-        # Get a list of all Python files in the directory
-        files = [file[:-3] for file in os.listdir(directory) if file.endswith('.py')]
-
-        instruments_dict = {}
-        # Import all classes from the files
-        for file in files:
-            module = importlib.import_module(directory.replace("/", ".")+'.' + file)
-            result = inspect.getmembers(module, inspect.isclass)
-            for name, cls in result:
-                if hasattr(cls, "class_name"):
-                    if name !="Example":
-                        instruments_dict[name] = cls
-        return instruments_dict
-
-    def _calculate_instrument(instrument: str, params: dict) -> Dict[str, Union[Number, str, List[Union[Number, str]]]]:
+    def _calculate_instrument(instrument: str, params: dict, block: bool = False,
+                              cancelled: Optional[threading.Event] = None
+                              ) -> Dict[str, Union[Number, str, List[Union[Number, str]]]]:
         """The base calculation script. Creates an instrument class, calculates the instrumental resolution for the
         configuration, and returns two list of intensities
 
         :param str instrument: The instrument that we're doing the calculations based off of
         :param dict params: A dictionary of parameters inputted by the user in the JavaScript
+        :param bool block: Wait for the worker pool instead of raising PoolBusyError when it is full
+        :param threading.Event cancelled: Cancels the job if it is still waiting for the worker pool when set
         :return: The python return dictionary
         :rtype: dict
         """
-        loaded_instruments = _import_instruments()
-        if instrument in loaded_instruments:
-            loaded_instrument = loaded_instruments[instrument]
-        else:
-            print("Instrument Not on List")
-            return {}
-        # Temporary fix- TODO make the name of everything the same
-        instrument_name = instrument[0:instrument.find("S")].lower()
-        i_class = loaded_instrument(instrument_name, params)
-        return i_class.sas_calc()
+        if pool.enabled:
+            # The instrument is set up here, and the slicer of each detector bank, where most of the time is spent, is
+            #  created by a worker, so the banks of an instrument are averaged in parallel
+            bank_map = functools.partial(pool.map, block=block, cancelled=cancelled)
+            return run_sas_calc(instrument, params, registry, bank_map)
+        return run_sas_calc(instrument, params, registry)
 
     return app
 